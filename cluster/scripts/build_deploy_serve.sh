@@ -13,6 +13,9 @@ PROJECT_ROOT=$(realpath "$SCRIPT_DIR/..")
 SERVE_DIR="$PROJECT_ROOT/serve/src"
 DOCKER_DIR="$PROJECT_ROOT/docker"
 DOCKERFILE="$DOCKER_DIR/Dockerfile.serve"
+# Optional multi-model config (e.g. examples/vllm-app/src/vllm.config.yaml), mounted into the container;
+# unset serves the single Llama deployment of start.sh
+MODELS_CONFIG="${MODELS_CONFIG:-}"
 IMAGE_TAG="serve:latest"
 
 # --- Functions ---
@@ -40,6 +43,7 @@ trap cleanup EXIT
 
 [[ ! -d "$SERVE_DIR" ]] && error_exit "Source directory not found: $SERVE_DIR"
 [[ ! -f "$DOCKERFILE" ]] && error_exit "Dockerfile not found: $DOCKERFILE"
+[[ -n "$MODELS_CONFIG" && ! -f "$MODELS_CONFIG" ]] && error_exit "Models config not found: $MODELS_CONFIG"
 echo "Copying serve directory contents to build context..."
 cp -r "$SERVE_DIR"/. "$BUILD_CONTEXT/" || error_exit "Failed to copy serve directory contents"
 cp "$DOCKERFILE" "$BUILD_CONTEXT/Dockerfile.serve" || error_exit "Failed to copy Dockerfile.serve"
@@ -63,11 +67,18 @@ echo "Deploying Docker container '$CONTAINER_NAME' from image: $IMAGE_TAG"
 echo "Using RAY_ADDRESS: $RAY_ADDRESS"
 echo "Mapping host path '/home/nitingoyal/storage/tmp/ray' to container path '/tmp/ray'"
 
+MODELS_ARGS=()
+if [[ -n "$MODELS_CONFIG" ]]; then
+    echo "Serving the models in $MODELS_CONFIG"
+    MODELS_ARGS=(-v "$(realpath "$MODELS_CONFIG"):/app/models.config.yaml:ro" -e SERVE_MODELS_CONFIG=/app/models.config.yaml)
+fi
+
 docker run \
     --name "$CONTAINER_NAME" \
     --network host \
     -v /home/nitingoyal/storage/tmp/ray:/tmp/ray \
     -e RAY_ADDRESS="$RAY_ADDRESS" \
+    "${MODELS_ARGS[@]}" \
     "$IMAGE_TAG";
 
 echo "Container '$CONTAINER_NAME' started successfully."
@@ -0,0 +1,231 @@
+"""Load generator for the OpenAI-compatible LLM deployment.
+
+Drives concurrent streaming chat completions and reports time-to-first-token,
+inter-token latency, end-to-end latency percentiles and aggregate tokens/s.
+
+    # against the cluster
+    python benchmark.py --base-url http://0.0.0.0:8000/v1 --num-requests 500 \
+        --arrival poisson --rate 4 --prompt-len lognormal:256:0.6 --output-len uniform:32:256
+
+    # closed loop against the bundled mock server (CPU only)
+    python mock_openai_server.py --port 8100 &
+    python benchmark.py --base-url http://127.0.0.1:8100/v1 --arrival closed --concurrency 32
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import numpy as np
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Log every request at INFO; newer openai releases send through httpx2
+HTTP_CLIENT_LOGGERS = ("httpx", "httpx2", "openai")
+
+FILLER_WORDS = (
+    "species habitat specimen occurrence record taxon genus family collection "
+    "observation latitude longitude museum herbarium biodiversity"
+).split()
+
+
+@dataclass
+class WorkloadConfig:
+    base_url: str = "http://0.0.0.0:8000/v1"
+    model: str = "meta-llama/Llama-3.1-8B-Instruct"
+    num_requests: int = 200
+    # "poisson": open loop at `rate` req/s; "closed": `concurrency` users back to back
+    arrival: str = "closed"
+    rate: float = 4.0
+    concurrency: int = 16
+    prompt_len: str = "uniform:64:512"
+    output_len: str = "uniform:32:256"
+    seed: int = 0
+    timeout_s: float = 600.0
+
+
+@dataclass
+class RequestResult:
+    # Token counts as reported by the server's usage, not the sampled lengths
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+    ttft_s: Optional[float] = None
+    e2e_s: Optional[float] = None
+    itl_s: List[float] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+def sample_lengths(spec: str, n: int, rng: np.random.Generator) -> List[int]:
+    """Samples n lengths from "fixed:N", "uniform:LO:HI" or "lognormal:MEDIAN:SIGMA"."""
+    kind, *params = spec.split(":")
+    if kind == "fixed":
+        values = np.full(n, float(params[0]))
+    elif kind == "uniform":
+        values = rng.integers(int(params[0]), int(params[1]) + 1, size=n)
+    elif kind == "lognormal":
+        values = rng.lognormal(np.log(float(params[0])), float(params[1]), size=n)
+    else:
+        raise ValueError(f"Unknown length distribution: {spec}")
+    return [max(1, int(v)) for v in values]
+
+
+def make_prompt(num_tokens: int, rng: random.Random) -> str:
+    # Roughly one token per filler word for Llama tokenizers
+    return " ".join(rng.choice(FILLER_WORDS) for _ in range(num_tokens))
+
+
+async def send_request(
+    client: AsyncOpenAI, config: WorkloadConfig, prompt: str, max_tokens: int
+) -> RequestResult:
+    result = RequestResult()
+    start = time.perf_counter()
+    last_token_at = None
+    try:
+        stream = await client.chat.completions.create(
+            model=config.model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            temperature=0,
+            stream=True,
+            stream_options={"include_usage": True},
+            # vLLM extension so every request generates exactly max_tokens
+            extra_body={"ignore_eos": True},
+        )
+        chunks = 0
+        async for chunk in stream:
+            if chunk.usage is not None:
+                result.prompt_tokens = chunk.usage.prompt_tokens
+                result.output_tokens = chunk.usage.completion_tokens
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            now = time.perf_counter()
+            if last_token_at is None:
+                result.ttft_s = now - start
+            else:
+                result.itl_s.append(now - last_token_at)
+            last_token_at = now
+            chunks += 1
+        result.e2e_s = time.perf_counter() - start
+        result.output_tokens = result.output_tokens or chunks
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def run_benchmark(config: WorkloadConfig) -> Dict[str, float]:
+    """Runs the workload and returns the summary produced by `summarize`."""
+    np_rng = np.random.default_rng(config.seed)
+    rng = random.Random(config.seed)
+    prompt_lens = sample_lengths(config.prompt_len, config.num_requests, np_rng)
+    output_lens = sample_lengths(config.output_len, config.num_requests, np_rng)
+    prompts = [make_prompt(n, rng) for n in prompt_lens]
+
+    client = AsyncOpenAI(base_url=config.base_url, api_key="-", timeout=config.timeout_s, max_retries=0)
+    jobs = list(zip(prompts, output_lens))
+
+    start = time.perf_counter()
+    if config.arrival == "poisson":
+        async def delayed(delay_s: float, job) -> RequestResult:
+            await asyncio.sleep(delay_s)
+            return await send_request(client, config, *job)
+
+        arrivals = np.cumsum(np_rng.exponential(1.0 / config.rate, size=len(jobs)))
+        results = await asyncio.gather(*(delayed(t, job) for t, job in zip(arrivals, jobs)))
+    elif config.arrival == "closed":
+        queue = list(reversed(jobs))
+        results = []
+
+        async def user():
+            while queue:
+                results.append(await send_request(client, config, *queue.pop()))
+
+        await asyncio.gather(*(user() for _ in range(config.concurrency)))
+    else:
+        raise ValueError(f"Unknown arrival process: {config.arrival}")
+    duration_s = time.perf_counter() - start
+
+    await client.close()
+    return summarize(results, duration_s)
+
+
+def percentiles(values: List[float], prefix: str) -> Dict[str, float]:
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(np.asarray(values) * 1000, [50, 90, 99])
+    return {
+        f"{prefix}_mean_ms": float(np.mean(values) * 1000),
+        f"{prefix}_p50_ms": float(p50),
+        f"{prefix}_p90_ms": float(p90),
+        f"{prefix}_p99_ms": float(p99),
+    }
+
+
+def summarize(results: List[RequestResult], duration_s: float) -> Dict[str, float]:
+    ok = [r for r in results if r.error is None]
+    output_tokens = sum(r.output_tokens for r in ok)
+    prompt_tokens = sum(r.prompt_tokens for r in ok)
+    summary = {
+        "requests": len(results),
+        "failed": len(results) - len(ok),
+        "duration_s": duration_s,
+        "request_throughput": len(ok) / duration_s,
+        "output_tokens_per_s": output_tokens / duration_s,
+        "total_tokens_per_s": (prompt_tokens + output_tokens) / duration_s,
+    }
+    summary.update(percentiles([r.ttft_s for r in ok if r.ttft_s is not None], "ttft"))
+    summary.update(percentiles([itl for r in ok for itl in r.itl_s], "itl"))
+    summary.update(percentiles([r.e2e_s for r in ok], "e2e"))
+    for r in results:
+        if r.error:
+            logger.warning(f"Request failed: {r.error}")
+            break
+    return summary
+
+
+def quiet_http_logs() -> None:
+    for name in HTTP_CLIENT_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def parse_args() -> argparse.Namespace:
+    defaults = WorkloadConfig()
+    parser = argparse.ArgumentParser("OpenAI-compatible serving benchmark")
+    parser.add_argument("--base-url", default=defaults.base_url)
+    parser.add_argument("--model", default=defaults.model)
+    parser.add_argument("--num-requests", type=int, default=defaults.num_requests)
+    parser.add_argument("--arrival", choices=["poisson", "closed"], default=defaults.arrival)
+    parser.add_argument("--rate", type=float, default=defaults.rate, help="Requests/s for poisson arrivals")
+    parser.add_argument("--concurrency", type=int, default=defaults.concurrency, help="Users for closed-loop arrivals")
+    parser.add_argument("--prompt-len", default=defaults.prompt_len, help="fixed:N | uniform:LO:HI | lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--output-len", default=defaults.output_len, help="fixed:N | uniform:LO:HI | lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--output", help="Append the summary as a JSON line to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    quiet_http_logs()
+    args = parse_args()
+    config = WorkloadConfig(
+        base_url=args.base_url,
+        model=args.model,
+        num_requests=args.num_requests,
+        arrival=args.arrival,
+        rate=args.rate,
+        concurrency=args.concurrency,
+        prompt_len=args.prompt_len,
+        output_len=args.output_len,
+        seed=args.seed,
+    )
+    summary = asyncio.run(run_benchmark(config))
+    for name, value in summary.items():
+        print(f"{name:>24}: {value:,.2f}")
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps({"config": asdict(config), "summary": summary}) + "\n")
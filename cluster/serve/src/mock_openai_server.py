@@ -0,0 +1,140 @@
+"""Mock OpenAI-compatible chat server for running benchmark.py on a CPU-only box.
+
+Generates filler tokens with a simple latency model: prefill cost grows with
+the prompt length, decode cost per token grows with the number of sequences
+sharing the (simulated) engine, and requests beyond `max_num_seqs` wait in a
+queue just like they would in vLLM.
+
+    python mock_openai_server.py --port 8100 --itl-ms 20
+    python benchmark.py --base-url http://127.0.0.1:8100/v1 --num-requests 200
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict
+
+import uvicorn
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class MockEngineProfile:
+    model: str = "meta-llama/Llama-3.1-8B-Instruct"
+    max_num_seqs: int = 64
+    prefill_base_ms: float = 20.0
+    prefill_per_token_ms: float = 0.05
+    itl_ms: float = 15.0
+    # Fractional slowdown of one decode step when every sequence slot is busy
+    batch_slowdown: float = 1.0
+
+
+def count_prompt_tokens(messages) -> int:
+    # Whitespace split is close enough to drive the latency model
+    return sum(len(str(message.get("content", "")).split()) for message in messages)
+
+
+def build_mock_app(profile: MockEngineProfile) -> FastAPI:
+    app = FastAPI()
+    slots = asyncio.Semaphore(profile.max_num_seqs)
+    state = {"running": 0}
+
+    def decode_delay_s() -> float:
+        load = state["running"] / profile.max_num_seqs
+        return profile.itl_ms * (1 + profile.batch_slowdown * load) / 1000
+
+    async def generate(prompt_tokens: int, max_tokens: int) -> AsyncIterator[str]:
+        async with slots:
+            state["running"] += 1
+            try:
+                prefill_ms = profile.prefill_base_ms + profile.prefill_per_token_ms * prompt_tokens
+                await asyncio.sleep(prefill_ms / 1000)
+                for i in range(max_tokens):
+                    if i:
+                        await asyncio.sleep(decode_delay_s())
+                    yield f"tok{i} "
+            finally:
+                state["running"] -= 1
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": profile.model, "object": "model", "owned_by": "mock"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body: Dict[str, Any] = await request.json()
+        prompt_tokens = count_prompt_tokens(body.get("messages", []))
+        max_tokens = int(body.get("max_tokens") or body.get("max_completion_tokens") or 16)
+        base = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "created": int(time.time()),
+            "model": body.get("model", profile.model),
+        }
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": max_tokens,
+            "total_tokens": prompt_tokens + max_tokens,
+        }
+
+        if not body.get("stream"):
+            content = "".join([token async for token in generate(prompt_tokens, max_tokens)])
+            return JSONResponse({
+                **base,
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "length",
+                    "logprobs": None,
+                }],
+                "usage": usage,
+            })
+
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        async def events() -> AsyncIterator[str]:
+            chunk = {**base, "object": "chat.completion.chunk"}
+            first = True
+            async for token in generate(prompt_tokens, max_tokens):
+                delta = {"role": "assistant", "content": token} if first else {"content": token}
+                first = False
+                yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})}\n\n"
+            yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'length'}]})}\n\n"
+            if include_usage:
+                yield f"data: {json.dumps({**chunk, 'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser("Mock OpenAI-compatible chat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--model", default=MockEngineProfile.model)
+    parser.add_argument("--max-num-seqs", type=int, default=MockEngineProfile.max_num_seqs)
+    parser.add_argument("--prefill-base-ms", type=float, default=MockEngineProfile.prefill_base_ms)
+    parser.add_argument("--prefill-per-token-ms", type=float, default=MockEngineProfile.prefill_per_token_ms)
+    parser.add_argument("--itl-ms", type=float, default=MockEngineProfile.itl_ms)
+    parser.add_argument("--batch-slowdown", type=float, default=MockEngineProfile.batch_slowdown)
+    args = parser.parse_args()
+
+    profile = MockEngineProfile(
+        model=args.model,
+        max_num_seqs=args.max_num_seqs,
+        prefill_base_ms=args.prefill_base_ms,
+        prefill_per_token_ms=args.prefill_per_token_ms,
+        itl_ms=args.itl_ms,
+        batch_slowdown=args.batch_slowdown,
+    )
+    uvicorn.run(build_mock_app(profile), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
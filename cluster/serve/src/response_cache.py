@@ -0,0 +1,317 @@
+import hashlib
+import json
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple
+
+import httpx
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+
+from ray import serve
+from ray.serve import metrics
+
+logger = logging.getLogger("ray.serve")
+
+# Fields that only change how a completion is delivered, not what is generated
+TRANSPORT_FIELDS = {"stream", "stream_options", "user"}
+# Seconds before an unknown model name triggers another look at the served models
+MODELS_REFRESH_S = 60.0
+
+
+def cache_key(body: Dict[str, Any]) -> str:
+    """Canonical hash of model + messages + sampling params."""
+    payload = {k: v for k, v in body.items() if k not in TRANSPORT_FIELDS}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(body: Dict[str, Any]) -> bool:
+    """Only greedy (or explicitly seeded) single-choice completions are replayable."""
+    if body.get("n") not in (None, 1):
+        return False
+    if body.get("logprobs") or body.get("tools"):
+        return False
+    # OpenAI (and vLLM) default temperature is 1.0 when omitted
+    temperature = body.get("temperature")
+    return temperature == 0 or body.get("seed") is not None
+
+
+class ResponseCache:
+    """In-memory LRU cache of chat completions with a TTL and a byte budget."""
+
+    def __init__(self, max_bytes: int, ttl_s: float):
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.size_bytes = 0
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, payload = entry
+        if self.ttl_s and time.monotonic() - stored_at > self.ttl_s:
+            self._evict(key)
+            return None
+        self._entries.move_to_end(key)
+        return json.loads(payload)
+
+    def put(self, key: str, completion: Dict[str, Any]) -> None:
+        payload = json.dumps(completion, separators=(",", ":")).encode("utf-8")
+        if len(payload) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._evict(key)
+        self._entries[key] = (time.monotonic(), payload)
+        self.size_bytes += len(payload)
+        while self.size_bytes > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, key: str) -> None:
+        _, payload = self._entries.pop(key)
+        self.size_bytes -= len(payload)
+
+
+# ================================================================== #
+# Streaming <-> non-streaming conversion
+# ================================================================== #
+def completion_to_sse(completion: Dict[str, Any], include_usage: bool = False) -> Iterator[str]:
+    """Replays a stored chat.completion as OpenAI chat.completion.chunk events."""
+    base = {
+        "id": completion["id"],
+        "object": "chat.completion.chunk",
+        "created": completion["created"],
+        "model": completion["model"],
+    }
+    for choice in completion["choices"]:
+        message = choice["message"]
+        deltas = [
+            ({"role": message.get("role", "assistant"), "content": ""}, None),
+            ({"content": message.get("content") or ""}, None),
+            ({}, choice.get("finish_reason")),
+        ]
+        for delta, finish_reason in deltas:
+            chunk = {**base, "choices": [{
+                "index": choice["index"],
+                "delta": delta,
+                "logprobs": None,
+                "finish_reason": finish_reason,
+            }]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+    if include_usage and completion.get("usage"):
+        yield f"data: {json.dumps({**base, 'choices': [], 'usage': completion['usage']})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def sse_to_completion(raw: bytes) -> Optional[Dict[str, Any]]:
+    """Rebuilds a chat.completion from a streamed response, or None if incomplete."""
+    completion: Optional[Dict[str, Any]] = None
+    choices: Dict[int, Dict[str, Any]] = {}
+    for line in raw.decode("utf-8").splitlines():
+        if not line.startswith("data: ") or line == "data: [DONE]":
+            continue
+        chunk = json.loads(line[len("data: "):])
+        if "error" in chunk:
+            return None
+        if completion is None:
+            completion = {
+                "id": chunk["id"],
+                "object": "chat.completion",
+                "created": chunk["created"],
+                "model": chunk["model"],
+                "usage": None,
+            }
+        if chunk.get("usage"):
+            completion["usage"] = chunk["usage"]
+        for delta_choice in chunk.get("choices", []):
+            delta = delta_choice.get("delta") or {}
+            if delta.get("tool_calls"):
+                return None
+            choice = choices.setdefault(delta_choice["index"], {
+                "index": delta_choice["index"],
+                "message": {"role": "assistant", "content": ""},
+                "logprobs": None,
+                "finish_reason": None,
+            })
+            if delta.get("role"):
+                choice["message"]["role"] = delta["role"]
+            choice["message"]["content"] += delta.get("content") or ""
+            if delta_choice.get("finish_reason"):
+                choice["finish_reason"] = delta_choice["finish_reason"]
+
+    if completion is None or not choices:
+        return None
+    if any(choice["finish_reason"] is None for choice in choices.values()):
+        return None
+    completion["choices"] = [choices[i] for i in sorted(choices)]
+    return completion
+
+
+# ================================================================== #
+# Serve deployment
+# ================================================================== #
+app = FastAPI()
+
+
+def bad_request(message: str) -> JSONResponse:
+    """400 in the OpenAI error format the router uses."""
+    return JSONResponse(
+        content={"object": "error", "message": message, "type": "BadRequestError", "param": None, "code": 400},
+        status_code=400,
+    )
+
+
+# A single replica keeps one coherent cache; it only proxies bytes so it is cheap
+@serve.deployment(num_replicas=1, ray_actor_options={"num_cpus": 1})
+@serve.ingress(app)
+class ResponseCacheProxy:
+    """Caches deterministic chat completions in front of the OpenAI LLM router.
+
+    Requests are forwarded to `upstream_url` (the router app) over HTTP. Cache
+    misses are recorded from non-streaming responses and from streams that
+    include usage (stream_options.include_usage), and replayed in whichever
+    form the next identical request asks for.
+    """
+
+    def __init__(self, upstream_url: str, max_bytes: int, ttl_s: float):
+        self.cache = ResponseCache(max_bytes=max_bytes, ttl_s=ttl_s)
+        self.client = httpx.AsyncClient(base_url=upstream_url.rstrip("/"), timeout=None)
+        # Served model ids, the only values of the "model" metric tag besides "other"
+        self.models: Set[str] = set()
+        self.models_listed_at = float("-inf")
+        logger.info(f"Response cache enabled: upstream={upstream_url}, max_bytes={max_bytes}, ttl_s={ttl_s}")
+
+        tag_keys = ("model", "stream")
+        self.hits = metrics.Counter(
+            "llm_response_cache_hits",
+            description="Chat completions served from the response cache.",
+            tag_keys=tag_keys,
+        )
+        self.misses = metrics.Counter(
+            "llm_response_cache_misses",
+            description="Cacheable chat completions forwarded to the LLM router.",
+            tag_keys=tag_keys,
+        )
+        self.bypassed = metrics.Counter(
+            "llm_response_cache_bypassed",
+            description="Chat completions that are not cacheable (sampled, n>1, tools, logprobs).",
+            tag_keys=tag_keys,
+        )
+        self.size_bytes = metrics.Gauge(
+            "llm_response_cache_size_bytes",
+            description="Bytes currently held by the response cache.",
+        )
+        self.entries = metrics.Gauge(
+            "llm_response_cache_entries",
+            description="Completions currently held by the response cache.",
+        )
+
+    @app.post("/v1/chat/completions")
+    async def chat(self, request: Request) -> Response:
+        raw_body = await request.body()
+        try:
+            body = json.loads(raw_body)
+        except ValueError as e:
+            return bad_request(f"Invalid JSON body: {e}")
+        if not isinstance(body, dict):
+            return bad_request("The request body must be a JSON object")
+        stream = bool(body.get("stream"))
+        tags = {"model": await self._model_tag(body.get("model")), "stream": str(stream).lower()}
+
+        if not is_cacheable(body):
+            self.bypassed.inc(tags=tags)
+            return await self._forward(request, raw_body, stream)
+
+        key = cache_key(body)
+        completion = self.cache.get(key)
+        if completion is not None:
+            self.hits.inc(tags=tags)
+            if stream:
+                include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+                return StreamingResponse(
+                    completion_to_sse(completion, include_usage=include_usage),
+                    media_type="text/event-stream",
+                )
+            return JSONResponse(content=completion)
+
+        self.misses.inc(tags=tags)
+        return await self._forward(request, raw_body, stream, key=key)
+
+    async def _model_tag(self, model: Any) -> str:
+        """The model as a metric tag; names the upstream does not serve are
+        "other", so clients cannot grow the tag's cardinality."""
+        if not isinstance(model, str):
+            return "other"
+        if model not in self.models and time.monotonic() - self.models_listed_at > MODELS_REFRESH_S:
+            self.models_listed_at = time.monotonic()
+            try:
+                response = await self.client.get("/v1/models")
+                response.raise_for_status()
+                self.models = {m["id"] for m in response.json()["data"]}
+            except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Listing the upstream models failed: {e!r}")
+        return model if model in self.models else "other"
+
+    @app.api_route("/{path:path}", methods=["GET", "POST"])
+    async def passthrough(self, path: str, request: Request) -> Response:
+        # Relayed as it arrives, so streamed responses (e.g. /v1/completions) are not buffered
+        return await self._forward(request, await request.body(), stream=True, path=f"/{path}")
+
+    async def _forward(
+        self,
+        request: Request,
+        raw_body: bytes,
+        stream: bool,
+        key: Optional[str] = None,
+        path: str = "/v1/chat/completions",
+    ) -> Response:
+        headers = {k: v for k, v in request.headers.items() if k.lower() in ("authorization", "content-type")}
+        upstream_request = self.client.build_request(
+            request.method, path, content=raw_body, headers=headers, params=request.query_params
+        )
+        upstream = await self.client.send(upstream_request, stream=stream)
+
+        if not stream:
+            if key is not None and upstream.status_code == 200:
+                self._store(key, upstream.json())
+            return Response(
+                content=upstream.content,
+                status_code=upstream.status_code,
+                media_type=upstream.headers.get("content-type"),
+            )
+
+        return StreamingResponse(
+            self._tee(upstream, key),
+            status_code=upstream.status_code,
+            media_type=upstream.headers.get("content-type", "text/event-stream"),
+        )
+
+    async def _tee(self, upstream: httpx.Response, key: Optional[str]) -> AsyncIterator[bytes]:
+        recorded: List[bytes] = []
+        try:
+            # Decoded: only authorization and content-type are forwarded, so
+            # a compressed upstream body would reach the client without its
+            # Content-Encoding header
+            async for chunk in upstream.aiter_bytes():
+                if key is not None:
+                    recorded.append(chunk)
+                yield chunk
+        finally:
+            await upstream.aclose()
+        if key is not None and upstream.status_code == 200:
+            completion = sse_to_completion(b"".join(recorded))
+            # Without stream_options.include_usage the stream has no usage, and a
+            # replay to a non-streaming client would return "usage": null
+            if completion is not None and completion["usage"] is not None:
+                self._store(key, completion)
+
+    def _store(self, key: str, completion: Dict[str, Any]) -> None:
+        self.cache.put(key, completion)
+        self.size_bytes.set(self.cache.size_bytes)
+        self.entries.set(len(self.cache))
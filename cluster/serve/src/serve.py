@@ -1,10 +1,14 @@
 import os
-from typing import Dict
+from typing import Any, Dict, List, Optional
+
+import yaml
 from ray import serve
 from dotenv import load_dotenv
 # from ray.serve.llm import LLMServer, LLMConfig, LLMRouter
 from ray.serve.llm import LLMConfig, build_openai_app
 
+from response_cache import ResponseCacheProxy
+
 # Documentation:
 # https://docs.ray.io/en/latest/serve/llm/serving-llms.html
 def parse_cli_args(cli_args: Dict[str, str]) -> Dict[str, str]:
@@ -20,46 +24,122 @@ def parse_cli_args(cli_args: Dict[str, str]) -> Dict[str, str]:
     }
     return {**defaults, **cli_args}
 
-# Related github issues: https://github.com/ray-project/ray/issues/51242
-def build_app(cli_args: Dict[str, str]) -> serve.Application:
-    args = parse_cli_args(cli_args)
+# Scale-to-zero friendly defaults for models loaded from the config file: a model
+# scales up once its replicas hold more than `target_ongoing_requests` (running +
+# queued), and idle models release their GPUs after `downscale_delay_s`.
+AUTOSCALING_DEFAULTS = {
+    "min_replicas": 0,
+    "initial_replicas": 1,
+    "max_replicas": 1,
+    "target_ongoing_requests": 16,
+    "upscale_delay_s": 10,
+    "downscale_delay_s": 300,
+}
+
+
+def engine_kwargs_from_args(args: Dict[str, str]) -> Dict[str, Any]:
+    return {
+        "tensor_parallel_size": int(args["tensor_parallel_size"]),
+        "pipeline_parallel_size": int(args.get("pipeline_parallel_size", "1")),
+        "gpu_memory_utilization": float(args["gpu_memory_utilization"]),
+        "max_model_len": int(args["max_model_len"]),
+        "max_num_seqs": int(args["max_num_seqs"]),
+        "max_num_batched_tokens": int(args["max_num_batched_tokens"]),
+        "dtype": args["dtype"],
+        "enable_chunked_prefill": args["enable_chunked_prefill"].lower() == "true",
+    }
 
-    load_dotenv('.serve.env')
-    HF_TOKEN = os.environ.get("HF_TOKEN")
 
-    llm_config_dict = {
+def build_llm_config(
+    model_id: str,
+    model_source: str,
+    engine_kwargs: Dict[str, Any],
+    accelerator_type: str,
+    autoscaling: Dict[str, Any],
+    hf_token: Optional[str],
+) -> LLMConfig:
+    autoscaling = dict(autoscaling)
+    deployment_config = {"ray_actor_options": {}}
+    # Requests beyond this many per replica are queued at the router instead of the engine
+    deployment_config["max_ongoing_requests"] = autoscaling.pop(
+        "max_ongoing_requests", engine_kwargs.get("max_num_seqs", 64)
+    )
+    # Requests beyond this queue depth are rejected with a 503 instead of piling up
+    if "max_queued_requests" in autoscaling:
+        deployment_config["max_queued_requests"] = autoscaling.pop("max_queued_requests")
+    deployment_config["autoscaling_config"] = autoscaling
+
+    return LLMConfig(**{
         "model_loading_config": {
-            "model_id": args.get("model", "meta-llama/Llama-3.1-8B-Instruct"),
-            "model_source": "meta-llama/Llama-3.1-8B-Instruct",
-        },
-        "engine_kwargs": {
-            "tensor_parallel_size": int(args["tensor_parallel_size"]),
-            "pipeline_parallel_size": int(args.get("pipeline_parallel_size", "1")),
-            "gpu_memory_utilization": float(args["gpu_memory_utilization"]),
-            "max_model_len": int(args["max_model_len"]),
-            "max_num_seqs": int(args["max_num_seqs"]),
-            "max_num_batched_tokens": int(args["max_num_batched_tokens"]),
-            "dtype": args["dtype"],
-            "enable_chunked_prefill": args["enable_chunked_prefill"].lower() == "true",
+            "model_id": model_id,
+            "model_source": model_source,
         },
-        "deployment_config": {
-            "ray_actor_options": {},
-            "autoscaling_config": {
-                "min_replicas": 1,
-                "max_replicas": 1
-            }
-        },
-        "accelerator_type": "V100",
+        "engine_kwargs": engine_kwargs,
+        "deployment_config": deployment_config,
+        "accelerator_type": accelerator_type,
         "runtime_env": {
             "pip": ["httpx", "ray[llm,serve]==2.44.1", "vllm==0.7.2"],
             "env_vars": {
                 "USE_VLLM_V1": "0",
-                "HF_TOKEN": HF_TOKEN,
+                "HF_TOKEN": hf_token,
                 "TRITON_DISABLE":"mma,cutlass"
             }
         }
+    })
+
+
+def load_llm_configs(path: str, hf_token: Optional[str]) -> List[LLMConfig]:
+    """Builds one LLMConfig per entry of `models` in the config file.
+
+    Engine kwargs start from the `parse_cli_args` defaults and are overridden
+    by the file's `defaults` section and then by each model entry.
+    """
+    with open(path) as f:
+        config = yaml.safe_load(f) or {}
+    defaults = config.get("defaults") or {}
+    models = config.get("models") or []
+    if not models:
+        raise ValueError(f"No models configured in {path}")
+
+    base_engine_kwargs = {
+        **engine_kwargs_from_args(parse_cli_args({})),
+        **(defaults.get("engine_kwargs") or {}),
     }
-    configs = LLMConfig(**llm_config_dict)
+    base_autoscaling = {**AUTOSCALING_DEFAULTS, **(defaults.get("autoscaling") or {})}
+
+    llm_configs = []
+    for model in models:
+        llm_configs.append(build_llm_config(
+            model_id=model["model_id"],
+            model_source=model.get("model_source", model["model_id"]),
+            engine_kwargs={**base_engine_kwargs, **(model.get("engine_kwargs") or {})},
+            accelerator_type=model.get("accelerator_type", defaults.get("accelerator_type", "V100")),
+            autoscaling={**base_autoscaling, **(model.get("autoscaling") or {})},
+            hf_token=hf_token,
+        ))
+    return llm_configs
+
+
+# Related github issues: https://github.com/ray-project/ray/issues/51242
+def build_app(cli_args: Dict[str, str]) -> serve.Application:
+    args = parse_cli_args(cli_args)
+
+    load_dotenv('.serve.env')
+    HF_TOKEN = os.environ.get("HF_TOKEN")
+
+    if "config" in args:
+        # Multi-model deployment, see vllm.config.yaml
+        llm_configs = load_llm_configs(args["config"], HF_TOKEN)
+    else:
+        model_id = args.get("model", "meta-llama/Llama-3.1-8B-Instruct")
+        llm_configs = [build_llm_config(
+            model_id=model_id,
+            model_source="meta-llama/Llama-3.1-8B-Instruct",
+            engine_kwargs=engine_kwargs_from_args(args),
+            accelerator_type="V100",
+            autoscaling={"min_replicas": 1, "max_replicas": 1},
+            hf_token=HF_TOKEN,
+        )]
 
     # Approach - 1: LLMRouter can be used to manage multiple LLM deployments
     # bundles=[
@@ -80,6 +160,19 @@ def build_app(cli_args: Dict[str, str]) -> serve.Application:
     # app = LLMRouter.as_deployment().bind(llm_deployments=[deployment])
     
     # Approach - 2: manages the llmconfig and llmrouter
-    app = build_openai_app({"llm_configs": [configs]})
+    app = build_openai_app({"llm_configs": llm_configs})
     
     return app
+
+
+def build_cached_app(cli_args: Dict[str, str]) -> serve.Application:
+    """Response cache that sits in front of the app returned by `build_app`.
+
+    The LLM router has to be deployed as its own Serve application (see
+    serve.config.yaml) and is reached through `upstream_url`.
+    """
+    upstream_url = cli_args.get("upstream_url", "http://127.0.0.1:8000/llm")
+    max_bytes = int(float(cli_args.get("response_cache_max_mb", "512")) * 1024 * 1024)
+    ttl_s = float(cli_args.get("response_cache_ttl_s", "3600"))
+
+    return ResponseCacheProxy.bind(upstream_url, max_bytes, ttl_s)
@@ -12,16 +12,42 @@ cleanup() {
 trap cleanup SIGTERM
 
 # Run the serve command in the background
-serve run serve:build_app \
-  model="meta-llama/Llama-3.1-8B-Instruct" \
-  dtype=half \
-  gpu_memory_utilization=0.90 \
-  tensor_parallel_size=2 \
-  pipeline_parallel_size=1 \
-  max_model_len=2048 \
-  max_num_seqs=64 \
-  max_num_batched_tokens=8192 \
-  guided_decoding_backend="xgrammar" &
+# SERVE_MODELS_CONFIG (opt-in) points at a multi-model config like
+# examples/vllm-app/src/vllm.config.yaml; without it the single Llama deployment below is served.
+if [ "${RESPONSE_CACHE:-false}" = "true" ]; then
+  # LLM router + response cache proxy, see serve.config.yaml
+  SERVE_CONFIG=serve.config.yaml
+  if [ -n "${SERVE_MODELS_CONFIG:-}" ]; then
+    # Same applications, with the llm app built from the multi-model config
+    SERVE_CONFIG=/tmp/serve.models.config.yaml
+    python - "$SERVE_MODELS_CONFIG" > "$SERVE_CONFIG" <<'EOF'
+import sys
+import yaml
+
+with open("serve.config.yaml") as f:
+    config = yaml.safe_load(f)
+for app in config["applications"]:
+    if app["name"] == "llm":
+        app["args"] = {"config": sys.argv[1]}
+yaml.safe_dump(config, sys.stdout, sort_keys=False)
+EOF
+  fi
+  serve run "$SERVE_CONFIG" &
+elif [ -n "${SERVE_MODELS_CONFIG:-}" ]; then
+  # Multi-model autoscaled deployment
+  serve run serve:build_app config="$SERVE_MODELS_CONFIG" &
+else
+  serve run serve:build_app \
+    model="meta-llama/Llama-3.1-8B-Instruct" \
+    dtype=half \
+    gpu_memory_utilization=0.90 \
+    tensor_parallel_size=2 \
+    pipeline_parallel_size=1 \
+    max_model_len=2048 \
+    max_num_seqs=64 \
+    max_num_batched_tokens=8192 \
+    guided_decoding_backend="xgrammar" &
+fi
 
 # Wait for the background process to finish or for a signal
 wait $!
@@ -0,0 +1,282 @@
+"""Engine-parameter sweep for the defaults in `serve.parse_cli_args`.
+
+Deploys `build_app` once per engine config, runs a fixed workload from
+benchmark.py against it and writes a table ranked by throughput, marking the
+configs on the throughput vs p99 latency Pareto front.
+
+    # grid search on the cluster (run from this directory, with RAY_ADDRESS set)
+    python sweep.py --grid max_num_seqs=32,64,128 --grid max_num_batched_tokens=4096,8192
+
+    # successive halving against a stubbed engine, no GPU needed
+    python sweep.py --stub --search halving --output sweep_results
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import socket
+import threading
+import time
+from dataclasses import replace
+from typing import Dict, List
+
+from benchmark import WorkloadConfig, quiet_http_logs, run_benchmark
+from serve import parse_cli_args
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GRID = {
+    "max_num_seqs": ["32", "64", "128"],
+    "max_num_batched_tokens": ["4096", "8192", "16384"],
+    "gpu_memory_utilization": ["0.85", "0.90"],
+    "max_model_len": ["2048"],
+    "enable_chunked_prefill": ["false", "true"],
+}
+
+# Fixed workload so results are comparable between sweeps
+WORKLOAD = WorkloadConfig(
+    num_requests=256,
+    arrival="closed",
+    concurrency=64,
+    prompt_len="lognormal:384:0.7",
+    output_len="uniform:64:256",
+    seed=1234,
+)
+
+LATENCY_METRIC = "e2e_p99_ms"
+THROUGHPUT_METRIC = "output_tokens_per_s"
+
+
+# ================================================================== #
+# Deployments
+# ================================================================== #
+class ServeTarget:
+    """Deploys `serve.build_app` with the given engine args on the Ray cluster."""
+
+    app_name = "engine_sweep"
+
+    def __init__(self, route_prefix: str = "/sweep", http_url: str = "http://127.0.0.1:8000"):
+        self.route_prefix = route_prefix
+        self.base_url = f"{http_url}{route_prefix}/v1"
+
+    def start(self, cli_args: Dict[str, str]) -> str:
+        from ray import serve
+        from serve import build_app
+
+        serve.run(build_app(cli_args), name=self.app_name, route_prefix=self.route_prefix)
+        return self.base_url
+
+    def stop(self) -> None:
+        from ray import serve
+
+        serve.delete(self.app_name)
+
+
+class StubTarget:
+    """Runs mock_openai_server in-process with a latency profile derived from the engine args.
+
+    The profile is a crude model of vLLM: KV-cache capacity bounds the number of
+    concurrent sequences, the token budget sets prefill speed and chunked
+    prefill trades prefill speed for smoother decode.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.thread = None
+
+    @staticmethod
+    def profile(cli_args: Dict[str, str]):
+        from mock_openai_server import MockEngineProfile
+
+        max_num_seqs = int(cli_args["max_num_seqs"])
+        max_num_batched_tokens = int(cli_args["max_num_batched_tokens"])
+        kv_capacity_tokens = 200_000 * float(cli_args["gpu_memory_utilization"])
+        kv_seqs = max(1, int(kv_capacity_tokens // int(cli_args["max_model_len"])))
+        chunked = cli_args["enable_chunked_prefill"].lower() == "true"
+        return MockEngineProfile(
+            model=cli_args.get("model", MockEngineProfile.model),
+            max_num_seqs=min(max_num_seqs, kv_seqs),
+            prefill_per_token_ms=0.4 * 8192 / max_num_batched_tokens * (1.3 if chunked else 1.0),
+            itl_ms=1.0,
+            batch_slowdown=0.5 if chunked else 1.0,
+        )
+
+    def start(self, cli_args: Dict[str, str]) -> str:
+        import uvicorn
+        from mock_openai_server import build_mock_app
+
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        config = uvicorn.Config(build_mock_app(self.profile(cli_args)), host="127.0.0.1", port=port, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.05)
+        return f"http://127.0.0.1:{port}/v1"
+
+    def stop(self) -> None:
+        self.server.should_exit = True
+        self.thread.join()
+
+
+# ================================================================== #
+# Search
+# ================================================================== #
+def expand_grid(grid: Dict[str, List[str]]) -> List[Dict[str, str]]:
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+def evaluate(target, overrides: Dict[str, str], base_args: Dict[str, str], workload: WorkloadConfig) -> Dict:
+    """Benchmarks one config. A config that fails to deploy or to run (e.g. out of
+    memory at a high gpu_memory_utilization) is recorded as failed, the sweep goes on."""
+    cli_args = parse_cli_args({**base_args, **overrides})
+    logger.info(f"Evaluating {overrides} with {workload.num_requests} requests")
+    try:
+        base_url = target.start(cli_args)
+        try:
+            summary = asyncio.run(run_benchmark(replace(workload, base_url=base_url, model=cli_args.get("model", workload.model))))
+        finally:
+            target.stop()
+    except Exception as e:
+        logger.exception(f"{overrides} failed")
+        summary = {
+            "requests": workload.num_requests,
+            "failed": workload.num_requests,
+            "error": repr(e),
+            "request_throughput": math.nan,
+            THROUGHPUT_METRIC: math.nan,
+        }
+    # No latencies when every request failed
+    summary.setdefault(LATENCY_METRIC, math.nan)
+    logger.info(f"{overrides}: {summary[THROUGHPUT_METRIC]:.1f} tok/s, p99 {summary[LATENCY_METRIC]:.0f} ms")
+    return {"config": overrides, "num_requests": workload.num_requests, **summary}
+
+
+def throughput(result: Dict) -> float:
+    """Throughput for sorting, failed configs (NaN) lowest."""
+    value = result[THROUGHPUT_METRIC]
+    return -math.inf if math.isnan(value) else value
+
+
+def to_json(result: Dict) -> str:
+    """One strict JSON line; NaN (not measured, e.g. a failed config) becomes null."""
+    def clean(value):
+        if isinstance(value, float) and not math.isfinite(value):
+            return None
+        if isinstance(value, dict):
+            return {k: clean(v) for k, v in value.items()}
+        return value
+
+    return json.dumps(clean(result), allow_nan=False)
+
+
+def grid_search(target, configs, base_args, workload) -> List[Dict]:
+    return [evaluate(target, overrides, base_args, workload) for overrides in configs]
+
+
+def successive_halving(target, configs, base_args, workload, eta: int = 2, min_requests: int = 32) -> List[Dict]:
+    """Evaluates every config on a small budget and re-runs the best 1/eta with eta times more requests."""
+    rounds = max(1, math.ceil(math.log(len(configs), eta)))
+    budget = min(workload.num_requests, max(min_requests, workload.num_requests // eta ** (rounds - 1)))
+    survivors = configs
+    results = []
+    while True:
+        rung = [evaluate(target, overrides, base_args, replace(workload, num_requests=budget)) for overrides in survivors]
+        results = rung + [r for r in results if r["config"] not in survivors]
+        if len(survivors) == 1 or budget == workload.num_requests:
+            return results
+        rung.sort(key=throughput, reverse=True)
+        # Failed requests make a config ineligible regardless of throughput
+        rung.sort(key=lambda r: r["failed"] > 0)
+        survivors = [r["config"] for r in rung[:max(1, len(rung) // eta)]]
+        budget = min(budget * eta, workload.num_requests)
+
+
+# ================================================================== #
+# Reporting
+# ================================================================== #
+def rank(results: List[Dict]) -> List[Dict]:
+    """Sorts by throughput, configs where every request failed last, and flags
+    configs no other config beats on both throughput and p99."""
+    # Only configs that saw the full budget are comparable
+    full = max(r["num_requests"] for r in results)
+    for r in results:
+        r["pareto"] = r["num_requests"] == full and r["failed"] == 0 and not any(
+            o is not r
+            and o["num_requests"] == full
+            and o["failed"] == 0
+            and o[THROUGHPUT_METRIC] >= r[THROUGHPUT_METRIC]
+            and o[LATENCY_METRIC] <= r[LATENCY_METRIC]
+            and (o[THROUGHPUT_METRIC] > r[THROUGHPUT_METRIC] or o[LATENCY_METRIC] < r[LATENCY_METRIC])
+            for o in results
+        )
+    return sorted(
+        results, key=lambda r: (r["failed"] < r["num_requests"], r["num_requests"], throughput(r)), reverse=True
+    )
+
+
+def format_table(ranked: List[Dict]) -> str:
+    keys = list(ranked[0]["config"])
+    header = ["rank", *keys, "requests", "failed", "tok/s", "req/s", "ttft p99 ms", "e2e p99 ms", "pareto"]
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    for i, r in enumerate(ranked, 1):
+        row = [
+            str(i),
+            *(r["config"][k] for k in keys),
+            str(r["num_requests"]),
+            str(r["failed"]),
+            f"{r[THROUGHPUT_METRIC]:.1f}",
+            f"{r['request_throughput']:.2f}",
+            f"{r.get('ttft_p99_ms', float('nan')):.0f}",
+            f"{r[LATENCY_METRIC]:.0f}",
+            "*" if r["pareto"] else "",
+        ]
+        lines.append("| " + " | ".join(row) + " |")
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser("Engine parameter sweep")
+    parser.add_argument("--model", default="meta-llama/Llama-3.1-8B-Instruct")
+    parser.add_argument("--grid", action="append", default=[], help="key=v1,v2,... (repeatable, replaces the default grid)")
+    parser.add_argument("--search", choices=["grid", "halving"], default="grid")
+    parser.add_argument("--eta", type=int, default=2, help="Halving rate for successive halving")
+    parser.add_argument("--num-requests", type=int, default=WORKLOAD.num_requests)
+    parser.add_argument("--stub", action="store_true", help="Benchmark a mock engine instead of deploying vLLM")
+    parser.add_argument("--output", default="sweep_results", help="Writes <output>.md and <output>.jsonl")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    quiet_http_logs()
+    args = parse_args()
+
+    grid = dict(DEFAULT_GRID)
+    if args.grid:
+        grid = {key: values.split(",") for key, values in (g.split("=", 1) for g in args.grid)}
+    configs = expand_grid(grid)
+    base_args = {"model": args.model}
+    workload = replace(WORKLOAD, num_requests=args.num_requests)
+    target = StubTarget() if args.stub else ServeTarget()
+
+    logger.info(f"Sweeping {len(configs)} configs ({args.search}) for {args.model}")
+    if args.search == "halving":
+        results = successive_halving(target, configs, base_args, workload, eta=args.eta)
+    else:
+        results = grid_search(target, configs, base_args, workload)
+
+    ranked = rank(results)
+    table = format_table(ranked)
+    print(table)
+    with open(f"{args.output}.md", "w") as f:
+        f.write(f"# Engine sweep: {args.model}\n\n{table}\n")
+    with open(f"{args.output}.jsonl", "w") as f:
+        for r in ranked:
+            f.write(to_json(r) + "\n")
+    logger.info(f"Results written to {args.output}.md and {args.output}.jsonl")
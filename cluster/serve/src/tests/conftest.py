@@ -0,0 +1,31 @@
+import os
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..")
+# The scripts import each other by name, as when run from this directory
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(scope="module")
+def mock_server():
+    """mock_openai_server on a free port, yields its /v1 base URL."""
+    import uvicorn
+    from mock_openai_server import MockEngineProfile, build_mock_app
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    profile = MockEngineProfile(prefill_base_ms=1, prefill_per_token_ms=0, itl_ms=1)
+    server = uvicorn.Server(uvicorn.Config(build_mock_app(profile), host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}/v1"
+    server.should_exit = True
+    thread.join()
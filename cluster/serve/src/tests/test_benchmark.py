@@ -0,0 +1,54 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from openai import AsyncOpenAI
+
+from benchmark import WorkloadConfig, send_request
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+
+def test_token_counts_come_from_usage(mock_server):
+    config = WorkloadConfig(base_url=mock_server)
+
+    async def run():
+        client = AsyncOpenAI(base_url=mock_server, api_key="-", max_retries=0)
+        try:
+            return await send_request(client, config, "one two three four five", max_tokens=7)
+        finally:
+            await client.close()
+
+    result = asyncio.run(run())
+    assert result.error is None
+    # The mock counts whitespace-separated words as prompt tokens
+    assert result.prompt_tokens == 5
+    assert result.output_tokens == 7
+    assert result.ttft_s is not None and len(result.itl_s) == 6
+
+
+def test_cli_against_mock_server(mock_server, tmp_path):
+    output = tmp_path / "benchmark.jsonl"
+    result = subprocess.run(
+        [
+            sys.executable, "benchmark.py",
+            "--base-url", mock_server,
+            "--num-requests", "8",
+            "--prompt-len", "fixed:10",
+            "--output-len", "fixed:4",
+            "--output", str(output),
+        ],
+        cwd=SRC_DIR, capture_output=True, text=True, timeout=300,
+    )
+    assert result.returncode == 0, result.stderr
+    # The HTTP client's per-request INFO lines are silenced
+    assert "HTTP Request" not in result.stderr
+
+    summary = json.loads(output.read_text())["summary"]
+    assert summary["failed"] == 0
+    prompt_tokens = (summary["total_tokens_per_s"] - summary["output_tokens_per_s"]) * summary["duration_s"]
+    assert prompt_tokens == pytest.approx(8 * 10)
+    assert summary["output_tokens_per_s"] * summary["duration_s"] == pytest.approx(8 * 4)
@@ -0,0 +1,384 @@
+"""Data pipeline for the LIMA fine-tuning in tune_lima.py.
+
+Examples are tokenized without padding and keep their own length. Batches
+are then either
+
+- padded only to their longest example (PaddingCollator), with
+  `group_by_length` putting examples of similar length in the same batch, or
+- packed: examples are binned first-fit-decreasing into rows of at most
+  `max_length` tokens (pack_examples) and every batch is flattened into one
+  row without any padding (FlatteningCollator). position_ids restart at
+  each example, from which transformers builds a block-diagonal causal mask,
+  so packed examples never attend to each other.
+
+Both collators count real and padded tokens; PaddingRatioCallback adds the
+ratio to the trainer logs.
+
+prepare_datasets runs the whole preprocessing as batched multi-process
+`datasets.map` stages and saves the result under a fingerprint of
+everything it depends on, so later runs load the Arrow files directly.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from datasets import Dataset, DatasetDict, load_dataset, load_from_disk
+from transformers import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+IGNORE_INDEX = -100
+
+DATASET_NAME = "GAIR/lima"
+# Bump when the preprocessing below changes, to invalidate cached datasets
+PREPROCESSING_VERSION = 1
+TEST_SIZE = 0.2
+SPLIT_SEED = 42
+
+SYSTEM_MESSAGE = """You are a helpful AI assistant. Users will ask you questions and you will answer the questions."""
+
+# Llama 3.1 instruct chat template
+LLAMA3_CHAT_TEMPLATE = "{{- bos_token }}\n{%- if custom_tools is defined %}\n    {%- set tools = custom_tools %}\n{%- endif %}\n{%- if not tools_in_user_message is defined %}\n    {%- set tools_in_user_message = true %}\n{%- endif %}\n{%- if not date_string is defined %}\n    {%- set date_string = \"26 Jul 2024\" %}\n{%- endif %}\n{%- if not tools is defined %}\n    {%- set tools = none %}\n{%- endif %}\n\n{#- This block extracts the system message, so we can slot it into the right place. #}\n{%- if messages[0]['role'] == 'system' %}\n    {%- set system_message = messages[0]['content']|trim %}\n    {%- set messages = messages[1:] %}\n{%- else %}\n    {%- set system_message = \"\" %}\n{%- endif %}\n\n{#- System message + builtin tools #}\n{{- \"<|start_header_id|>system<|end_header_id|>\\n\\n\" }}\n{%- if builtin_tools is defined or tools is not none %}\n    {{- \"Environment: ipython\\n\" }}\n{%- endif %}\n{%- if builtin_tools is defined %}\n    {{- \"Tools: \" + builtin_tools | reject('equalto', 'code_interpreter') | join(\", \") + \"\\n\\n\"}}\n{%- endif %}\n{{- \"Cutting Knowledge Date: December 2023\\n\" }}\n{{- \"Today Date: \" + date_string + \"\\n\\n\" }}\n{%- if tools is not none and not tools_in_user_message %}\n    {{- \"You have access to the following functions. To call a function, please respond with JSON for a function call.\" }}\n    {{- 'Respond in the format {\"name\": function name, \"parameters\": dictionary of argument name and its value}.' }}\n    {{- \"Do not use variables.\\n\\n\" }}\n    {%- for t in tools %}\n        {{- t | tojson(indent=4) }}\n        {{- \"\\n\\n\" }}\n    {%- endfor %}\n{%- endif %}\n{{- system_message }}\n{{- \"<|eot_id|>\" }}\n\n{#- Custom tools are passed in a user message with some extra guidance #}\n{%- if tools_in_user_message and not tools is none %}\n    {#- Extract the first user message so we can plug it in here #}\n    {%- if messages | length != 0 %}\n        {%- set first_user_message = messages[0]['content']|trim %}\n        {%- set messages = messages[1:] %}\n    {%- else %}\n        {{- raise_exception(\"Cannot put tools in the first user message when there's no first user message!\") }}\n{%- endif %}\n    {{- '<|start_header_id|>user<|end_header_id|>\\n\\n' -}}\n    {{- \"Given the following functions, please respond with a JSON for a function call \" }}\n    {{- \"with its proper arguments that best answers the given prompt.\\n\\n\" }}\n    {{- 'Respond in the format {\"name\": function name, \"parameters\": dictionary of argument name and its value}.' }}\n    {{- \"Do not use variables.\\n\\n\" }}\n    {%- for t in tools %}\n        {{- t | tojson(indent=4) }}\n        {{- \"\\n\\n\" }}\n    {%- endfor %}\n    {{- first_user_message + \"<|eot_id|>\"}}\n{%- endif %}\n\n{%- for message in messages %}\n    {%- if not (message.role == 'ipython' or message.role == 'tool' or 'tool_calls' in message) %}\n        {{- '<|start_header_id|>' + message['role'] + '<|end_header_id|>\\n\\n'+ message['content'] | trim + '<|eot_id|>' }}\n    {%- elif 'tool_calls' in message %}\n        {%- if not message.tool_calls|length == 1 %}\n            {{- raise_exception(\"This model only supports single tool-calls at once!\") }}\n        {%- endif %}\n        {%- set tool_call = message.tool_calls[0].function %}\n        {%- if builtin_tools is defined and tool_call.name in builtin_tools %}\n            {{- '<|start_header_id|>assistant<|end_header_id|>\\n\\n' -}}\n            {{- \"<|python_tag|>\" + tool_call.name + \".call(\" }}\n            {%- for arg_name, arg_val in tool_call.arguments | items %}\n                {{- arg_name + '=\"' + arg_val + '\"' }}\n                {%- if not loop.last %}\n                    {{- \", \" }}\n                {%- endif %}\n                {%- endfor %}\n            {{- \")\" }}\n        {%- else  %}\n            {{- '<|start_header_id|>assistant<|end_header_id|>\\n\\n' -}}\n            {{- '{\"name\": \"' + tool_call.name + '\", ' }}\n            {{- '\"parameters\": ' }}\n            {{- tool_call.arguments | tojson }}\n            {{- \"}\" }}\n        {%- endif %}\n        {%- if builtin_tools is defined %}\n            {#- This means we're in ipython mode #}\n            {{- \"<|eom_id|>\" }}\n        {%- else %}\n            {{- \"<|eot_id|>\" }}\n        {%- endif %}\n    {%- elif message.role == \"tool\" or message.role == \"ipython\" %}\n        {{- \"<|start_header_id|>ipython<|end_header_id|>\\n\\n\" }}\n        {%- if message.content is mapping or message.content is iterable %}\n            {{- message.content | tojson }}\n        {%- else %}\n            {{- message.content }}\n        {%- endif %}\n        {{- \"<|eot_id|>\" }}\n    {%- endif %}\n{%- endfor %}\n{%- if add_generation_prompt %}\n    {{- '<|start_header_id|>assistant<|end_header_id|>\\n\\n' }}\n{%- endif %}\n"
+
+
+# ================================================================== #
+# Conversations
+# ================================================================== #
+def create_conversation(sample):
+  messages = [{"role": "system", "content": SYSTEM_MESSAGE.format(schema=sample["source"])}]
+  conversation = sample["conversations"]
+  for i, message in enumerate(conversation):
+    if i % 2 == 0:
+      messages.append({"role": "user", "content": message})
+    else:
+      messages.append({"role": "assistant", "content": message})
+  return { "messages": messages }
+
+
+# Customized chat template to pass to the tokenizer
+# However, We use the llama 3 instruct chat template
+def format_messages(sample):
+    text = ""
+    for message in sample["messages"]:
+        if message["role"] == "system":
+            text += f"<|system|>{message['content']}\n"
+        elif message["role"] == "user":
+            text += f"<|user|>{message['content']}\n"
+        elif message["role"] == "assistant":
+            text += f"<|assistant|>{message['content']}\n"
+    return {"text": text}
+
+
+def tokenize(batch: Dict[str, List[Any]], tokenizer, max_length: int) -> Dict[str, List[Any]]:
+    """
+    Batched `datasets.map` function: renders the conversations with the
+    Llama chat template and tokenizes them without padding, truncated to
+    `max_length`.
+    """
+    texts = tokenizer.apply_chat_template(
+        batch["messages"],
+        tokenize=False,
+        add_generation_prompt=True,
+        bos_token="<|begin_of_text|>",
+        chat_template=LLAMA3_CHAT_TEMPLATE,
+        clean_up_tokenization_spaces=True,
+        eos_token="<|eot_id|>",
+    )
+    # The template already starts with the BOS token
+    input_ids = tokenizer(texts, add_special_tokens=False, truncation=True, max_length=max_length)["input_ids"]
+    return {"input_ids": input_ids, "length": [len(ids) for ids in input_ids]}
+
+
+def preprocess(batch: Dict[str, List[Any]], tokenizer, max_length: int) -> Dict[str, List[Any]]:
+    """Batched `datasets.map` function from raw LIMA rows to tokenized conversations."""
+    samples = [dict(zip(batch, values)) for values in zip(*batch.values())]
+    messages = [create_conversation(sample)["messages"] for sample in samples]
+    return tokenize({"messages": messages}, tokenizer, max_length)
+
+
+# ================================================================== #
+# Packing
+# ================================================================== #
+def pack_examples(batch: Dict[str, List[Any]], max_length: int) -> Dict[str, List[Any]]:
+    """
+    Batched `datasets.map` function: bins the batch's examples first-fit-
+    decreasing into rows of at most `max_length` tokens. position_ids
+    restart at 0 for every example, marking the boundaries.
+    """
+    order = sorted(range(len(batch["input_ids"])), key=lambda i: -len(batch["input_ids"][i]))
+    bins: List[List[int]] = []
+    free: List[int] = []
+    for i in order:
+        size = len(batch["input_ids"][i])
+        for b, space in enumerate(free):
+            if size <= space:
+                bins[b].append(i)
+                free[b] -= size
+                break
+        else:
+            bins.append([i])
+            free.append(max_length - size)
+
+    packed = {"input_ids": [], "position_ids": [], "length": []}
+    for examples in bins:
+        input_ids, position_ids = [], []
+        for i in examples:
+            input_ids += batch["input_ids"][i]
+            position_ids += range(len(batch["input_ids"][i]))
+        packed["input_ids"].append(input_ids)
+        packed["position_ids"].append(position_ids)
+        packed["length"].append(len(input_ids))
+    return packed
+
+
+def length_grouped_order(
+    lengths: Sequence[int],
+    batch_size: int,
+    epoch: int = 0,
+    seed: int = SPLIT_SEED,
+    mega_batch_mult: int = 50,
+) -> List[int]:
+    """
+    Shuffled order in which consecutive runs of `batch_size` examples have
+    similar lengths: like transformers' LengthGroupedSampler, for pipelines
+    that keep the dataset order (Ray Data shards) instead of sampling. Every
+    `epoch` gets a different shuffle.
+    """
+    order = np.random.default_rng([seed, epoch]).permutation(len(lengths))
+    mega_batch = batch_size * mega_batch_mult
+    grouped = []
+    for start in range(0, len(order), mega_batch):
+        grouped += sorted(order[start:start + mega_batch].tolist(), key=lambda i: -lengths[i])
+    return grouped
+
+
+# ================================================================== #
+# Cached preprocessing
+# ================================================================== #
+def tokenizer_fingerprint(tokenizer) -> str:
+    """Hash of the vocabulary, special tokens and truncation settings the tokenized ids depend on."""
+    state = {
+        "name": tokenizer.name_or_path,
+        "class": type(tokenizer).__name__,
+        "vocab": sorted(tokenizer.get_vocab().items()),
+        "special_tokens": tokenizer.special_tokens_map,
+        "truncation_side": tokenizer.truncation_side,
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def preprocessing_fingerprint(
+    raw: Dataset,
+    tokenizer,
+    max_length: int,
+    packing: bool,
+    revision: Optional[str] = None,
+) -> str:
+    state = {
+        "version": PREPROCESSING_VERSION,
+        "dataset": DATASET_NAME,
+        "revision": revision,
+        # Derived from the downloaded files, so it changes with the data even on the default revision
+        "dataset_fingerprint": raw._fingerprint,
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "system_message": SYSTEM_MESSAGE,
+        "chat_template": LLAMA3_CHAT_TEMPLATE,
+        "max_length": max_length,
+        "packing": packing,
+        "split": [TEST_SIZE, SPLIT_SEED],
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def prepare_datasets(
+    tokenizer,
+    max_length: int,
+    packing: bool = False,
+    cache_dir: str = "~/storage/hf-datasets/lima-preprocessed",
+    num_proc: Optional[int] = None,
+    revision: Optional[str] = None,
+    raw_cache_dir: str = "~/storage/hf-datasets",
+) -> Tuple[Dataset, Dataset]:
+    """
+    (train, test) tokenized, and packed if `packing`. The first run with a
+    given dataset revision, tokenizer, template, max length and packing
+    mode maps the data over `num_proc` processes and saves it under
+    `cache_dir/<fingerprint>`; every later run only memory-maps it.
+    """
+    raw = load_dataset(DATASET_NAME, cache_dir=os.path.expanduser(raw_cache_dir), revision=revision, split="train")
+    fingerprint = preprocessing_fingerprint(raw, tokenizer, max_length, packing, revision)
+    path = os.path.join(os.path.expanduser(cache_dir), fingerprint)
+    if os.path.exists(path):
+        logger.info(f"Loading preprocessed datasets from {path}")
+        splits = load_from_disk(path)
+        return splits["train"], splits["test"]
+
+    num_proc = num_proc or os.cpu_count()
+    # The tokenizer's own thread pool would deadlock in forked map workers
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    dataset = raw.map(
+        preprocess,
+        batched=True,
+        batch_size=256,
+        num_proc=num_proc,
+        fn_kwargs={"tokenizer": tokenizer, "max_length": max_length},
+        remove_columns=raw.column_names,
+        desc="Tokenizing",
+    )
+    splits = dataset.train_test_split(test_size=TEST_SIZE, seed=SPLIT_SEED)
+    if packing:
+        # Packed within chunks of 1000 conversations, position_ids mark where each one starts
+        splits = DatasetDict({
+            name: split.map(
+                pack_examples,
+                batched=True,
+                batch_size=1000,
+                num_proc=min(num_proc, max(1, len(split) // 1000)),
+                fn_kwargs={"max_length": max_length},
+                remove_columns=split.column_names,
+                desc=f"Packing {name}",
+            )
+            for name, split in splits.items()
+        })
+
+    # Saved under a temporary name first, so an interrupted run never leaves a partial cache entry
+    shutil.rmtree(f"{path}.tmp", ignore_errors=True)
+    splits.save_to_disk(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+    logger.info(f"Saved preprocessed datasets to {path}")
+    # Reloaded so both splits are memory-mapped from the cache like on later runs
+    splits = load_from_disk(path)
+    return splits["train"], splits["test"]
+
+
+# ================================================================== #
+# Collators
+# ================================================================== #
+class _TokenCounter:
+    def __init__(self):
+        # Totals since creation, for readers that must not interfere with reset()
+        self.total_real_tokens = 0
+        self.total_padded_tokens = 0
+        self.reset()
+
+    def reset(self) -> None:
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def count(self, real: int, padded: int) -> None:
+        self.real_tokens += real
+        self.padded_tokens += padded
+        self.total_real_tokens += real
+        self.total_padded_tokens += padded
+
+    @property
+    def padding_ratio(self) -> float:
+        """Share of the tokens the model processed that were padding."""
+        total = self.real_tokens + self.padded_tokens
+        return self.padded_tokens / total if total else 0.0
+
+
+class PaddingCollator(_TokenCounter):
+    """Pads a batch to its longest example, rounded up to `pad_to_multiple_of`."""
+
+    def __init__(self, pad_token_id: int, pad_to_multiple_of: Optional[int] = 8):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        super().__init__()
+
+    def __call__(self, features: Sequence[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        lengths = [len(f["input_ids"]) for f in features]
+        width = max(lengths)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        input_ids = torch.full((len(features), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(features), width), dtype=torch.long)
+        for row, (feature, length) in enumerate(zip(features, lengths)):
+            input_ids[row, :length] = torch.as_tensor(feature["input_ids"])
+            attention_mask[row, :length] = 1
+        labels = input_ids.masked_fill(attention_mask == 0, IGNORE_INDEX)
+
+        self.count(sum(lengths), input_ids.numel() - sum(lengths))
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+class FlatteningCollator(_TokenCounter):
+    """
+    Concatenates the whole batch into a single row with no padding and no
+    attention_mask. position_ids restart at each example (or continue those
+    of packed rows), and the first label of every example is ignored so no
+    example is trained to predict the next one.
+
+    transformers (>=4.53) only derives the per-example attention from
+    position_ids when no KV cache is passed, so the model needs
+    `config.use_cache = False` (otherwise evaluation attends across examples).
+    """
+
+    def __call__(self, features: Sequence[Dict[str, Any]]) -> Dict[str, torch.Tensor]:
+        input_ids, position_ids = [], []
+        for feature in features:
+            input_ids += feature["input_ids"]
+            position_ids += feature.get("position_ids") or range(len(feature["input_ids"]))
+
+        input_ids = torch.as_tensor([input_ids], dtype=torch.long)
+        position_ids = torch.as_tensor([position_ids], dtype=torch.long)
+        labels = input_ids.masked_fill(position_ids == 0, IGNORE_INDEX)
+
+        self.count(input_ids.numel(), 0)
+        return {"input_ids": input_ids, "position_ids": position_ids, "labels": labels}
+
+
+class PaddingRatioCallback(TrainerCallback):
+    """
+    Adds the padding ratio of the training batches since the last training
+    log to the trainer logs, from the collator's token totals. Batches
+    collated for evaluation are left out. The totals live in the process
+    that collates, so this needs `dataloader_num_workers=0`.
+    """
+
+    def __init__(self, collator: _TokenCounter):
+        self.collator = collator
+        self.window = _TokenCounter()
+        self._seen = (0, 0)
+
+    def _totals(self) -> Tuple[int, int]:
+        return self.collator.total_real_tokens, self.collator.total_padded_tokens
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        self._seen = self._totals()
+
+    def on_step_end(self, args, state, control, **kwargs):
+        real, padded = self._totals()
+        self.window.count(real - self._seen[0], padded - self._seen[1])
+        self._seen = (real, padded)
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._seen = self._totals()
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        # Evaluation logs carry eval_loss but no loss and are not a training window
+        if logs is not None and "loss" in logs:
+            logs["padding_ratio"] = round(self.window.padding_ratio, 4)
+            logs["real_tokens"] = self.window.real_tokens
+            self.window.reset()
+
+
+def estimate_padding_ratio(lengths: Sequence[int], batch_size: int, pad_to: Optional[int] = None) -> float:
+    """
+    Padding ratio of batching `lengths` in order, each batch padded to its
+    longest example, or to `pad_to` for every batch (pad-to-longest over
+    the whole dataset, as the script did before).
+    """
+    real = padded = 0
+    for start in range(0, len(lengths), batch_size):
+        batch = lengths[start:start + batch_size]
+        width = pad_to or max(batch)
+        real += sum(batch)
+        padded += width * len(batch) - sum(batch)
+    return padded / (real + padded) if real + padded else 0.0
@@ -0,0 +1,162 @@
+"""LoRA hyperparameter search for train_lima_ray.py with Ray Tune.
+
+Samples LoRA rank, alpha, dropout, target modules and learning rate, and
+runs the trials concurrently as far as the cluster's GPUs allow. Every
+trial is the same TorchTrainer as a regular run, reporting eval_loss every
+--eval-steps; ASHA (asynchronous successive halving) stops the worse
+trials at each rung so the budget goes to the promising ones. The dataset
+is preprocessed once (cached by lima_data) and placed in the object store
+once, all trials read the same blocks.
+
+Writes the trial table (trials.csv) and the best config (best_config.json)
+to --output.
+
+    # on the cluster (run from this directory, with RAY_ADDRESS set)
+    python search_lima_lora.py --num-samples 16 --packing
+
+    # CPU-only, end to end with a tiny model
+    python search_lima_lora.py --cpu --model-name hf-internal-testing/tiny-random-LlamaForCausalLM \\
+        --num-samples 4 --max-examples 64 --max-seq-length 256 --max-steps 8 --eval-steps 2
+"""
+import argparse
+import json
+import logging
+import math
+import os
+
+import ray
+from ray import tune
+from ray.train import CheckpointConfig, RunConfig
+from ray.tune.schedulers import ASHAScheduler
+
+from lima_data import prepare_datasets
+from train_lima_ray import DEFAULT_CONFIG, build_trainer, load_tokenizer, steps_per_epoch
+
+logger = logging.getLogger(__name__)
+
+ATTENTION = ["q_proj", "k_proj", "v_proj", "o_proj"]
+MLP = ["gate_proj", "up_proj", "down_proj"]
+
+SEARCH_SPACE = {
+    "lora_r": tune.choice([4, 8, 16, 32]),
+    "lora_alpha": tune.choice([16, 32, 64]),
+    "lora_dropout": tune.choice([0.0, 0.05, 0.1]),
+    "target_modules": tune.choice([["q_proj", "v_proj"], ATTENTION, ATTENTION + MLP]),
+    "learning_rate": tune.loguniform(5e-5, 5e-4),
+}
+
+# Trial table columns, in order
+COLUMNS = ["trial_id", "training_iteration", "eval_loss", "loss"] + [
+    f"config/train_loop_config/{name}" for name in SEARCH_SPACE
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser("LIMA LoRA hyperparameter search")
+    parser.add_argument("--model-name", default=DEFAULT_CONFIG["model_name"])
+    parser.add_argument("--num-samples", type=int, default=16, help="Trials to sample")
+    parser.add_argument("--max-concurrent", type=int, help="Default as many as the resources allow")
+    parser.add_argument("--workers-per-trial", type=int, default=1)
+    parser.add_argument("--cpu", action="store_true", help="CPU workers with the gloo backend")
+    parser.add_argument("--max-seq-length", type=int, default=2048)
+    parser.add_argument("--packing", action="store_true")
+    parser.add_argument("--batch-size", type=int, help="Rows per worker and step, default 1 packed and 4 padded")
+    parser.add_argument("--gradient-accumulation-steps", type=int, default=DEFAULT_CONFIG["gradient_accumulation_steps"])
+    parser.add_argument("--max-steps", type=int, help="Steps of a trial that is never stopped, default one epoch")
+    parser.add_argument("--eval-steps", type=int, default=DEFAULT_CONFIG["eval_steps"], help="Steps between ASHA decisions")
+    parser.add_argument("--grace-period", type=int, default=2, help="Evaluations before a trial can be stopped")
+    parser.add_argument("--reduction-factor", type=int, default=3)
+    parser.add_argument("--max-examples", type=int, help="Search on a subset, for smoke tests")
+    parser.add_argument("--dataset-revision")
+    parser.add_argument("--cache-dir", default="~/storage/hf-datasets/lima-preprocessed")
+    parser.add_argument("--num-proc", type=int)
+    parser.add_argument("--storage-path", help="Ray Tune results, default ~/ray_results")
+    parser.add_argument("--output", default="./output/search")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    batch_size = args.batch_size or (1 if args.packing else 4)
+
+    # Ships lima_data.py and train_lima_ray.py to the workers
+    ray.init(runtime_env={
+        "working_dir": os.path.dirname(os.path.abspath(__file__)),
+        "excludes": ["output/", "*.ipynb"],
+        "pip": ["peft", "datasets", "bitsandbytes"],
+    })
+
+    tokenizer = load_tokenizer(args.model_name)
+    train_dataset, eval_dataset = prepare_datasets(
+        tokenizer,
+        args.max_seq_length,
+        packing=args.packing,
+        cache_dir=args.cache_dir,
+        num_proc=args.num_proc,
+        revision=args.dataset_revision,
+    )
+    if args.max_examples:
+        train_dataset = train_dataset.select(range(min(args.max_examples, len(train_dataset))))
+        eval_dataset = eval_dataset.select(range(min(args.max_examples, len(eval_dataset))))
+
+    max_steps = args.max_steps or steps_per_epoch(
+        len(train_dataset), batch_size, args.workers_per_trial, args.gradient_accumulation_steps
+    )
+    # One report (and ASHA decision) per evaluation
+    max_reports = max(1, math.ceil(max_steps / args.eval_steps))
+
+    # Search values are merged into this config for every trial
+    trainer = build_trainer(
+        {
+            "model_name": args.model_name,
+            "packing": args.packing,
+            "batch_size": batch_size,
+            "gradient_accumulation_steps": args.gradient_accumulation_steps,
+            "max_steps": max_steps,
+            "eval_steps": args.eval_steps,
+            "output_dir": os.path.abspath(args.output),
+        },
+        num_workers=args.workers_per_trial,
+        use_gpu=not args.cpu,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+    )
+    tuner = tune.Tuner(
+        trainer,
+        param_space={"train_loop_config": SEARCH_SPACE},
+        tune_config=tune.TuneConfig(
+            metric="eval_loss",
+            mode="min",
+            num_samples=args.num_samples,
+            max_concurrent_trials=args.max_concurrent,
+            scheduler=ASHAScheduler(
+                time_attr="training_iteration",
+                max_t=max_reports,
+                grace_period=min(args.grace_period, max_reports),
+                reduction_factor=args.reduction_factor,
+            ),
+        ),
+        run_config=RunConfig(
+            name="lima_lora_search",
+            storage_path=args.storage_path,
+            # Only the last checkpoint of each trial is kept, the best one is retrained anyway
+            checkpoint_config=CheckpointConfig(num_to_keep=1),
+        ),
+    )
+    logger.info(f"Searching {args.num_samples} trials of up to {max_steps} steps ({max_reports} evaluations)")
+    results = tuner.fit()
+
+    os.makedirs(args.output, exist_ok=True)
+    trials = results.get_dataframe(filter_metric="eval_loss", filter_mode="min")
+    trials = trials[[column for column in COLUMNS if column in trials.columns]].sort_values("eval_loss")
+    trials.columns = [column.removeprefix("config/train_loop_config/") for column in trials.columns]
+    trials.to_csv(os.path.join(args.output, "trials.csv"), index=False)
+    print(trials.to_string(index=False))
+
+    best = results.get_best_result()
+    best_config = {name: best.config["train_loop_config"][name] for name in SEARCH_SPACE}
+    with open(os.path.join(args.output, "best_config.json"), "w") as f:
+        json.dump({"eval_loss": best.metrics.get("eval_loss"), **best_config}, f, indent=2)
+    logger.info(f"Best eval_loss {best.metrics.get('eval_loss')}: {best_config}")
+    logger.info(f"Trial table and best config written to {args.output}")
@@ -0,0 +1,17 @@
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "slow: end-to-end runs of the training scripts, minutes each (run with -m slow)"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    # Opt-in: they start Ray and need the Hugging Face hub for the model and GAIR/lima
+    if "slow" in (config.getoption("markexpr") or ""):
+        return
+    skip = pytest.mark.skip(reason="slow, run with -m slow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,71 @@
+"""CPU-only end-to-end runs of the training scripts with a tiny random Llama."""
+import csv
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+TUNE_DIR = os.path.join(os.path.dirname(__file__), "..")
+TINY_MODEL = "hf-internal-testing/tiny-random-LlamaForCausalLM"
+TIMEOUT_S = 1800
+
+
+def run_script(script, *args, tmp_path):
+    env = dict(os.environ)
+    # A local Ray instance, not the cluster
+    env.pop("RAY_ADDRESS", None)
+    command = [
+        sys.executable, script,
+        "--cpu",
+        "--model-name", TINY_MODEL,
+        "--max-examples", "32",
+        "--max-seq-length", "256",
+        "--max-steps", "4",
+        "--eval-steps", "2",
+        "--cache-dir", str(tmp_path / "datasets"),
+        "--storage-path", str(tmp_path / "ray_results"),
+        *args,
+    ]
+    result = subprocess.run(command, cwd=TUNE_DIR, env=env, capture_output=True, text=True, timeout=TIMEOUT_S)
+    assert result.returncode == 0, result.stdout[-5000:] + result.stderr[-5000:]
+    return result
+
+
+@pytest.mark.slow
+def test_search_cpu(tmp_path):
+    output = tmp_path / "search"
+    run_script("search_lima_lora.py", "--num-samples", "2", "--output", str(output), tmp_path=tmp_path)
+
+    with open(output / "trials.csv") as f:
+        trials = list(csv.DictReader(f))
+    assert len(trials) == 2
+    assert all(float(trial["eval_loss"]) > 0 for trial in trials)
+
+    with open(output / "best_config.json") as f:
+        best = json.load(f)
+    assert best["eval_loss"] == min(float(trial["eval_loss"]) for trial in trials)
+    assert {"lora_r", "lora_alpha", "lora_dropout", "target_modules", "learning_rate"} <= set(best)
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize("packing", [False, True])
+def test_train_gloo(tmp_path, packing):
+    output = tmp_path / "output"
+    run_script(
+        "train_lima_ray.py",
+        "--num-workers", "2",
+        "--logging-steps", "1",
+        "--output-dir", str(output),
+        *(["--packing"] if packing else []),
+        tmp_path=tmp_path,
+    )
+
+    # Both gloo workers trained and logged throughput windows (metrics/<trial>/rank_<n>)
+    for rank in ("rank_0", "rank_1"):
+        [path] = (output / "metrics").glob(f"*/{rank}/throughput.jsonl")
+        with open(path) as f:
+            windows = [json.loads(line) for line in f]
+        assert windows and windows[-1]["global_step"] == 4
+    assert list((tmp_path / "ray_results" / "lima_lora").glob("*/checkpoint_*"))
@@ -0,0 +1,277 @@
+"""Training throughput instrumentation for the LIMA fine-tuning.
+
+ThroughputCallback times every optimizer step of a transformers Trainer
+from its callback events:
+
+    on_step_end ... on_step_begin          data_wait: fetching and collating the
+                                           step's micro-batches (log/eval/save excluded)
+    on_step_begin ... on_substep_end       one micro-batch forward + backward
+    ... on_pre_optimizer_step              compute: all micro-batches, the gradient
+                                           sync of the last one and clipping
+    on_pre_optimizer_step ... on_optimizer_step   optimizer
+    on_step_begin ... on_step_end          step
+
+Gradient-accumulation overhead is the part of a step that is not plain
+micro-batch work: step time minus micro-batches times the mean micro-batch
+time without gradient sync (or minus compute without accumulation).
+Tokens come from the lima_data collator, real and as processed (padding
+included). Peak device memory and peak host RSS are read per logging
+window.
+
+At every log the window is appended to <output_dir>/throughput.jsonl, the
+latest values are written to <output_dir>/throughput.prom in the Prometheus
+text format (for node-exporter's textfile collector or any scraper of
+files), and the headline numbers are added to the trainer logs. With
+profile_steps=(start, end) a torch profiler records steps [start, end) to
+<output_dir>/profile.
+
+CUDA kernels run asynchronously, so a timestamp only covers the device work
+that finished before it. The device is synchronized at the end of every
+logging window, which keeps the window totals exact without stalling every
+step; with synchronize=True (and inside the profiler window) it is also
+synchronized at every timestamp, so each phase is charged for the kernels
+it launched.
+"""
+import json
+import logging
+import os
+import resource
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+from transformers import TrainerCallback
+
+logger = logging.getLogger(__name__)
+
+
+def parse_profile_steps(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """"START:END" (steps, END exclusive) as a tuple, None for no profiling."""
+    if not value:
+        return None
+    start, end = (int(step) for step in value.split(":"))
+    if end <= start:
+        raise ValueError(f"Empty profiler window {value}")
+    return start, end
+
+
+class ThroughputCallback(TrainerCallback):
+    def __init__(
+        self,
+        collator,
+        output_dir: str,
+        labels: Optional[Dict[str, str]] = None,
+        profile_steps: Optional[Tuple[int, int]] = None,
+        synchronize: bool = False,
+    ):
+        """
+        Args:
+            collator: lima_data collator whose token totals are read
+            output_dir: where throughput.jsonl, throughput.prom and profile/ go
+            labels: extra Prometheus labels, e.g. {"rank": "0"}
+            profile_steps: [start, end) optimizer steps to profile
+            synchronize: wait for the device at every timestamp, not only at
+                the end of each logging window, so async CUDA kernels are
+                counted in the phase that launched them
+        """
+        self.collator = collator
+        self.output_dir = output_dir
+        self.labels = labels or {}
+        self.profile_steps = profile_steps
+        self.synchronize = synchronize
+        self.cuda = torch.cuda.is_available()
+        self._profiler: Optional[torch.profiler.profile] = None
+
+        self.registry = CollectorRegistry()
+        names = list(self.labels)
+        self.gauges = {
+            name: Gauge(f"lima_train_{name}", description, names, registry=self.registry)
+            for name, description in [
+                ("step_seconds", "Mean optimizer step time of the last logging window."),
+                ("data_wait_seconds", "Mean time per step spent fetching and collating batches."),
+                ("optimizer_seconds", "Mean optimizer.step time."),
+                ("accumulation_overhead_seconds", "Mean step time beyond plain micro-batch forward and backward."),
+                ("real_tokens_per_second", "Non-padding tokens per second of wall time."),
+                ("padded_tokens_per_second", "Tokens processed per second of wall time, padding included."),
+                ("padding_ratio", "Share of processed tokens that were padding."),
+                ("peak_device_memory_bytes", "Peak allocated device memory of the last logging window."),
+                ("peak_device_reserved_bytes", "Peak reserved device memory of the last logging window."),
+                ("peak_host_rss_bytes", "Peak resident host memory of the process."),
+                ("global_step", "Optimizer steps completed."),
+            ]
+        }
+        self._reset_window()
+        self._gap_start: Optional[float] = None
+        self._tokens_seen = (0, 0)
+
+    # ============================================================== #
+    # Timestamps
+    # ============================================================== #
+    def _now(self, boundary: bool = False) -> float:
+        if self.cuda and (boundary or self.synchronize or self._profiler is not None):
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _tokens(self) -> Tuple[int, int]:
+        return self.collator.total_real_tokens, self.collator.total_padded_tokens
+
+    def _reset_window(self) -> None:
+        self.window: Dict[str, List[float]] = {
+            "step": [], "data_wait": [], "compute": [], "optimizer": [], "overhead": [], "microbatch": [],
+        }
+        self.window_real_tokens = 0
+        self.window_padded_tokens = 0
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def _mark_gap(self) -> None:
+        self._gap_start = self._now()
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._tokens_seen = self._tokens()
+        self._mark_gap()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self._step_start = self._now()
+        self._substep_start = self._step_start
+        self._substeps: List[float] = []
+        if self._gap_start is not None:
+            self.window["data_wait"].append(self._step_start - self._gap_start)
+
+        if self.profile_steps and state.global_step == self.profile_steps[0]:
+            self._start_profiler()
+
+    def on_substep_end(self, args, state, control, **kwargs):
+        now = self._now()
+        self._substeps.append(now - self._substep_start)
+        self._substep_start = now
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self._pre_optimizer = self._now()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        self.window["optimizer"].append(self._now() - self._pre_optimizer)
+
+    def on_step_end(self, args, state, control, **kwargs):
+        # The Trainer logs after the steps that are a multiple of logging_steps
+        end = self._now(boundary=state.global_step % max(1, args.logging_steps) == 0)
+        step = end - self._step_start
+        compute = self._pre_optimizer - self._step_start
+        self.window["step"].append(step)
+        self.window["compute"].append(compute)
+        if self._substeps:
+            microbatch = sum(self._substeps) / len(self._substeps)
+            self.window["microbatch"].append(microbatch)
+            self.window["overhead"].append(step - microbatch * (len(self._substeps) + 1))
+        else:
+            self.window["overhead"].append(step - compute)
+
+        real, padded = self._tokens()
+        self.window_real_tokens += real - self._tokens_seen[0]
+        self.window_padded_tokens += padded - self._tokens_seen[1]
+        self._tokens_seen = (real, padded)
+
+        if self._profiler is not None:
+            self._profiler.step()
+            if state.global_step >= self.profile_steps[1]:
+                self._stop_profiler()
+        self._gap_start = end
+
+    # Logging, evaluation and saving run between two steps but are no data wait
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if self.window["step"] and logs is not None and "loss" in logs:
+            metrics = self._summarize(state)
+            self._write(metrics)
+            logs.update({
+                "step_s": round(metrics["step_seconds"], 4),
+                "data_wait_s": round(metrics["data_wait_seconds"], 4),
+                "real_tokens_per_s": round(metrics["real_tokens_per_second"], 1),
+                "peak_device_memory_gb": round(metrics["peak_device_memory_bytes"] / 2 ** 30, 2),
+            })
+            self._reset_window()
+        # Tokens collated for evaluation are not training throughput
+        self._tokens_seen = self._tokens()
+        self._mark_gap()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        self._tokens_seen = self._tokens()
+        self._mark_gap()
+
+    def on_save(self, args, state, control, **kwargs):
+        self._mark_gap()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        self._stop_profiler()
+
+    # ============================================================== #
+    # Output
+    # ============================================================== #
+    def _summarize(self, state) -> Dict[str, Any]:
+        def mean(name: str) -> float:
+            values = self.window[name]
+            return sum(values) / len(values) if values else 0.0
+
+        wall = sum(self.window["step"]) + sum(self.window["data_wait"])
+        processed = self.window_real_tokens + self.window_padded_tokens
+        # ru_maxrss is in kilobytes on Linux
+        peak_host = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        peak_device = torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0
+        peak_reserved = torch.cuda.max_memory_reserved() if torch.cuda.is_available() else 0
+        return {
+            "global_step": state.global_step,
+            "steps": len(self.window["step"]),
+            "step_seconds": mean("step"),
+            "data_wait_seconds": mean("data_wait"),
+            "compute_seconds": mean("compute"),
+            "microbatch_seconds": mean("microbatch"),
+            "optimizer_seconds": mean("optimizer"),
+            "accumulation_overhead_seconds": mean("overhead"),
+            "real_tokens": self.window_real_tokens,
+            "padded_tokens": self.window_padded_tokens,
+            "real_tokens_per_second": self.window_real_tokens / wall if wall else 0.0,
+            "padded_tokens_per_second": processed / wall if wall else 0.0,
+            "padding_ratio": self.window_padded_tokens / processed if processed else 0.0,
+            "peak_device_memory_bytes": peak_device,
+            "peak_device_reserved_bytes": peak_reserved,
+            "peak_host_rss_bytes": peak_host,
+        }
+
+    def _write(self, metrics: Dict[str, Any]) -> None:
+        with open(os.path.join(self.output_dir, "throughput.jsonl"), "a") as f:
+            f.write(json.dumps({"time": time.time(), **self.labels, **metrics}) + "\n")
+
+        for name, gauge in self.gauges.items():
+            (gauge.labels(**self.labels) if self.labels else gauge).set(metrics[name])
+        try:
+            write_to_textfile(os.path.join(self.output_dir, "throughput.prom"), self.registry)
+        except Exception as e:
+            logger.error(f"Failed to write throughput metrics: {e}")
+
+    # ============================================================== #
+    # Profiler
+    # ============================================================== #
+    def _start_profiler(self) -> None:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            record_shapes=True,
+            profile_memory=True,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(os.path.join(self.output_dir, "profile")),
+        )
+        self._profiler.start()
+        logger.info(f"Profiling steps {self.profile_steps[0]} to {self.profile_steps[1] - 1}")
+
+    def _stop_profiler(self) -> None:
+        if self._profiler is None:
+            return
+        self._profiler.stop()
+        os.makedirs(os.path.join(self.output_dir, "profile"), exist_ok=True)
+        sort_by = "cuda_time_total" if torch.cuda.is_available() else "cpu_time_total"
+        with open(os.path.join(self.output_dir, "profile", "key_averages.txt"), "w") as f:
+            f.write(self._profiler.key_averages().table(sort_by=sort_by, row_limit=50))
+        logger.info(f"Profile written to {os.path.join(self.output_dir, 'profile')}")
+        self._profiler = None
@@ -0,0 +1,350 @@
+"""Data-parallel LoRA fine-tuning of tune_lima.py on the Ray cluster.
+
+The driver preprocesses LIMA once (lima_data.prepare_datasets, cached) and
+hands it to a Ray Train TorchTrainer as Ray Data datasets, which are split
+into one shard per worker. Every worker builds the LoRA model and a
+transformers Trainer over its shard, wrapped in DDP (or FSDP with --fsdp)
+by Ray's process group. Checkpoints are reported to Ray Train by all workers
+at every save, and a restarted run resumes from the latest one.
+
+    # all GPUs of the cluster (run from this directory, with RAY_ADDRESS set)
+    python train_lima_ray.py --num-workers 3 --packing
+
+    # CPU-only smoke test of the distributed path with gloo and a tiny model
+    python train_lima_ray.py --cpu --num-workers 2 --model-name hf-internal-testing/tiny-random-LlamaForCausalLM \\
+        --max-examples 64 --max-seq-length 256 --max-steps 4 --eval-steps 2
+"""
+import argparse
+import logging
+import math
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+import ray
+import torch
+from peft import LoraConfig, get_peft_model
+from ray.train import CheckpointConfig, DataConfig, RunConfig, ScalingConfig
+from ray.train.huggingface.transformers import RayTrainReportCallback, prepare_trainer
+from ray.train.torch import TorchConfig, TorchTrainer
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, Trainer, TrainingArguments
+
+from lima_data import (
+    FlatteningCollator,
+    PaddingCollator,
+    PaddingRatioCallback,
+    length_grouped_order,
+    prepare_datasets,
+)
+from throughput import ThroughputCallback, parse_profile_steps
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    "model_name": "meta-llama/Llama-3.1-8B",
+    "packing": False,
+    "batch_size": 4,
+    "gradient_accumulation_steps": 4,
+    "max_steps": 100,
+    "eval_steps": 20,
+    "logging_steps": 10,
+    # "START:END" steps to record with the torch profiler, on every worker
+    "profile_steps": None,
+    # Synchronize CUDA at every timing event instead of once per logging window
+    "sync_timings": False,
+    "learning_rate": 2e-4,
+    "lora_r": 8,
+    "lora_alpha": 32,
+    "lora_dropout": 0.1,
+    "target_modules": ["q_proj", "v_proj", "k_proj", "o_proj"],
+    "fsdp": False,
+    "output_dir": "./output/",
+}
+
+
+# ================================================================== #
+# Worker
+# ================================================================== #
+def load_tokenizer(model_name: str):
+    tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+    tokenizer.padding_side = "right"
+    tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
+
+
+def load_model(config: Dict[str, Any], device: torch.device):
+    """4-bit QLoRA model on GPU workers, plain float32 LoRA on CPU workers."""
+    if device.type == "cuda":
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16,
+            # FSDP can only shard the quantized weights when they are stored as a float type
+            bnb_4bit_quant_storage=torch.float16 if config["fsdp"] else torch.uint8,
+        )
+        model = AutoModelForCausalLM.from_pretrained(
+            config["model_name"],
+            torch_dtype=torch.float16,
+            quantization_config=bnb_config,
+            device_map=None if config["fsdp"] else {"": device},
+        )
+    else:
+        model = AutoModelForCausalLM.from_pretrained(config["model_name"], torch_dtype=torch.float32)
+    # No KV cache in training or evaluation, packed rows rely on it (see FlatteningCollator)
+    model.config.use_cache = False
+
+    lora_config = LoraConfig(
+        r=config["lora_r"],
+        lora_alpha=config["lora_alpha"],
+        target_modules=config["target_modules"],
+        lora_dropout=config["lora_dropout"],
+        bias="none",
+        task_type="CAUSAL_LM"
+    )
+    return get_peft_model(model, lora_config)
+
+
+class RayBatchCollator:
+    """Adapts a lima_data collator to the column batches of Ray Data's iter_torch_batches."""
+
+    def __init__(self, collator):
+        self.collator = collator
+
+    def __call__(self, batch: Dict[str, np.ndarray]) -> Dict[str, torch.Tensor]:
+        size = len(next(iter(batch.values())))
+        features = [{name: np.asarray(column[i]).tolist() for name, column in batch.items()} for i in range(size)]
+        return self.collator(features)
+
+
+def training_arguments(config: Dict[str, Any], use_gpu: bool, output_dir: str) -> TrainingArguments:
+    return TrainingArguments(
+        output_dir=output_dir,
+        logging_dir=os.path.join(output_dir, "logs"),
+        optim="paged_adamw_8bit" if use_gpu else "adamw_torch",
+        per_device_train_batch_size=config["batch_size"],
+        per_device_eval_batch_size=config["batch_size"],
+        lr_scheduler_type="cosine",
+        logging_strategy="steps",
+        logging_steps=config["logging_steps"],
+        # The shards are iterables without a length, so training is bounded by steps
+        max_steps=config["max_steps"],
+        gradient_accumulation_steps=config["gradient_accumulation_steps"],
+        gradient_checkpointing=True,
+        gradient_checkpointing_kwargs={"use_reentrant": False},
+        learning_rate=config["learning_rate"],
+        fp16=use_gpu,
+        max_grad_norm=0.3,
+        warmup_ratio=0.03,
+        report_to="none",
+        push_to_hub=False,
+        # Every save is reported to Ray Train together with the latest eval_loss
+        eval_strategy="steps",
+        eval_steps=config["eval_steps"],
+        save_strategy="steps",
+        save_steps=config["eval_steps"],
+        save_total_limit=1,
+        remove_unused_columns=False,
+        dataloader_num_workers=0,
+        ddp_find_unused_parameters=False,
+        fsdp="full_shard auto_wrap" if config["fsdp"] else "",
+    )
+
+
+def train_loop_per_worker(config: Dict[str, Any]) -> None:
+    config = {**DEFAULT_CONFIG, **config}
+    device = ray.train.torch.get_device()
+    use_gpu = device.type == "cuda"
+
+    tokenizer = load_tokenizer(config["model_name"])
+    model = load_model(config, device)
+
+    collator = FlatteningCollator() if config["packing"] else PaddingCollator(tokenizer.pad_token_id)
+    shards = {
+        name: ray.train.get_dataset_shard(name).iter_torch_batches(
+            batch_size=config["batch_size"],
+            collate_fn=RayBatchCollator(collator),
+        )
+        for name in ("train", "eval")
+    }
+
+    # Every worker (of every concurrent trial) writes its own HF checkpoints, Ray Train collects them on report
+    context = ray.train.get_context()
+    trial, rank = context.get_trial_id() or "run", str(context.get_world_rank())
+    output_dir = os.path.join(config["output_dir"], "checkpoints", trial, f"rank_{rank}")
+    throughput = ThroughputCallback(
+        collator,
+        os.path.join(config["output_dir"], "metrics", trial, f"rank_{rank}"),
+        labels={"trial": trial, "rank": rank},
+        profile_steps=parse_profile_steps(config["profile_steps"]),
+        synchronize=config["sync_timings"],
+    )
+    trainer = Trainer(
+        model=model,
+        args=training_arguments(config, use_gpu, output_dir),
+        train_dataset=shards["train"],
+        eval_dataset=shards["eval"],
+        processing_class=tokenizer,
+        data_collator=collator,
+        callbacks=[RayTrainReportCallback(), PaddingRatioCallback(collator), throughput],
+    )
+    trainer = prepare_trainer(trainer)
+
+    checkpoint = ray.train.get_checkpoint()
+    if checkpoint:
+        with checkpoint.as_directory() as checkpoint_dir:
+            trainer.train(resume_from_checkpoint=os.path.join(checkpoint_dir, RayTrainReportCallback.CHECKPOINT_NAME))
+    else:
+        trainer.train()
+
+
+# ================================================================== #
+# Driver
+# ================================================================== #
+def to_ray_dataset(dataset) -> ray.data.Dataset:
+    # Straight from the Arrow table, ray.data.from_huggingface breaks with some datasets releases
+    return ray.data.from_arrow(dataset.flatten_indices().data.table)
+
+
+def build_trainer(
+    config: Dict[str, Any],
+    num_workers: int,
+    use_gpu: bool,
+    train_dataset,
+    eval_dataset,
+    storage_path: Optional[str] = None,
+    name: str = "lima_lora",
+    num_to_keep: int = 2,
+) -> TorchTrainer:
+    """
+    TorchTrainer over `num_workers` workers, one GPU each (nccl) or CPU
+    only (gloo). The Hugging Face datasets are handed to Ray Data and
+    split evenly between the workers.
+    """
+    config = {**DEFAULT_CONFIG, **config}
+    if config["packing"]:
+        # Packed rows all have about the same length, so a plain shuffle,
+        # which Ray Data draws anew every epoch
+        train = to_ray_dataset(train_dataset).random_shuffle()
+    else:
+        # Ray Data keeps the order, so the shards see similar lengths side by
+        # side. Training is bounded by steps: the epochs it runs are laid out
+        # back to back, each grouped from its own shuffle.
+        epochs = math.ceil(config["max_steps"] / steps_per_epoch(
+            len(train_dataset), config["batch_size"], num_workers, config["gradient_accumulation_steps"]
+        ))
+        lengths = train_dataset["length"]
+        order = [i for epoch in range(epochs) for i in length_grouped_order(lengths, config["batch_size"], epoch)]
+        train = to_ray_dataset(train_dataset.select(order))
+
+    execution_options = DataConfig.default_ingest_options()
+    execution_options.preserve_order = True
+    return TorchTrainer(
+        train_loop_per_worker,
+        train_loop_config=config,
+        scaling_config=ScalingConfig(num_workers=num_workers, use_gpu=use_gpu),
+        torch_config=TorchConfig(backend="nccl" if use_gpu else "gloo"),
+        datasets={
+            "train": train,
+            "eval": to_ray_dataset(eval_dataset),
+        },
+        dataset_config=DataConfig(execution_options=execution_options),
+        run_config=RunConfig(
+            name=name,
+            storage_path=storage_path,
+            checkpoint_config=CheckpointConfig(
+                num_to_keep=num_to_keep,
+                checkpoint_score_attribute="eval_loss",
+                checkpoint_score_order="min",
+            ),
+        ),
+    )
+
+
+def steps_per_epoch(num_rows: int, batch_size: int, num_workers: int, gradient_accumulation_steps: int) -> int:
+    # The shards are split evenly, rows that do not fill a batch on every worker are dropped
+    return max(1, num_rows // (batch_size * num_workers * gradient_accumulation_steps))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser("LIMA LoRA fine-tuning with Ray Train")
+    parser.add_argument("--model-name", default=DEFAULT_CONFIG["model_name"])
+    parser.add_argument("--num-workers", type=int, default=3, help="One GPU per worker")
+    parser.add_argument("--cpu", action="store_true", help="CPU workers with the gloo backend")
+    parser.add_argument("--fsdp", action="store_true", help="Shard the model with FSDP instead of replicating it with DDP")
+    parser.add_argument("--max-seq-length", type=int, default=2048)
+    parser.add_argument("--packing", action="store_true")
+    parser.add_argument("--batch-size", type=int, help="Rows per worker and step, default 1 packed and 4 padded")
+    parser.add_argument("--gradient-accumulation-steps", type=int, default=DEFAULT_CONFIG["gradient_accumulation_steps"])
+    parser.add_argument("--epochs", type=float, default=1)
+    parser.add_argument("--max-steps", type=int, help="Default --epochs worth of steps")
+    parser.add_argument("--eval-steps", type=int, default=DEFAULT_CONFIG["eval_steps"], help="Steps between eval and checkpoint")
+    parser.add_argument("--learning-rate", type=float, default=DEFAULT_CONFIG["learning_rate"])
+    parser.add_argument("--logging-steps", type=int, default=DEFAULT_CONFIG["logging_steps"])
+    parser.add_argument("--profile-steps", help="START:END steps to record with the torch profiler")
+    parser.add_argument("--sync-timings", action="store_true", help="Synchronize CUDA at every timing event, for exact per-phase times")
+    parser.add_argument("--max-examples", type=int, help="Train on a subset, for smoke tests")
+    parser.add_argument("--dataset-revision")
+    parser.add_argument("--cache-dir", default="~/storage/hf-datasets/lima-preprocessed")
+    parser.add_argument("--num-proc", type=int)
+    parser.add_argument("--storage-path", help="Ray Train results and checkpoints, default ~/ray_results")
+    parser.add_argument("--output-dir", default=DEFAULT_CONFIG["output_dir"])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    batch_size = args.batch_size or (1 if args.packing else 4)
+
+    # Ships lima_data.py to the workers
+    ray.init(runtime_env={
+        "working_dir": os.path.dirname(os.path.abspath(__file__)),
+        "excludes": ["output/", "*.ipynb"],
+        "pip": ["peft", "datasets", "bitsandbytes"],
+    })
+
+    tokenizer = load_tokenizer(args.model_name)
+    train_dataset, eval_dataset = prepare_datasets(
+        tokenizer,
+        args.max_seq_length,
+        packing=args.packing,
+        cache_dir=args.cache_dir,
+        num_proc=args.num_proc,
+        revision=args.dataset_revision,
+    )
+    if args.max_examples:
+        train_dataset = train_dataset.select(range(min(args.max_examples, len(train_dataset))))
+        eval_dataset = eval_dataset.select(range(min(args.max_examples, len(eval_dataset))))
+
+    max_steps = args.max_steps or math.ceil(
+        args.epochs * steps_per_epoch(len(train_dataset), batch_size, args.num_workers, args.gradient_accumulation_steps)
+    )
+    logger.info(f"Training {len(train_dataset)} rows on {args.num_workers} workers for {max_steps} steps")
+
+    trainer = build_trainer(
+        {
+            "model_name": args.model_name,
+            "packing": args.packing,
+            "batch_size": batch_size,
+            "gradient_accumulation_steps": args.gradient_accumulation_steps,
+            "max_steps": max_steps,
+            "eval_steps": args.eval_steps,
+            "logging_steps": args.logging_steps,
+            "profile_steps": args.profile_steps,
+            "sync_timings": args.sync_timings,
+            "learning_rate": args.learning_rate,
+            "fsdp": args.fsdp,
+            "output_dir": os.path.abspath(args.output_dir),
+        },
+        num_workers=args.num_workers,
+        use_gpu=not args.cpu,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        storage_path=args.storage_path,
+    )
+    result = trainer.fit()
+    logger.info(f"Final metrics: {result.metrics}")
+    if result.best_checkpoints:
+        checkpoint, metrics = result.best_checkpoints[0]
+        logger.info(f"Best checkpoint (eval_loss {metrics.get('eval_loss')}): {checkpoint.path}")
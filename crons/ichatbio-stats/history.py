@@ -0,0 +1,128 @@
+from datetime import date, datetime
+import logging
+import os
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+logger = logging.getLogger(__name__)
+
+
+# ================================================================== #
+# Layout
+# ================================================================== #
+# Long format, one row per report x metric x key:
+#   sign_ups, conversations, user_messages  key ""
+#   messages                                key = message type
+#   org_sign_ups                            key = organization
+# Stored as an uncompressed Arrow IPC file so it can be memory-mapped and
+# scanned without parsing.
+SCHEMA = pa.schema([
+    ("kind", pa.string()),
+    ("period_end", pa.date32()),
+    ("metric", pa.string()),
+    ("key", pa.string()),
+    ("value", pa.int64()),
+])
+
+TREND_METRICS = [
+    ("sign_ups", "Sign Ups"),
+    ("conversations", "New Conversations"),
+    ("user_messages", "User Messages"),
+    ("messages", None),
+]
+
+
+def aggregates_to_rows(kind: str, period_end: date, aggregates: Dict[str, Any]) -> List[Dict[str, Any]]:
+    rows = []
+    for metric, value in aggregates.items():
+        values = value if isinstance(value, dict) else {"": value}
+        for key, count in values.items():
+            rows.append({
+                "kind": kind,
+                "period_end": period_end,
+                "metric": metric,
+                "key": key or "",
+                "value": int(count),
+            })
+    return rows
+
+
+class History:
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self) -> pa.Table:
+        if not os.path.exists(self.path):
+            return SCHEMA.empty_table()
+        with pa.memory_map(self.path) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def append(self, kind: str, period_end: date, aggregates: Dict[str, Any]) -> None:
+        """Adds one report's aggregates, replacing a previous run for the same report."""
+        history = self.read()
+        if history.num_rows:
+            same_report = pc.and_(pc.equal(history["kind"], kind), pc.equal(history["period_end"], period_end))
+            history = history.filter(pc.invert(same_report))
+        new_rows = pa.Table.from_pylist(aggregates_to_rows(kind, period_end, aggregates), schema=SCHEMA)
+        table = pa.concat_tables([history.cast(SCHEMA), new_rows])
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with pa.OSFile(f"{self.path}.tmp", "wb") as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+        os.replace(f"{self.path}.tmp", self.path)
+        logger.info(f"Appended {new_rows.num_rows} {kind} history rows to {self.path}")
+
+    def trends(
+        self,
+        kind: str,
+        aggregates: Dict[str, Any],
+        period_end: Optional[date] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Rows of: label, current value, the same report a week earlier, the
+        change in percent and the mean over the previous 30 days.
+        """
+        period_end = period_end or datetime.now().date()
+        current = pa.Table.from_pylist(aggregates_to_rows(kind, period_end, aggregates), schema=SCHEMA)
+        history = self.read().cast(SCHEMA)
+        history = history.filter(pc.equal(history["kind"], kind))
+
+        ends = history["period_end"].to_numpy(zero_copy_only=False).astype("datetime64[D]")
+        end = np.datetime64(period_end, "D")
+        week_ago = history.filter(pa.array(ends == end - np.timedelta64(7, "D")))
+        last_30_days = history.filter(pa.array((ends < end) & (ends >= end - np.timedelta64(30, "D"))))
+
+        keys = ["metric", "key"]
+        table = (
+            current.select(keys + ["value"])
+            .join(week_ago.select(keys + ["value"]).rename_columns(keys + ["week_ago"]), keys=keys)
+            .join(
+                last_30_days.group_by(keys).aggregate([("value", "mean")]).rename_columns(keys + ["mean_30d"]),
+                keys=keys,
+            )
+        )
+
+        value = table["value"].to_numpy(zero_copy_only=False).astype(float)
+        week = table["week_ago"].to_numpy(zero_copy_only=False).astype(float)
+        mean = table["mean_30d"].to_numpy(zero_copy_only=False).astype(float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            change = np.where(week > 0, 100 * (value - week) / week, np.nan)
+
+        rows = {}
+        for i, (metric, key) in enumerate(zip(table["metric"].to_pylist(), table["key"].to_pylist())):
+            rows[(metric, key)] = {
+                "value": int(value[i]),
+                "week_ago": None if np.isnan(week[i]) else int(week[i]),
+                "change_pct": None if np.isnan(change[i]) else round(float(change[i]), 1),
+                "mean_30d": None if np.isnan(mean[i]) else round(float(mean[i]), 1),
+            }
+
+        trends = []
+        for metric, label in TREND_METRICS:
+            for (row_metric, key), row in sorted(rows.items()):
+                if row_metric == metric:
+                    trends.append({"label": label or key, **row})
+        return trends
@@ -0,0 +1,9 @@
+-- Indexes the stats queries rely on, see README.md ("Daily rollup").
+-- Also usable as benchmark.py --setup-sql.
+
+-- Rolling up a finished day, counting today's messages and filling the partition cache
+CREATE INDEX IF NOT EXISTS messages_created_idx ON messages (created);
+
+-- Conversations and new users of a period
+CREATE INDEX IF NOT EXISTS conversations_created_idx ON conversations (created);
+CREATE INDEX IF NOT EXISTS users_created_idx ON users (created);
@@ -0,0 +1,190 @@
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+import logging
+import os
+import queue
+import random
+import smtplib
+import time
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ================================================================== #
+# Connections
+# ================================================================== #
+class SmtpPool:
+    """
+    A few authenticated SMTP connections, opened on first use and reused for
+    every message of the run. A connection that failed is discarded and
+    replaced by a fresh one the next time it is needed.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        starttls: bool = False,
+        size: int = 2,
+        timeout: float = 30,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.size = size
+        self._idle: "queue.LifoQueue[Optional[smtplib.SMTP]]" = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    @classmethod
+    def from_env(cls) -> "SmtpPool":
+        return cls(
+            host=os.getenv("SMTP_SERVER"),
+            port=int(os.getenv("SMTP_PORT", 25)),
+            username=os.getenv("SMTP_USER"),
+            password=os.getenv("SMTP_PASS"),
+            starttls=os.getenv("SMTP_STARTTLS", "false").lower() == "true",
+            size=int(os.getenv("SMTP_POOL_SIZE", 2)),
+        )
+
+    def connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            smtp.starttls()
+        if self.username:
+            smtp.login(self.username, self.password)
+        return smtp
+
+    def send(self, sender: str, recipient: str, message: str) -> None:
+        smtp = self._idle.get()
+        try:
+            if smtp is None:
+                smtp = self.connect()
+            smtp.sendmail(sender, [recipient], message)
+        except smtplib.SMTPRecipientsRefused:
+            # The server rejected this address, the connection itself is fine
+            raise
+        except Exception:
+            self._discard(smtp)
+            smtp = None
+            raise
+        finally:
+            self._idle.put(smtp)
+
+    def close(self) -> None:
+        for _ in range(self.size):
+            self._discard(self._idle.get())
+        for _ in range(self.size):
+            self._idle.put(None)
+
+    @staticmethod
+    def _discard(smtp: Optional[smtplib.SMTP]) -> None:
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+
+# ================================================================== #
+# Sending
+# ================================================================== #
+def is_transient(e: Exception) -> bool:
+    """Whether sending again may succeed: 4xx replies and connection errors."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(e, smtplib.SMTPException):
+        return False
+    return isinstance(e, OSError)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2^attempt)]."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Mailer:
+    """
+    Sends one message per recipient over an SmtpPool with at most
+    `pool.size` messages in flight, then retries only the recipients that
+    failed transiently (see is_transient), waiting an exponentially growing,
+    jittered delay between rounds.
+    """
+
+    def __init__(
+        self,
+        pool: SmtpPool,
+        sender: str,
+        retry_attempts: int = 3,
+        retry_delay: float = 5,
+        max_retry_delay: float = 60,
+    ):
+        self.pool = pool
+        self.sender = sender
+        self.retry_attempts = retry_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+    @classmethod
+    def from_env(cls, sender: str) -> "Mailer":
+        return cls(
+            SmtpPool.from_env(),
+            sender,
+            retry_attempts=int(os.getenv("RETRY_ATTEMPTS", 3)),
+            retry_delay=float(os.getenv("RETRY_DELAY", 5)),
+            max_retry_delay=float(os.getenv("RETRY_MAX_DELAY", 60)),
+        )
+
+    def send_all(self, recipients: List[str], build_message: Callable[[str], Message]) -> Dict[str, Exception]:
+        """
+        Args:
+            recipients: addresses to send to, one message each
+            build_message: returns the (personalized) message for a recipient
+        Returns:
+            The recipients that could not be reached and their last error
+        """
+        messages = {recipient: build_message(recipient).as_string() for recipient in recipients}
+        pending = list(recipients)
+        failed: Dict[str, Exception] = {}
+
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            for attempt in range(self.retry_attempts):
+                if attempt:
+                    delay = backoff_delay(attempt, self.retry_delay, self.max_retry_delay)
+                    logger.info(f"Retrying {len(pending)} recipients in {delay:.1f} seconds...")
+                    time.sleep(delay)
+
+                logger.info(f"Sending to {len(pending)} recipients (attempt {attempt + 1})")
+                futures = {
+                    recipient: executor.submit(self.pool.send, self.sender, recipient, messages[recipient])
+                    for recipient in pending
+                }
+                pending = []
+                for recipient, future in futures.items():
+                    try:
+                        future.result()
+                        failed.pop(recipient, None)
+                    except Exception as e:
+                        failed[recipient] = e
+                        if is_transient(e):
+                            logger.error(f"Failed to send to {recipient} (attempt {attempt + 1}): {e}")
+                            pending.append(recipient)
+                        else:
+                            logger.error(f"Failed to send to {recipient}, not retrying: {e}")
+                if not pending:
+                    break
+        return failed
+
+    def close(self) -> None:
+        self.pool.close()
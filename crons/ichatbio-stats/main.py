@@ -1,24 +1,30 @@
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.utils import formataddr
 from dotenv import load_dotenv
-import smtplib
 import logging
 import datetime
-import time
 import os
 import json
 import sys
 import argparse
+from typing import Dict, Tuple
 
-from stats import get_data
+from history import History
+import metrics
+from mailer import Mailer
+from stats import close_pool, get_period, get_reports, stream_data
 sys.path.append('../')
 from templates.usage_summary import UsageSummary
 
 parser = argparse.ArgumentParser('iChatBio Usage Summary Service')
-parser.add_argument('--kind', dest="kind", choices=['Daily', 'Weekly'], type=str, help='Choose a summary duration')
+parser.add_argument('--kind', dest="kinds", choices=['Daily', 'Weekly'], type=str, nargs='+', default=['Daily'], help='Choose one or more summary durations, e.g. --kind Daily Weekly')
+parser.add_argument('--stream', dest="stream", action='store_true', help='Stream rows through server-side cursors instead of loading them all (for long periods)')
 args = parser.parse_args()
-kind = args.kind
+kinds = list(dict.fromkeys(args.kinds))
+
+KIND_DAYS = {'Daily': 1, 'Weekly': 7}
 
 # Logging Setup
 log_file = 'ichatbio_email_service.log'
@@ -42,13 +48,8 @@ logger.info("=" * 50 + "\n")
 load_dotenv(".chat.env")
 logger.info("Loaded .chat.env")
 
-# Fetch summary data
-if not kind or kind == 'Daily':
-    days = 1
-else:
-    days = 7
-conversations, new_users = get_data(days=days)
-logger.info(f"{kind} summary data fetched from DB")
+# Phase timings and exit status for Prometheus, written out by metrics.emit
+metrics.job = os.getenv("METRICS_JOB") or "ichatbio_" + "_".join(kind.lower() for kind in kinds)
 
 # Load recipients list
 recipients_file = os.getenv("RECIPIENTS_FILE", "recipients.json")
@@ -58,41 +59,104 @@ with open(recipients_file, "r") as file:
 recipients = receivers.get("recipients", [])
 if not recipients:
     logger.error("No recipients configured. Email not sent.")
+    metrics.emit(1)
     sys.exit(1)
+# Entries are addresses or {"email": ..., "name": ...}, the name personalizes the To header
+recipient_names = {
+    (r["email"] if isinstance(r, dict) else r): (r.get("name", "") if isinstance(r, dict) else "")
+    for r in recipients
+}
+
+# Aggregates of past runs, for the trend rows
+history = History(os.getenv("STATS_HISTORY_FILE", "history/usage_history.arrow"))
+
+# Fetch summary data, all periods at once over the shared connection pool
+if not args.stream:
+    try:
+        with metrics.phase("fetch"):
+            reports = get_reports({kind: get_period(days=KIND_DAYS[kind]) for kind in kinds})
+    except Exception:
+        close_pool()
+        metrics.emit(1)
+        raise
+    logger.info(f"{', '.join(kinds)} summary data fetched from DB")
+
+
+def generate_email(kind: str) -> Tuple[str, Dict[str, bytes]]:
+    with metrics.phase("render", kind):
+        email_content, attachments = render_email(kind)
+    metrics.rendered_bytes.labels(metrics.job, kind, "html").set(len(email_content.encode()))
+    metrics.rendered_bytes.labels(metrics.job, kind, "attachments").set(sum(len(a) for a in attachments.values()))
+    return email_content, attachments
+
 
-logger.info(f"Sending email to {len(recipients)} recipients")
+def render_email(kind: str) -> Tuple[str, Dict[str, bytes]]:
+    if args.stream:
+        # Rows are read from the DB while the email is rendered
+        with stream_data(days=KIND_DAYS[kind]) as (conversations, new_users):
+            email_generator = UsageSummary(conversations, new_users, kind=kind, history=history)
+            email_content = email_generator.generate_html_email()
+        logger.info(f"{kind} summary data streamed from DB")
+    else:
+        conversations, new_users = reports[kind]
+        email_generator = UsageSummary(conversations, new_users, kind=kind, history=history)
+        email_content = email_generator.generate_html_email()
+    history.append(kind, get_period(days=KIND_DAYS[kind])["end_date"], email_generator.aggregates())
+    logger.info(f"{kind} email generated ({len(email_content)} bytes, attachments: {list(email_generator.attachments)})")
+    return email_content, email_generator.attachments
 
-# Generate email content
-email_generator = UsageSummary(conversations, new_users, kind=kind)
-email_content = email_generator.generate_html_email()
-logger.info("Email generated")
 
-# Prepare email
-message = MIMEMultipart("alternative")
+def send_email(kind: str, email_content: str, attachments: Dict[str, bytes]) -> bool:
+    # The HTML body and CSVs (lists cut short in it) are shared by every recipient
+    body = MIMEMultipart("alternative")
+    body.attach(MIMEText(email_content, "html"))
+    attachment_parts = []
+    for filename, content in attachments.items():
+        attachment = MIMEApplication(content, "gzip")
+        attachment.add_header("Content-Disposition", "attachment", filename=filename)
+        attachment_parts.append(attachment)
+
+    def build_message(recipient: str) -> MIMEMultipart:
+        message = MIMEMultipart("mixed")
+        message['From'] = formataddr((sender_name, sender_email))
+        message['Subject'] = f"iChatBio - {kind} Summary"
+        message['To'] = formataddr((recipient_names.get(recipient, ""), recipient))
+        message.attach(body)
+        for attachment in attachment_parts:
+            message.attach(attachment)
+        return message
+
+    with metrics.phase("send", kind):
+        failed = mailer.send_all(list(recipient_names), build_message)
+    metrics.recipients.labels(metrics.job, kind, "sent").set(len(recipient_names) - len(failed))
+    metrics.recipients.labels(metrics.job, kind, "failed").set(len(failed))
+    if failed:
+        logger.error(f"{kind} email not delivered to {len(failed)} of {len(recipient_names)} recipients: {', '.join(failed)}")
+        return False
+    logger.info(f"{kind} email sent successfully to {len(recipient_names)} recipients")
+    return True
+
+
+# One pooled, authenticated SMTP connection set for every summary of the run
 sender_name = os.getenv("EMAIL_FROM_NAME",)
 sender_email = os.getenv("EMAIL_FROM_EMAIL")
-message['From'] = formataddr((sender_name, sender_email))
-message['Subject'] = f"iChatBio - {kind} Summary"
-message['To'] = ", ".join(recipients)
-message.attach(MIMEText(email_content, "html"))
+mailer = Mailer.from_env(sender_email)
 
-# Retry settings
-retry_attempts = int(os.getenv("RETRY_ATTEMPTS", 3))
-retry_delay = int(os.getenv("RETRY_DELAY", 5))
+failed = []
+try:
+    for kind in kinds:
+        if not send_email(kind, *generate_email(kind)):
+            failed.append(kind)
+except Exception:
+    metrics.emit(1)
+    raise
+finally:
+    close_pool()
+    mailer.close()
 
-# Send email with retries
-for attempt in range(1, retry_attempts + 1):
-    try:
-        logger.info(f"Sending email to {len(recipients)} recipients (attempt {attempt})")
-        with smtplib.SMTP(os.getenv("SMTP_SERVER"), os.getenv("SMTP_PORT")) as smtp:
-            smtp.sendmail(sender_email, recipients, message.as_string())
-        logger.info(f"Email sent successfully to {len(recipients)} recipients")
-        sys.exit(0)
-    except Exception as e:
-        logger.error(f"Failed to send email (attempt {attempt}): {e}")
-        if attempt < retry_attempts:
-            logger.info(f"Retrying in {retry_delay} seconds...")
-            time.sleep(retry_delay)
-
-logger.error("All attempts to send email failed")
-sys.exit(1)
+if failed:
+    logger.error(f"Summaries not sent: {', '.join(failed)}")
+    metrics.emit(1)
+    sys.exit(1)
+metrics.emit(0)
+sys.exit(0)
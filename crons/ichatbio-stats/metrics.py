@@ -0,0 +1,105 @@
+from contextlib import contextmanager
+import logging
+import os
+import time
+from typing import Iterator
+
+from prometheus_client import CollectorRegistry, Gauge, pushadd_to_gateway, write_to_textfile
+
+logger = logging.getLogger(__name__)
+
+# One registry per process: each cron invocation is a single run, and its
+# values are written out once at the end (see emit)
+registry = CollectorRegistry()
+
+phase_duration = Gauge(
+    "ichatbio_cron_phase_duration_seconds",
+    "Duration of each phase of the last run (connect, queries, render, send).",
+    ["job", "kind", "phase"],
+    registry=registry,
+)
+rows = Gauge(
+    "ichatbio_cron_rows",
+    "Rows read by the last run.",
+    ["job", "kind", "table"],
+    registry=registry,
+)
+rendered_bytes = Gauge(
+    "ichatbio_cron_rendered_bytes",
+    "Size of the rendered email body and attachments of the last run.",
+    ["job", "kind", "part"],
+    registry=registry,
+)
+recipients = Gauge(
+    "ichatbio_cron_recipients",
+    "Recipients the last run delivered to or failed to reach.",
+    ["job", "kind", "status"],
+    registry=registry,
+)
+exit_status = Gauge(
+    "ichatbio_cron_exit_status",
+    "Exit status of the last run, 0 on success.",
+    ["job"],
+    registry=registry,
+)
+last_run = Gauge(
+    "ichatbio_cron_last_run_timestamp_seconds",
+    "Unix time the last run finished.",
+    ["job"],
+    registry=registry,
+)
+# Written only by successful runs and kept apart from the rest, so a failed
+# run leaves the previous value in place for "time since last success" alerts
+success_registry = CollectorRegistry()
+last_success = Gauge(
+    "ichatbio_cron_last_success_timestamp_seconds",
+    "Unix time the last successful run finished.",
+    ["job"],
+    registry=success_registry,
+)
+
+# Jobs are named after the summaries they send, e.g. ichatbio_daily
+job = os.getenv("METRICS_JOB", "ichatbio_stats")
+
+
+@contextmanager
+def phase(name: str, kind: str = "") -> Iterator[None]:
+    """Records the wall time of the block as phase `name`, also when it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_duration.labels(job, kind, name).set(time.perf_counter() - start)
+
+
+def emit(status: int) -> None:
+    """
+    Writes the run's metrics to a node-exporter textfile (METRICS_TEXTFILE_DIR)
+    and/or a Pushgateway (PUSHGATEWAY_URL). Never raises: failing to report
+    must not fail the job.
+    """
+    now = time.time()
+    exit_status.labels(job).set(status)
+    last_run.labels(job).set(now)
+    registries = {"": registry}
+    if status == 0:
+        last_success.labels(job).set(now)
+        registries["_success"] = success_registry
+
+    textfile_dir = os.getenv("METRICS_TEXTFILE_DIR")
+    if textfile_dir:
+        for suffix, metrics in registries.items():
+            try:
+                # write_to_textfile writes a temp file and renames it, so node-exporter never reads a partial file
+                write_to_textfile(os.path.join(textfile_dir, f"{job}{suffix}.prom"), metrics)
+            except Exception as e:
+                logger.error(f"Failed to write metrics textfile: {e}")
+
+    pushgateway_url = os.getenv("PUSHGATEWAY_URL")
+    if pushgateway_url:
+        for metrics in registries.values():
+            try:
+                # POST replaces only the pushed metric names, a PUT would delete last_success
+                pushadd_to_gateway(pushgateway_url, job=job, registry=metrics, timeout=10)
+            except Exception as e:
+                logger.error(f"Failed to push metrics to {pushgateway_url}: {e}")
@@ -0,0 +1,203 @@
+from datetime import date, datetime, timedelta
+import logging
+import os
+from typing import Dict, Any, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+
+# ================================================================== #
+# Partition layout
+# ================================================================== #
+# Every finished day is stored once as three zstd Parquet files:
+#   users/<day>.parquet          users who signed up that day
+#   conversations/<day>.parquet  conversations created that day
+#   messages/<day>.parquet       message counts per conversation x type sent that day
+# Nothing about a finished day changes afterwards, so a partition is never
+# rewritten and any report period is assembled from the days it covers.
+USERS_SCHEMA = pa.schema([
+    ("user_id", pa.string()),
+    ("username", pa.string()),
+    ("user_email", pa.string()),
+    ("organization", pa.string()),
+    ("created", pa.timestamp("us")),
+])
+CONVERSATIONS_SCHEMA = pa.schema([
+    ("conv_id", pa.string()),
+    ("user_id", pa.string()),
+    ("username", pa.string()),
+    ("created", pa.timestamp("us")),
+])
+MESSAGES_SCHEMA = pa.schema([
+    ("conv_id", pa.string()),
+    ("message_type", pa.string()),
+    ("message_count", pa.int64()),
+    ("last_message_created", pa.timestamp("us")),
+])
+SCHEMAS = {
+    "users": USERS_SCHEMA,
+    "conversations": CONVERSATIONS_SCHEMA,
+    # Written last: a day is complete once its messages partition exists
+    "messages": MESSAGES_SCHEMA,
+}
+
+QUERIES = {
+    "users": """
+        SELECT
+            u.created::date,
+            u.id::text,
+            COALESCE(NULLIF(u.given_name, ''), u.email),
+            u.email,
+            u.organization,
+            u.created
+        FROM users u
+        WHERE u.created >= %s AND u.created < %s;
+    """,
+    "conversations": """
+        SELECT
+            c.created::date,
+            c.id::text,
+            c.user_id::text,
+            u.given_name,
+            c.created
+        FROM conversations c
+        JOIN users u ON u.id = c.user_id
+        WHERE c.created >= %s AND c.created < %s;
+    """,
+    "messages": """
+        SELECT
+            m.created::date,
+            m.conversation_id::text,
+            m.type,
+            COUNT(*),
+            MAX(m.created)
+        FROM messages m
+        WHERE m.created >= %s AND m.created < %s
+        GROUP BY 1, 2, 3;
+    """,
+}
+
+
+def day_range(start_date: date, end_date: date) -> List[date]:
+    return [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+
+
+def contiguous_runs(days: List[date]) -> List[Tuple[date, date]]:
+    """[start, end) ranges covering consecutive days."""
+    runs = []
+    for day in sorted(days):
+        if runs and runs[-1][1] == day:
+            runs[-1] = (runs[-1][0], day + timedelta(days=1))
+        else:
+            runs.append((day, day + timedelta(days=1)))
+    return runs
+
+
+class PartitionCache:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        for table in SCHEMAS:
+            os.makedirs(os.path.join(cache_dir, table), exist_ok=True)
+
+    def path(self, table: str, day: date) -> str:
+        return os.path.join(self.cache_dir, table, f"{day.isoformat()}.parquet")
+
+    def missing_days(self, start_date: date, end_date: date) -> List[date]:
+        return [day for day in day_range(start_date, end_date) if not os.path.exists(self.path("messages", day))]
+
+    def write_day(self, day: date, rows: Dict[str, List[Dict[str, Any]]]) -> None:
+        for table, schema in SCHEMAS.items():
+            path = self.path(table, day)
+            pq.write_table(pa.Table.from_pylist(rows[table], schema=schema), f"{path}.tmp", compression="zstd")
+            os.replace(f"{path}.tmp", path)
+
+    def read(self, table: str, days: List[date]) -> pa.Table:
+        tables = [pq.read_table(self.path(table, day)) for day in days]
+        if not tables:
+            return SCHEMAS[table].empty_table()
+        return pa.concat_tables(tables)
+
+    # ============================================================== #
+    # Filling from the database
+    # ============================================================== #
+    def fill(self, db, start_date: date, today: Optional[date] = None) -> List[date]:
+        """
+        Queries and stores every finished day since start_date that is not
+        cached yet, with one query per table and run of consecutive days.
+        Returns:
+            The days that were fetched
+        """
+        today = today or datetime.now().date()
+        missing = self.missing_days(start_date, today)
+        for run_start, run_end in contiguous_runs(missing):
+            by_day = {day: {table: [] for table in SCHEMAS} for day in day_range(run_start, run_end)}
+            for table, schema in SCHEMAS.items():
+                db.execute(QUERIES[table], (run_start, run_end))
+                for day, *values in db:
+                    by_day[day][table].append(dict(zip(schema.names, values)))
+            for day, rows in by_day.items():
+                self.write_day(day, rows)
+            logger.info(f"Cached days {run_start} to {run_end - timedelta(days=1)}")
+        return missing
+
+    def fetch_today(self, db, today: Optional[date] = None) -> pa.Table:
+        """Message counts of the unfinished current day, which are never cached."""
+        today = today or datetime.now().date()
+        db.execute(QUERIES["messages"], (today, today + timedelta(days=1)))
+        return pa.Table.from_pylist(
+            [dict(zip(MESSAGES_SCHEMA.names, values)) for _, *values in db],
+            schema=MESSAGES_SCHEMA,
+        )
+
+    # ============================================================== #
+    # Reports
+    # ============================================================== #
+    def get_report(
+        self,
+        period: Dict[str, date],
+        today_messages: pa.Table,
+        today: Optional[date] = None,
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]]]:
+        """
+        (conversations, new_users) of the period, in the same shape as
+        stats.get_data. Conversation counts include every message sent
+        since the period started, up to now.
+        """
+        today = today or datetime.now().date()
+        period_days = day_range(period["start_date"], min(period["end_date"], today))
+
+        users = self.read("users", period_days).sort_by([("created", "descending")])
+        new_users = users.select(["user_id", "username", "user_email", "organization"]).to_pylist()
+
+        conversations = self.read("conversations", period_days).sort_by([("created", "descending")])
+        messages = pa.concat_tables([self.read("messages", day_range(period["start_date"], today)), today_messages])
+        message_types = sorted(pc.unique(messages["message_type"]).to_pylist())
+        messages = messages.filter(pc.is_in(messages["conv_id"], value_set=conversations["conv_id"]))
+        counts = messages.group_by(["conv_id", "message_type"]).aggregate([
+            ("message_count", "sum"),
+            ("last_message_created", "max"),
+        ])
+
+        by_conversation = {
+            conv["conv_id"]: {
+                "user_id": conv["user_id"],
+                "username": conv["username"],
+                "conv_id": conv["conv_id"],
+                "total_message_count": 0,
+                "last_message_created": None,
+                "counts": {t: 0 for t in message_types},
+            }
+            for conv in conversations.to_pylist()
+        }
+        for row in counts.to_pylist():
+            conversation = by_conversation[row["conv_id"]]
+            conversation["counts"][row["message_type"]] = row["message_count_sum"]
+            conversation["total_message_count"] += row["message_count_sum"]
+            last = row["last_message_created_max"]
+            if conversation["last_message_created"] is None or last > conversation["last_message_created"]:
+                conversation["last_message_created"] = last
+        return list(by_conversation.values()), new_users
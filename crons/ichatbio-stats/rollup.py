@@ -0,0 +1,252 @@
+from datetime import date, datetime, timedelta
+import logging
+from typing import Dict, Any, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# ================================================================== #
+# Schema
+# ================================================================== #
+# One row per day x conversation x message type. Days are only rolled up once
+# they are over, so a rolled-up day never changes and each run only has to
+# scan the raw messages of the days it has not seen yet. conversation_id has
+# the type of messages.conversation_id, so joins need no cast and can use the
+# indexes on either side.
+#
+# Rolling up a day and counting today's messages filter messages by created;
+# without an index on messages (created) each is a full table scan, see
+# indexes.sql.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_daily_rollup (
+    day DATE NOT NULL,
+    conversation_id {conversation_id_type} NOT NULL,
+    message_type TEXT NOT NULL,
+    message_count BIGINT NOT NULL,
+    last_message_created TIMESTAMP NOT NULL,
+    PRIMARY KEY (day, conversation_id, message_type)
+);
+CREATE INDEX IF NOT EXISTS usage_daily_rollup_conversation_idx
+    ON usage_daily_rollup (conversation_id);
+
+CREATE TABLE IF NOT EXISTS usage_rollup_days (
+    day DATE PRIMARY KEY,
+    rolled_up_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS usage_message_types (
+    type TEXT PRIMARY KEY,
+    first_seen DATE NOT NULL
+);
+"""
+
+
+def column_type(db, table: str, column: str) -> Optional[str]:
+    """SQL type of table.column, None if the table has no such column."""
+    db.execute(
+        """
+        SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attname = %s AND NOT attisdropped;
+        """,
+        (table, column)
+    )
+    row = db.fetchone()
+    return row[0] if row else None
+
+
+def ensure_schema(db) -> None:
+    conversation_id_type = column_type(db, "messages", "conversation_id")
+    if conversation_id_type is None:
+        raise ValueError("No messages.conversation_id column to roll up, is this the iChatBio database?")
+    db.execute(SCHEMA.format(conversation_id_type=conversation_id_type))
+    if column_type(db, "usage_daily_rollup", "conversation_id") != conversation_id_type:
+        # Rollups created before conversation_id kept its native type stored it as text
+        db.execute(
+            f"ALTER TABLE usage_daily_rollup ALTER COLUMN conversation_id "
+            f"TYPE {conversation_id_type} USING conversation_id::{conversation_id_type};"
+        )
+    db.connection.commit()
+
+
+# ================================================================== #
+# Incremental rollup
+# ================================================================== #
+def get_missing_days(db, start_date: date, end_date: date) -> List[date]:
+    """Days in [start_date, end_date) that have not been rolled up yet."""
+    db.execute(
+        "SELECT day FROM usage_rollup_days WHERE day >= %s AND day < %s;",
+        (start_date, end_date)
+    )
+    done = {row[0] for row in db.fetchall()}
+    days = []
+    day = start_date
+    while day < end_date:
+        if day not in done:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def rollup_day(db, day: date) -> int:
+    """
+    Aggregates one finished day of messages into usage_daily_rollup and
+    records its message types in the catalog, in a single transaction.
+    Returns:
+        Number of rollup rows written
+    """
+    try:
+        db.execute(
+            """
+            INSERT INTO usage_daily_rollup
+                (day, conversation_id, message_type, message_count, last_message_created)
+            SELECT
+                %s,
+                m.conversation_id,
+                m.type,
+                COUNT(*),
+                MAX(m.created)
+            FROM
+                messages m
+            WHERE
+                m.created >= %s
+                AND m.created < %s
+            GROUP BY
+                m.conversation_id, m.type
+            ON CONFLICT (day, conversation_id, message_type) DO UPDATE SET
+                message_count = EXCLUDED.message_count,
+                last_message_created = EXCLUDED.last_message_created;
+            """,
+            (day, day, day + timedelta(days=1))
+        )
+        rows = db.rowcount
+        db.execute(
+            """
+            INSERT INTO usage_message_types (type, first_seen)
+            SELECT DISTINCT message_type, day FROM usage_daily_rollup WHERE day = %s
+            ON CONFLICT (type) DO NOTHING;
+            """,
+            (day,)
+        )
+        db.execute(
+            "INSERT INTO usage_rollup_days (day) VALUES (%s) ON CONFLICT (day) DO NOTHING;",
+            (day,)
+        )
+        db.connection.commit()
+        return rows
+    except Exception:
+        db.connection.rollback()
+        raise
+
+
+def extend_rollup(db, start_date: date, today: Optional[date] = None) -> List[date]:
+    """
+    Rolls up every finished day since start_date that is not in the rollup yet.
+    Returns:
+        The days that were added
+    """
+    today = today or datetime.now().date()
+    missing = get_missing_days(db, start_date, today)
+    for day in missing:
+        rows = rollup_day(db, day)
+        logger.info(f"Rolled up {day}: {rows} conversation x type rows")
+    return missing
+
+
+def get_message_types(db) -> List[str]:
+    db.execute("SELECT type FROM usage_message_types ORDER BY first_seen, type;")
+    return [row[0] for row in db.fetchall()]
+
+
+# ================================================================== #
+# Queries
+# ================================================================== #
+CONVERSATIONS_QUERY = """
+WITH period_conversations AS (
+    SELECT c.id AS conversation_id, c.user_id, u.given_name, c.created
+    FROM conversations c
+    JOIN users u ON u.id = c.user_id
+    WHERE c.created >= %(start_date)s AND c.created < %(end_date)s
+),
+counts AS (
+    SELECT r.conversation_id, r.message_type, r.message_count, r.last_message_created
+    FROM usage_daily_rollup r
+    JOIN period_conversations pc ON pc.conversation_id = r.conversation_id
+    WHERE r.day >= %(start_date)s
+    UNION ALL
+    SELECT m.conversation_id, m.type, COUNT(*), MAX(m.created)
+    FROM messages m
+    JOIN period_conversations pc ON pc.conversation_id = m.conversation_id
+    WHERE m.created >= %(today)s
+    GROUP BY m.conversation_id, m.type
+)
+SELECT
+    pc.user_id,
+    pc.given_name,
+    pc.conversation_id,
+    counts.message_type,
+    SUM(counts.message_count),
+    MAX(counts.last_message_created)
+FROM
+    period_conversations pc
+LEFT JOIN counts
+    ON counts.conversation_id = pc.conversation_id
+GROUP BY
+    pc.conversation_id, pc.user_id, pc.given_name, pc.created, counts.message_type
+ORDER BY
+    pc.created DESC, pc.conversation_id;
+"""
+
+
+def iter_conversations(
+    db,
+    period: Dict[str, datetime],
+    message_types: List[str],
+    today: Optional[date] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Conversations created within the period with their message counts per
+    type, summed from the rollup. Messages from today (not rolled up yet)
+    are counted from the raw table, which only touches today's rows.
+
+    Rows arrive one per conversation x type, ordered by conversation, so
+    each conversation is yielded as soon as its last row has been read.
+    """
+    today = today or datetime.now().date()
+    db.execute(CONVERSATIONS_QUERY, {**period, "today": today})
+
+    conversation = None
+    for user_id, username, conv_id, message_type, count, last_message_created in db:
+        if conversation is None or conversation["conv_id"] != conv_id:
+            if conversation is not None:
+                yield conversation
+            conversation = {
+                "user_id": user_id,
+                "username": username,
+                "conv_id": conv_id,
+                "total_message_count": 0,
+                "last_message_created": None,
+                "counts": {t: 0 for t in message_types},
+            }
+        if message_type is None:
+            continue
+        conversation["counts"][message_type] = int(count)
+        conversation["total_message_count"] += int(count)
+        if conversation["last_message_created"] is None or last_message_created > conversation["last_message_created"]:
+            conversation["last_message_created"] = last_message_created
+    if conversation is not None:
+        yield conversation
+
+
+def get_conversations(db, period: Dict[str, datetime], today: Optional[date] = None) -> List[Dict[str, Any]]:
+    """
+    Extends the rollup up to yesterday and returns the period's conversations.
+    Args:
+        db: database cursor to execute queries
+        period: {start_date, end_date}
+    Returns:
+        Array of conversation objects sorted by creation, newest first
+    """
+    today = today or datetime.now().date()
+    extend_rollup(db, period["start_date"], today)
+    message_types = get_message_types(db)
+    return list(iter_conversations(db, period, message_types, today))
@@ -1,10 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+import argparse
+import gzip
+import itertools
 import json
 import logging
 import os
+import sys
+import threading
+import time
 import psycopg2
-from typing import Dict, Any
+import psycopg2.pool
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+import metrics
+import partitions
+import rollup
+
+logger = logging.getLogger(__name__)
+
+# Defaults, overridden by STATS_* variables in .chat.env (read on use, since
+# main.py loads the env file after importing this module)
+# Rows per round trip when streaming through a server-side cursor
+FETCH_SIZE = 2000
+# Connections shared by all queries of a run, and the per-statement limit on each
+POOL_SIZE = 4
+STATEMENT_TIMEOUT_MS = 120000
+_pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+_pool_lock = threading.Lock()
 
 
 # ================================================================== #
@@ -19,14 +46,62 @@ def get_db_connection(connection_string: str) -> psycopg2.extensions.connection:
         raise
 
 
-def get_new_users(db, period: Dict[str, datetime]) -> Dict[str, str]:
+def get_pool() -> psycopg2.pool.ThreadedConnectionPool:
     """
-    Fetch users who registered within the last specified number of days.
-    Args:
-        db: database cursor to execute queries
-        period: {start_date, end_date}
-    Returns:
-        Array of user objects
+    Process-wide pool, created on first use from the PG_* environment.
+    Every connection carries the statement timeout.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                statement_timeout_ms = int(os.getenv("STATS_STATEMENT_TIMEOUT_MS", STATEMENT_TIMEOUT_MS))
+                with metrics.phase("connect"):
+                    _pool = psycopg2.pool.ThreadedConnectionPool(
+                        1,
+                        int(os.getenv("STATS_POOL_SIZE", POOL_SIZE)),
+                        get_connection_string(),
+                        options=f"-c statement_timeout={statement_timeout_ms}",
+                    )
+            except Exception as e:
+                logger.error(f"Database connection error: {e}")
+                raise
+        return _pool
+
+
+def close_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def pooled_connection() -> Iterator[psycopg2.extensions.connection]:
+    """Borrows a connection, rolling back whatever the caller left uncommitted."""
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        pool.putconn(conn)
+
+
+def server_side_cursor(conn, name: str, fetch_size: Optional[int] = None):
+    """
+    Named cursor: rows stay on the server and iterating it fetches
+    `fetch_size` rows per round trip instead of the whole result.
+    """
+    cursor = conn.cursor(name=name)
+    cursor.itersize = fetch_size or int(os.getenv("STATS_FETCH_SIZE", FETCH_SIZE))
+    return cursor
+
+
+def iter_new_users(db, period: Dict[str, datetime]) -> Iterator[Dict[str, str]]:
+    """
+    Same as get_new_users, yielding users as rows are read from the cursor.
     """
     try:
 
@@ -46,36 +121,59 @@ def get_new_users(db, period: Dict[str, datetime]) -> Dict[str, str]:
         """
         db.execute(query, (period["start_date"], period["end_date"]))
 
-        users = []
-        for row in db.fetchall():
+        for row in db:
             user_id, user_email, username, organization = row
             # Use username if available, otherwise email
             display_name = username if username else user_email
-            users.append({
+            yield {
                 "user_id": user_id,
                 "username": display_name,
                 "user_email": user_email,
                 "organization": organization
-            })
-
-        return users
+            }
 
     except Exception as e:
         logger.error(f"Error fetching new users: {e}")
         raise
 
 
-def get_conversations(db, period: Dict[str, datetime]) -> Dict[str, Any]:
+def get_new_users(db, period: Dict[str, datetime]) -> List[Dict[str, str]]:
     """
+    Fetch users who registered within the last specified number of days.
     Args:
         db: database cursor to execute queries
         period: {start_date, end_date}
     Returns:
-        Array of conversation objects sorted by last_message_created
+        Array of user objects
+    """
+    return list(iter_new_users(db, period))
+
+
+def get_message_types(db) -> List[str]:
+    db.execute("SELECT DISTINCT type FROM messages;")
+    return [row[0] for row in db.fetchall()]
+
+
+def iter_conversations(
+    db,
+    period: Dict[str, datetime],
+    message_types: List[str],
+    use_rollup: bool = True,
+) -> Iterator[Dict[str, Any]]:
     """
+    Yields conversation objects as rows are read from the cursor. The
+    message types (and the rollup) must be prepared beforehand, so `db`
+    can be a server-side cursor that only ever runs this one query.
+    """
+    if use_rollup:
+        try:
+            yield from rollup.iter_conversations(db, period, message_types)
+        except Exception as e:
+            logger.error(f"Error retrieving conversation data from rollup: {e}")
+            raise
+        return
+
     try:
-        db.execute("SELECT DISTINCT type FROM messages;")
-        message_types = [row[0] for row in db.fetchall()]
         # dynamic query to retrieve all message type count
         query = """
         SELECT 
@@ -105,8 +203,7 @@ def get_conversations(db, period: Dict[str, datetime]) -> Dict[str, Any]:
 
         db.execute(query, (period["start_date"],period["end_date"]))
 
-        conversations = []
-        for row in db.fetchall():
+        for row in db:
             conversation = {
                 "user_id": row[0],
                 "username": row[1],
@@ -116,91 +213,337 @@ def get_conversations(db, period: Dict[str, datetime]) -> Dict[str, Any]:
             }
             counts = {}
             for i in range(len(message_types)):
-                counts[message_types[i]] = row[i + 3]
+                counts[message_types[i]] = row[i + 4]
             conversation["counts"] = counts
-            conversations.append(conversation)
-        return conversations
+            yield conversation
         
     except Exception as e:
         logger.error(f"Error retrieving conversation data: {e}")
         raise
 
 
+def get_conversations(db, period: Dict[str, datetime], use_rollup: bool = True) -> List[Dict[str, Any]]:
+    """
+    Args:
+        db: database cursor to execute queries
+        period: {start_date, end_date}
+        use_rollup: sum the daily rollup (extending it first) instead of
+            scanning all messages of the period's conversations
+    Returns:
+        Array of conversation objects sorted by last_message_created
+    """
+    if use_rollup:
+        rollup.extend_rollup(db, period["start_date"])
+        message_types = rollup.get_message_types(db)
+    else:
+        message_types = get_message_types(db)
+    return list(iter_conversations(db, period, message_types, use_rollup=use_rollup))
+
+
 # ================================================================== #
 # Retrieval and Export
 # ================================================================== #
-def get_data(days: int = 7) -> Dict[str, Any]:
-    try:
-        db_user = os.getenv("PG_USER")
-        db_pass = os.getenv("PG_PASS")
-        db_host = os.getenv("PG_HOST")
-        db_port = os.getenv("PG_PORT")
-        db_name = os.getenv("PG_DB")
-        
-        if not all([db_user, db_pass, db_host, db_port, db_name]):
-            raise ValueError("Missing database connection parameters in environment variables")
+def get_connection_string() -> str:
+    db_user = os.getenv("PG_USER")
+    db_pass = os.getenv("PG_PASS")
+    db_host = os.getenv("PG_HOST")
+    db_port = os.getenv("PG_PORT")
+    db_name = os.getenv("PG_DB")
+    
+    if not all([db_user, db_pass, db_host, db_port, db_name]):
+        raise ValueError("Missing database connection parameters in environment variables")
+
+    return (
+        f"postgresql://{db_user}:{db_pass}@{db_host}:"
+        f"{db_port}/{db_name}?sslmode=disable"
+    )
 
-        period = {
-            "start_date": datetime.now().date() - timedelta(days=days),
-            "end_date": datetime.now().date()
-        }
 
-        connection_string = (
-            f"postgresql://{db_user}:{db_pass}@{db_host}:"
-            f"{db_port}/{db_name}?sslmode=disable"
-        )
-        conn = get_db_connection(connection_string)
-        db = conn.cursor()
+def get_period(
+    days: int = 7,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+) -> Dict[str, datetime]:
+    end_date = end_date or datetime.now().date()
+    return {
+        "start_date": start_date or end_date - timedelta(days=days),
+        "end_date": end_date
+    }
 
-        new_users = get_new_users(db, period)
-        conversations = get_conversations(db, period)
 
-        db.close()
-        conn.close()
+def rollup_enabled() -> bool:
+    return os.getenv("STATS_ROLLUP", "true").lower() == "true"
 
-        return conversations, new_users
+
+def get_data(
+    days: int = 7,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]]]:
+    """
+    Conversations and new users of the last `days` days, or of
+    [start_date, end_date) when given.
+    """
+    reports = get_reports({"report": get_period(days, start_date, end_date)})
+    return reports["report"]
+
+
+def get_reports(
+    periods: Dict[str, Dict[str, datetime]],
+) -> Dict[str, Tuple[List[Dict[str, Any]], List[Dict[str, str]]]]:
+    """
+    (conversations, new_users) for several named periods at once.
+
+    With the partition cache (STATS_CACHE_DIR), only days not cached yet
+    and today's messages are queried, and every period is assembled from
+    the cached days. Without it, the rollup is extended once for the
+    earliest period, then every query of every period runs concurrently on
+    its own pooled connection, so the wall time is that of the slowest query
+    rather than the sum of all of them.
+    """
+    start_date = min(p["start_date"] for p in periods.values())
+    # Opt-in: without it the rollup and the concurrent queries below answer the reports
+    cache_dir = os.getenv("STATS_CACHE_DIR")
+    if cache_dir:
+        try:
+            cache = partitions.PartitionCache(cache_dir)
+            with pooled_connection() as conn, conn.cursor() as db:
+                with metrics.phase("query_uncached_days"):
+                    fetched = cache.fill(db, start_date)
+                with metrics.phase("query_today_messages"):
+                    today_messages = cache.fetch_today(db)
+            logger.info(f"Fetched {len(fetched)} uncached days from DB")
+            metrics.rows.labels(metrics.job, "", "uncached_days").set(len(fetched))
+            metrics.rows.labels(metrics.job, "", "today_messages").set(today_messages.num_rows)
+
+            reports = {}
+            for name, period in periods.items():
+                with metrics.phase("load_partitions", name):
+                    reports[name] = cache.get_report(period, today_messages)
+                record_rows(name, *reports[name])
+            return reports
+        except Exception as e:
+            logger.error(f"Failed to retrieve data through the partition cache: {e}")
+            raise
+
+    try:
+        use_rollup = rollup_enabled()
+        with pooled_connection() as conn, conn.cursor() as db, metrics.phase("query_message_types"):
+            if use_rollup:
+                rollup.ensure_schema(db)
+                rollup.extend_rollup(db, start_date)
+                message_types = rollup.get_message_types(db)
+            else:
+                message_types = get_message_types(db)
+
+        def run(query, phase, name, period):
+            with pooled_connection() as conn, conn.cursor() as db, metrics.phase(phase, name):
+                return list(query(db, period))
+
+        def conversations(db, period):
+            return iter_conversations(db, period, message_types, use_rollup=use_rollup)
+
+        # One worker per pooled connection, more would exhaust the pool
+        with ThreadPoolExecutor(max_workers=get_pool().maxconn) as executor:
+            futures = {
+                name: (
+                    executor.submit(run, conversations, "query_conversations", name, period),
+                    executor.submit(run, iter_new_users, "query_new_users", name, period),
+                )
+                for name, period in periods.items()
+            }
+            reports = {
+                name: (conversations_future.result(), users_future.result())
+                for name, (conversations_future, users_future) in futures.items()
+            }
+        for name, report in reports.items():
+            record_rows(name, *report)
+        return reports
     except Exception as e:
         logger.error(f"Failed to retrieve data: {e}")
         raise
 
 
+def record_rows(kind: str, conversations: List[Dict[str, Any]], new_users: List[Dict[str, str]]) -> None:
+    metrics.rows.labels(metrics.job, kind, "conversations").set(len(conversations))
+    metrics.rows.labels(metrics.job, kind, "new_users").set(len(new_users))
+
+
+@contextmanager
+def stream_data(
+    days: int = 7,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    fetch_size: Optional[int] = None,
+    use_rollup: Optional[bool] = None,
+) -> Iterator[Tuple[Iterator[Dict[str, Any]], Iterator[Dict[str, str]]]]:
+    """
+    Streaming get_data: yields (conversations, new_users) iterators backed by
+    server-side cursors, so only `fetch_size` rows (STATS_FETCH_SIZE) are
+    held in memory at a time. Both iterators are single-use and only valid
+    inside the block. `use_rollup` defaults to STATS_ROLLUP; with False
+    nothing is written to the database.
+
+        with stream_data(days=30) as (conversations, new_users):
+            html = UsageSummary(conversations, new_users).generate_html_email()
+    """
+    period = get_period(days, start_date, end_date)
+    if use_rollup is None:
+        use_rollup = rollup_enabled()
+    try:
+        with pooled_connection() as conn:
+            # Everything that commits runs before the named cursors are opened,
+            # since a commit would close them
+            with conn.cursor() as db:
+                if use_rollup:
+                    rollup.ensure_schema(db)
+                    rollup.extend_rollup(db, period["start_date"])
+                    message_types = rollup.get_message_types(db)
+                else:
+                    message_types = get_message_types(db)
+
+            conversations = iter_conversations(
+                server_side_cursor(conn, "usage_conversations", fetch_size),
+                period,
+                message_types,
+                use_rollup=use_rollup,
+            )
+            new_users = iter_new_users(server_side_cursor(conn, "usage_new_users", fetch_size), period)
+            yield conversations, new_users
+    except Exception as e:
+        logger.error(f"Failed to stream data: {e}")
+        raise
+
+
 # ================================================================== #
-# Test/Export data into JSON
+# Export
 # ================================================================== #
-def export_weekly_data(output_file: str = "user_data_export.json") -> str:
+EXPORT_FORMATS = {"ndjson": ".ndjson.gz", "parquet": ".parquet"}
+# Rows per Parquet row group, and between progress lines
+EXPORT_BATCH_ROWS = 50000
+
+EXPORT_SCHEMAS = {
+    "conversations": pa.schema([
+        ("user_id", pa.string()),
+        ("username", pa.string()),
+        ("conv_id", pa.string()),
+        ("total_message_count", pa.int64()),
+        ("last_message_created", pa.timestamp("us")),
+        ("counts", pa.map_(pa.string(), pa.int64())),
+    ]),
+    "new_users": pa.schema([
+        ("user_id", pa.string()),
+        ("username", pa.string()),
+        ("user_email", pa.string()),
+        ("organization", pa.string()),
+    ]),
+}
+
+
+def to_export_row(table: str, row: Dict[str, Any]) -> Dict[str, Any]:
+    row = {**row, "user_id": str(row["user_id"])}
+    if table == "conversations":
+        row["conv_id"] = str(row["conv_id"])
+        row["counts"] = list(row["counts"].items())
+    return row
+
+
+def write_ndjson(path: str, table: str, rows: Iterator[Dict[str, Any]]) -> Iterator[int]:
+    """Writes one JSON object per line, yielding the row count after every batch."""
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, default=str))
+            f.write("\n")
+            count += 1
+            if count % EXPORT_BATCH_ROWS == 0:
+                yield count
+    if count % EXPORT_BATCH_ROWS or not count:
+        yield count
+
+
+def write_parquet(path: str, table: str, rows: Iterator[Dict[str, Any]]) -> Iterator[int]:
+    """Writes zstd Parquet one row group per batch, yielding the row count after every batch."""
+    schema = EXPORT_SCHEMAS[table]
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        while True:
+            batch = [to_export_row(table, row) for row in itertools.islice(rows, EXPORT_BATCH_ROWS)]
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            count += len(batch)
+            yield count
+
+
+def export_data(
+    output_dir: str = "export",
+    format: str = "ndjson",
+    days: int = 7,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    fetch_size: Optional[int] = None,
+) -> Dict[str, str]:
+    """
+    Streams the conversations and new users of [start_date, end_date) (or
+    of the last `days` days) from server-side cursors into one file per
+    table, ndjson (gzipped, nested counts) or parquet (zstd, counts as a
+    map). Only `fetch_size` rows plus one batch are in memory at a time.
+    Rows are read from the raw tables: the rollup is never extended, so an
+    export of a long-past range does not turn into a backfill.
+    Returns:
+        The written file of each table
+    """
+    write = {"ndjson": write_ndjson, "parquet": write_parquet}[format]
+    period = get_period(days, start_date, end_date)
+    os.makedirs(output_dir, exist_ok=True)
+    name = f"{period['start_date']:%Y%m%d}_{period['end_date']:%Y%m%d}"
+
     try:
-        days = 3
-        conversations, users = get_data(days)
-        data = {
-            "conversations": conversations,
-            "new_users": users
-        }
-
-        with open(output_file, "w") as f:
-            json.dump(data, f, indent=2, default=str)
-            
-        logger.info(f"Data successfully exported to {output_file}")
-        return output_file
-        
+        files = {}
+        with stream_data(days, start_date, end_date, fetch_size, use_rollup=False) as (conversations, new_users):
+            for table, rows in (("conversations", conversations), ("new_users", new_users)):
+                path = os.path.join(output_dir, f"{table}_{name}{EXPORT_FORMATS[format]}")
+                start = time.perf_counter()
+                count = 0
+                # Written under a temporary name, so a failed export never leaves a truncated file behind
+                for count in write(f"{path}.tmp", table, rows):
+                    elapsed = time.perf_counter() - start
+                    logger.info(f"{table}: {count} rows, {count / max(elapsed, 1e-9):.0f} rows/s")
+                os.replace(f"{path}.tmp", path)
+                logger.info(f"Exported {count} {table} to {path} in {time.perf_counter() - start:.1f}s")
+                files[table] = path
+        return files
     except Exception as e:
-        logger.error(f"Failed to export weekly data: {e}")
+        logger.error(f"Failed to export data: {e}")
         raise
 
 
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser("iChatBio usage export")
+    parser.add_argument("--start", type=parse_date, help="First day (YYYY-MM-DD), default --days before --end")
+    parser.add_argument("--end", type=parse_date, help="Day after the last exported day (YYYY-MM-DD), default today")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="ndjson")
+    parser.add_argument("--output-dir", default="export")
+    parser.add_argument("--fetch-size", type=int, help="Rows per round trip, default STATS_FETCH_SIZE")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        handlers=[logging.StreamHandler()]
+    )
+    load_dotenv(".chat.env")
     try:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            handlers=[logging.StreamHandler()]
-        )
-        logger = logging.getLogger(__name__)
-
-        load_dotenv(".chat.env")
-        logger.info("Running in standalone mode for testing")
-        
-        output_file = export_weekly_data()
-        logger.info(f"Test export completed: {output_file}")
-        
+        files = export_data(args.output_dir, args.format, args.days, args.start, args.end, args.fetch_size)
+        logger.info(f"Export completed: {', '.join(files.values())}")
     except Exception as e:
         logger.error(f"Error in main execution: {e}")
+        sys.exit(1)
+    finally:
+        close_pool()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The cron's modules are imported by name, as when run from its directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
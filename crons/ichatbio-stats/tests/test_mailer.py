@@ -0,0 +1,148 @@
+import smtplib
+import socketserver
+import threading
+from email.mime.text import MIMEText
+
+import pytest
+
+from mailer import Mailer, SmtpPool, is_transient
+
+SENDER = "stats@example.org"
+
+
+class SmtpSession(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib's sendmail."""
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply("220 stand-in ready")
+        recipients = []
+        while line := self.rfile.readline():
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250 stand-in")
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                address = command.split(":", 1)[1].strip().strip("<>")
+                with server.lock:
+                    codes = server.refuse.get(address)
+                    code = codes.pop(0) if codes else None
+                    server.attempts[address] = server.attempts.get(address, 0) + 1
+                if code:
+                    self.reply(f"{code} refused")
+                else:
+                    recipients.append(address)
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 go ahead")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with server.lock:
+                    server.delivered.extend(recipients)
+                    drop = server.drops > 0
+                    server.drops -= drop
+                self.reply("250 queued")
+                if drop:
+                    # Gone without a QUIT, as when the server times out an idle connection
+                    return
+            elif verb == "RSET":
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("502 not implemented")
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+
+class SmtpStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), SmtpSession)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.delivered = []
+        self.attempts = {}
+        # address -> reply codes for its next RCPTs
+        self.refuse = {}
+        # Connections to drop after their next message
+        self.drops = 0
+
+
+@pytest.fixture
+def smtp_server():
+    server = SmtpStandIn()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def send_all(server, recipients, pool_size=2):
+    pool = SmtpPool("127.0.0.1", server.server_address[1], size=pool_size, timeout=5)
+    mailer = Mailer(pool, SENDER, retry_attempts=3, retry_delay=0)
+    try:
+        return mailer.send_all(recipients, lambda recipient: MIMEText(f"Hello {recipient}"))
+    finally:
+        mailer.close()
+
+
+def recipients(n):
+    return [f"user{i}@example.org" for i in range(n)]
+
+
+def test_connections_are_reused(smtp_server):
+    assert send_all(smtp_server, recipients(10), pool_size=2) == {}
+    assert sorted(smtp_server.delivered) == sorted(recipients(10))
+    assert smtp_server.connections <= 2
+
+
+def test_dropped_connection_is_replaced(smtp_server):
+    smtp_server.drops = 1
+    assert send_all(smtp_server, recipients(3), pool_size=1) == {}
+    assert sorted(smtp_server.delivered) == sorted(recipients(3))
+    assert smtp_server.connections == 2
+
+
+def test_partial_recipient_failure(smtp_server):
+    to = recipients(3)
+    smtp_server.refuse = {to[0]: [550], to[1]: [450]}
+    failed = send_all(smtp_server, to)
+    # The permanent refusal is reported without retrying, the transient one goes through on retry
+    assert list(failed) == [to[0]]
+    assert isinstance(failed[to[0]], smtplib.SMTPRecipientsRefused)
+    assert smtp_server.attempts[to[0]] == 1
+    assert smtp_server.attempts[to[1]] == 2
+    assert sorted(smtp_server.delivered) == sorted(to[1:])
+
+
+def test_transient_failure_gives_up_after_retry_attempts(smtp_server):
+    to = recipients(1)
+    smtp_server.refuse = {to[0]: [451] * 5}
+    failed = send_all(smtp_server, to)
+    assert list(failed) == to
+    assert smtp_server.attempts[to[0]] == 3
+
+
+@pytest.mark.parametrize("error, transient", [
+    (smtplib.SMTPRecipientsRefused({"a@example.org": (450, b"busy")}), True),
+    (smtplib.SMTPRecipientsRefused({"a@example.org": (550, b"no such user")}), False),
+    (smtplib.SMTPDataError(421, b"closing"), True),
+    (smtplib.SMTPSenderRefused(553, b"bad sender", SENDER), False),
+    (smtplib.SMTPAuthenticationError(535, b"bad credentials"), False),
+    (smtplib.SMTPServerDisconnected("gone"), True),
+    (smtplib.SMTPNotSupportedError("no STARTTLS"), False),
+    (ConnectionRefusedError(), True),
+    (TimeoutError(), True),
+    (ValueError("bad message"), False),
+])
+def test_is_transient(error, transient):
+    assert is_transient(error) == transient
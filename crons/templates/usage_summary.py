@@ -1,7 +1,13 @@
-from jinja2 import Template
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
 from datetime import datetime, timedelta
 from dataclasses import dataclass
-from typing import List, Dict
+from typing import Iterable, Iterator, List, Dict
 from enum import Enum
 
 @dataclass
@@ -25,11 +31,406 @@ class User:
     user_email: str = ""
     organization: str = ""
 
+# Rows and cards are rendered on their own so the (possibly streamed) users and
+# conversations are consumed once, before the totals in the page header are needed.
+USER_ROWS_TEMPLATE = """
+        {% for user in users %}
+        <tr>
+            <td>{{ user.user_email }}</td>
+            <td>
+                <a href="https://ichatbio.org/admin#/user/{{ user.user_id }}" target="_blank">
+                {{ user.username }}
+                </a>
+            </td>
+            <td>{{ user.organization }}</td>
+        </tr>
+        {% endfor %}
+"""
+
+CONVERSATION_CARDS_TEMPLATE = """
+        {% for conv in conversations %}
+        <div class="conversation-card">
+            <div class="conversation-header">
+                <div class="id-info">
+                    <p><strong>User:</strong> 
+                        <a href="https://ichatbio.org/admin#/user/{{ conv.user_id }}" target="_blank">
+                        <u>{{ conv.username }}</u>
+                        </a>
+                    </p>
+                    <p><strong>Conversation ID:</strong> {{ conv.conv_id }}</p>
+                    <p><strong>Date:</strong> {{ conv.last_message_created }}</p>
+                </div>
+            </div>
+            <div class="message-count">{{ conv.counts["user_text_message"] }} user messages</div>
+        </div>
+        {% endfor %}
+"""
+
+EMAIL_TEMPLATE = """
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <style>
+    body { 
+        font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, 'Open Sans', 'Helvetica Neue', sans-serif; 
+        line-height: 1.5; 
+        color: #1a1a1a; 
+        margin: 0; 
+        padding: 0; 
+        background-color: #ffffff;
+    }
+    .container {
+        max-width: 600px;
+        margin: 1rem auto;
+        padding: 1rem;
+        border: 0.0625rem solid #e0e0e0;
+        border-radius: 0.5rem;
+    }
+    .header { 
+        text-align: center; 
+        margin-bottom: 1.5rem; 
+    }
+    .header h1 { 
+        color: #000000; 
+        font-size: 1.4rem; 
+        margin-bottom: 0.5rem; 
+    }
+    .header p { 
+        color: #666; 
+        font-size: 0.875rem; 
+        margin: 0;
+    }
+    .overview-section {
+        background-color: #f9f9f9; 
+        border-radius: 0.5rem; 
+        padding: 1rem; 
+        margin-bottom: 1rem;
+    }
+    .overview-stats {
+        display: flex;
+        flex-wrap: wrap;
+        justify-content: space-between;
+        text-align: center;
+    }
+    .stat {
+        flex: 1;
+        min-width: 20%;
+        margin: 0.5rem 0;
+    }
+    .stat-value {
+        font-size: 1.5rem; 
+        font-weight: bold; 
+        color: #000000;
+    }
+    .stat-label {
+        color: #666;
+        font-size: 0.8rem;
+        margin-top: 0.25rem;
+    }
+    .table {
+        width: 100%;
+        border-collapse: collapse;
+        margin-bottom: 1rem;
+        table-layout: fixed;
+    }
+    .table th, 
+    .table td {
+        border: 1px solid #e0e0e0;
+        padding: 0.5rem;
+        font-size: 0.875rem;
+        word-wrap: break-word;
+        overflow-wrap: break-word;
+    }
+    .table th {
+        background-color: #f0f0f0;
+        font-weight: 600;
+        text-align: left;
+    }
+    .new-conversations {
+        margin-top: 1rem;
+    }
+    .conversation-card {
+        width: full;
+        display: flex;
+        justify-content: space-between;
+        align-items: center;
+        background-color: #f0f0f0;
+        border-radius: 0.5rem;
+        margin-bottom: 0.75rem;
+        padding: 0.75rem;
+    }
+    .conversation-header {
+        display: flex;
+        flex-direction: column;
+    }
+    .conversation-meta {
+        font-size: 0.75rem;
+        color: #666;
+        margin-bottom: 0.25rem;
+        font-family: monospace;
+    }
+    .conversation-meta strong {
+        color: #000;
+    }
+    .message-count {
+        font-weight: bold;
+        padding: 0.25rem 0.5rem;
+        border-radius: 1rem;
+        font-size: 0.75rem;
+        margin-top: 0.25rem;
+        display: inline-block;
+    }
+    .metrics-section {
+        margin-top: 1.5rem;
+        padding: 0;
+    }
+    .footer {
+        text-align: center;
+        color: #666;
+        margin-top: 1.5rem;
+        font-size: 0.75rem;
+    }
+    .id-info {
+        font-size: 0.75rem;
+        color: #666;
+        font-family: monospace;
+    }
+    .id-info p {
+        margin: 0 0 0.25rem 0;
+    }
+    h2 {
+        color: #000000; 
+        font-size: 1.1rem; 
+        margin: 1rem 0 0.75rem 0;
+    }
+    .more {
+        color: #666;
+        font-size: 0.8rem;
+        text-align: center;
+    }
+    .empty {
+        width: full;
+        display: flex;
+        justify-content: center;
+        color: #666;
+        align-items: center;
+        font-size: 1.1rem;
+    }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>iChatBio - {{ kind }} User Activity</h1>
+            {% if kind == 'Weekly' %}
+                <p><u>{{ period.start }} - {{ period.end }}</u></p>
+            {% else %}
+                <p><u>{{ period.start }}</u></p>
+            {% endif %}
+        </div>
+        <div class="overview-section">
+            <div class="overview-stats">
+                <div class="stat">
+                    <div class="stat-value">{{ total_users }}</div>
+                    <div class="stat-label">Sign Ups</div>
+                </div>
+                <div class="stat">
+                    <div class="stat-value">{{ total_conversations }}</div>
+                    <div class="stat-label">New Conversations</div>
+                </div>
+                <div class="stat">
+                    <div class="stat-value">{{ total_messages }}</div>
+                    <div class="stat-label">User Messages</div>
+                </div>
+            </div>
+        </div>
+
+        {% if trends %}
+        <h2>Trends</h2>
+        <table class="table">
+            <thead>
+                <tr>
+                    <th width="34%">Metric</th>
+                    <th width="16%">{{ kind }}</th>
+                    <th width="16%">Week Ago</th>
+                    <th width="16%">Change</th>
+                    <th width="18%">30-Day Avg</th>
+                </tr>
+            </thead>
+            <tbody>
+                {% for trend in trends %}
+                <tr>
+                    <td>{{ trend.label }}</td>
+                    <td>{{ trend.value }}</td>
+                    <td>{{ trend.week_ago if trend.week_ago is not none else "-" }}</td>
+                    <td>{{ "%+.1f%%" % trend.change_pct if trend.change_pct is not none else "-" }}</td>
+                    <td>{{ trend.mean_30d if trend.mean_30d is not none else "-" }}</td>
+                </tr>
+                {% endfor %}
+            </tbody>
+        </table>
+        {% endif %}
+
+        <h2>New Users</h2>
+        <table class="table">
+            <thead>
+                <tr>
+                    <th width="35%">Email</th>
+                    <th width="30%">Profile</th>
+                    <th width="35%">Organization</th>
+                </tr>
+            </thead>
+            <tbody>
+                {{ users_html }}
+                {% if more_users %}
+                <tr>
+                    <td colspan="3" class="more">&hellip; and {{ more_users }} more, listed in the attached {{ users_csv }}</td>
+                </tr>
+                {% endif %}
+            </tbody>
+        </table>
+
+        <h2>User Conversations</h2>
+        <div class="new-conversations">
+            {{ conversations_html }}
+            {% if more_conversations %}
+            <div class="more">&hellip; and {{ more_conversations }} more, listed in the attached {{ conversations_csv }}</div>
+            {% endif %}
+        </div>
+
+        <div class="metrics-section overview-section">
+            <h2>Messaging Metrics</h2>
+            <table class="table">
+                <thead>
+                    <tr>
+                        <th width="70%">Message Type</th>
+                        <th width="30%">Count</th>
+                    </tr>
+                </thead>
+                <tbody>
+                    {% for type, metric in message_metrics.items() %}
+                    <tr>
+                        <td>{{ type }}</td>
+                        <td>{{ metric.count }}</td>
+                    </tr>
+                    {% endfor %}
+                </tbody>
+            </table>
+        </div>
+        <div class="footer">
+            <p>This is an automated summary generated on {{ generation_date }}</p>
+            <p>&copy; 2025 <a href="https://www.acis.ufl.edu" target="_blank">www.acis.ufl.edu</a></p>         
+        </div>
+    </div>
+</body>
+</html>
+"""
+
+# Compiled once per process; the bytecode cache also spares new processes
+# (every cron run) from recompiling the templates
+ENV = Environment(
+    loader=DictLoader({
+        "usage_summary.html": EMAIL_TEMPLATE,
+        "user_rows.html": USER_ROWS_TEMPLATE,
+        "conversation_cards.html": CONVERSATION_CARDS_TEMPLATE,
+    }),
+    bytecode_cache=FileSystemBytecodeCache(os.getenv("JINJA_BYTECODE_CACHE") or None),
+)
+EMAIL = ENV.get_template("usage_summary.html")
+USER_ROWS = ENV.get_template("user_rows.html")
+CONVERSATION_CARDS = ENV.get_template("conversation_cards.html")
+
+# Rows shown in the email, the full lists are attached as gzipped CSV
+MAX_ROWS = 50
+USERS_CSV = "new_users.csv.gz"
+CONVERSATIONS_CSV = "conversations.csv.gz"
+# Spooled rows stay in memory up to this size, then move to a temporary file
+SPOOL_MAX_BYTES = 1 << 20
+
+
+class SpooledCsv:
+    """
+    Rows are spooled as JSON lines and the CSV is written once all of them
+    are known, so the header can cover columns that only show up late.
+    """
+    FIELDS: List[str] = []
+
+    def __init__(self):
+        self.rows = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES, mode="w+", encoding="utf-8")
+
+    def fieldnames(self) -> List[str]:
+        return self.FIELDS
+
+    def spool(self, row: Dict) -> None:
+        self.rows.write(json.dumps(row, default=str) + "\n")
+
+    def gzipped(self) -> bytes:
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode="wb") as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8", newline="") as stream:
+                writer = csv.DictWriter(stream, fieldnames=self.fieldnames(), restval=0)
+                writer.writeheader()
+                self.rows.seek(0)
+                for line in self.rows:
+                    writer.writerow(json.loads(line))
+        return buffer.getvalue()
+
+    def close(self) -> None:
+        self.rows.close()
+
+
+class UserCsv(SpooledCsv):
+    FIELDS = ["user_id", "username", "user_email", "organization"]
+
+    def write(self, user: User) -> None:
+        self.spool({field: user.get(field) for field in self.FIELDS})
+
+
+class ConversationCsv(SpooledCsv):
+    FIELDS = ["conv_id", "user_id", "username", "last_message_created", "total_message_count"]
+
+    def __init__(self):
+        super().__init__()
+        # Every message type seen, in order of first appearance
+        self.message_types: Dict[str, None] = {}
+
+    def fieldnames(self) -> List[str]:
+        return self.FIELDS + list(self.message_types)
+
+    def write(self, conv: Conversation) -> None:
+        for message_type in conv["counts"]:
+            self.message_types.setdefault(message_type, None)
+        self.spool({**{field: conv.get(field) for field in self.FIELDS}, **conv["counts"]})
+
+
 class UsageSummary:
-    def __init__(self, conversations: List[Conversation], users: List[User] = None, kind='Weekly'):
+    """
+    Conversations and users may be lists or one-shot iterators (e.g. streamed
+    from a server-side cursor); generate_html_email reads them exactly once.
+    """
+    def __init__(
+        self,
+        conversations: Iterable[Conversation],
+        users: Iterable[User] = None,
+        kind='Weekly',
+        max_rows: int = MAX_ROWS,
+        history=None,
+    ):
         self.conversations = conversations or []
         self.users = users or []
+        self.max_rows = max_rows
+        # Anything with trends(kind, aggregates) -> rows, e.g. ichatbio-stats' History
+        self.history = history
+        self.trends: List[Dict] = []
+        # Gzipped CSVs of the lists that were cut short, set by generate_html_email
+        self.attachments: Dict[str, bytes] = {}
         self.message_metrics: Dict[str, MessageMetric] = {}
+        self.total_messages = 0
+        self.total_conversations = 0
+        self.total_users = 0
+        self.org_sign_ups: Dict[str, int] = {}
         self.kind = kind
 
     def format_date(self, date: datetime) -> str:
@@ -48,287 +449,100 @@ class UsageSummary:
             "end": end_date.strftime("%B %d, %Y")
         }
 
-    def analyze_message_metrics(self) -> Dict[str, MessageMetric]:
-        metrics: Dict[str, MessageMetric] = {}
-        for conv in self.conversations:
+    def aggregate(self, conversations: Iterable[Conversation]) -> Iterator[Conversation]:
+        """Passes conversations through, adding each to the totals and message metrics."""
+        for conv in conversations:
+            self.total_conversations += 1
+            self.total_messages += conv["counts"].get("user_text_message", 0)
             for message_type, count in conv["counts"].items():
-                if message_type not in metrics:
-                    metrics[message_type] = MessageMetric(
-                        type=message_type,
-                        count=count,
-                    )
+                metric = self.message_metrics.get(message_type)
+                if metric is None:
+                    self.message_metrics[message_type] = MessageMetric(type=message_type, count=count)
                 else:
-                    metrics[message_type].count += count
+                    metric.count += count
+            yield conv
+
+    def count_users(self, users: Iterable[User]) -> Iterator[User]:
+        for user in users:
+            self.total_users += 1
+            organization = user.get("organization") or ""
+            self.org_sign_ups[organization] = self.org_sign_ups.get(organization, 0) + 1
+            yield user
+
+    def top(self, items: Iterable, n: int, full_list) -> Iterator:
+        """Yields the first n items but reads (and writes to full_list) all of them."""
+        for i, item in enumerate(items):
+            full_list.write(item)
+            if i < n:
+                yield item
+
+    def reset_totals(self) -> None:
+        self.message_metrics = {}
+        self.total_messages = 0
+        self.total_conversations = 0
+        self.total_users = 0
+        self.org_sign_ups = {}
+
+    def aggregates(self) -> Dict:
+        """The report's totals, as recorded in the history for trends."""
+        return {
+            "sign_ups": self.total_users,
+            "conversations": self.total_conversations,
+            "user_messages": self.total_messages,
+            "messages": {t: metric.count for t, metric in self.message_metrics.items()},
+            "org_sign_ups": dict(self.org_sign_ups),
+        }
 
-        self.message_metrics = metrics.copy()
+    def analyze_message_metrics(self) -> Dict[str, MessageMetric]:
+        self.reset_totals()
+        for _ in self.aggregate(self.conversations):
+            pass
         return self.message_metrics
-    
-    def get_total_messages(self):
-        total_messages = 0
-        for conv in self.conversations:
-            total_messages += conv["counts"]["user_text_message"]
-        return total_messages
-    
-    def generate_html_email(self) -> str:
 
-        # Jinja2 HTML template
-        template_str = """
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <style>
-            body { 
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, 'Open Sans', 'Helvetica Neue', sans-serif; 
-                line-height: 1.5; 
-                color: #1a1a1a; 
-                margin: 0; 
-                padding: 0; 
-                background-color: #ffffff;
-            }
-            .container {
-                max-width: 600px;
-                margin: 1rem auto;
-                padding: 1rem;
-                border: 0.0625rem solid #e0e0e0;
-                border-radius: 0.5rem;
-            }
-            .header { 
-                text-align: center; 
-                margin-bottom: 1.5rem; 
-            }
-            .header h1 { 
-                color: #000000; 
-                font-size: 1.4rem; 
-                margin-bottom: 0.5rem; 
-            }
-            .header p { 
-                color: #666; 
-                font-size: 0.875rem; 
-                margin: 0;
-            }
-            .overview-section {
-                background-color: #f9f9f9; 
-                border-radius: 0.5rem; 
-                padding: 1rem; 
-                margin-bottom: 1rem;
-            }
-            .overview-stats {
-                display: flex;
-                flex-wrap: wrap;
-                justify-content: space-between;
-                text-align: center;
-            }
-            .stat {
-                flex: 1;
-                min-width: 20%;
-                margin: 0.5rem 0;
-            }
-            .stat-value {
-                font-size: 1.5rem; 
-                font-weight: bold; 
-                color: #000000;
-            }
-            .stat-label {
-                color: #666;
-                font-size: 0.8rem;
-                margin-top: 0.25rem;
-            }
-            .table {
-                width: 100%;
-                border-collapse: collapse;
-                margin-bottom: 1rem;
-                table-layout: fixed;
-            }
-            .table th, 
-            .table td {
-                border: 1px solid #e0e0e0;
-                padding: 0.5rem;
-                font-size: 0.875rem;
-                word-wrap: break-word;
-                overflow-wrap: break-word;
-            }
-            .table th {
-                background-color: #f0f0f0;
-                font-weight: 600;
-                text-align: left;
-            }
-            .new-conversations {
-                margin-top: 1rem;
-            }
-            .conversation-card {
-                width: full;
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                background-color: #f0f0f0;
-                border-radius: 0.5rem;
-                margin-bottom: 0.75rem;
-                padding: 0.75rem;
-            }
-            .conversation-header {
-                display: flex;
-                flex-direction: column;
-            }
-            .conversation-meta {
-                font-size: 0.75rem;
-                color: #666;
-                margin-bottom: 0.25rem;
-                font-family: monospace;
-            }
-            .conversation-meta strong {
-                color: #000;
-            }
-            .message-count {
-                font-weight: bold;
-                padding: 0.25rem 0.5rem;
-                border-radius: 1rem;
-                font-size: 0.75rem;
-                margin-top: 0.25rem;
-                display: inline-block;
-            }
-            .metrics-section {
-                margin-top: 1.5rem;
-                padding: 0;
-            }
-            .footer {
-                text-align: center;
-                color: #666;
-                margin-top: 1.5rem;
-                font-size: 0.75rem;
-            }
-            .id-info {
-                font-size: 0.75rem;
-                color: #666;
-                font-family: monospace;
-            }
-            .id-info p {
-                margin: 0 0 0.25rem 0;
-            }
-            h2 {
-                color: #000000; 
-                font-size: 1.1rem; 
-                margin: 1rem 0 0.75rem 0;
-            }
-            .empty {
-                width: full;
-                display: flex;
-                justify-content: center;
-                color: #666;
-                align-items: center;
-                font-size: 1.1rem;
-            }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h1>iChatBio - {{ kind }} User Activity</h1>
-                    {% if kind == 'Weekly' %}
-                        <p><u>{{ period.start }} - {{ period.end }}</u></p>
-                    {% else %}
-                        <p><u>{{ period.start }}</u></p>
-                    {% endif %}
-                </div>
-                <div class="overview-section">
-                    <div class="overview-stats">
-                        <div class="stat">
-                            <div class="stat-value">{{ total_users }}</div>
-                            <div class="stat-label">Sign Ups</div>
-                        </div>
-                        <div class="stat">
-                            <div class="stat-value">{{ total_conversations }}</div>
-                            <div class="stat-label">New Conversations</div>
-                        </div>
-                        <div class="stat">
-                            <div class="stat-value">{{ total_messages }}</div>
-                            <div class="stat-label">User Messages</div>
-                        </div>
-                    </div>
-                </div>
+    def get_total_messages(self):
+        self.analyze_message_metrics()
+        return self.total_messages
 
-                <h2>New Users</h2>
-                <table class="table">
-                    <thead>
-                        <tr>
-                            <th width="35%">Email</th>
-                            <th width="30%">Profile</th>
-                            <th width="35%">Organization</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {% for user in users %}
-                        <tr>
-                            <td>{{ user.user_email }}</td>
-                            <td>
-                                <a href="https://ichatbio.org/admin#/user/{{ user.user_id }}" target="_blank">
-                                {{ user.username }}
-                                </a>
-                            </td>
-                            <td>{{ user.organization }}</td>
-                        </tr>
-                        {% endfor %}
-                    </tbody>
-                </table>
-
-                <h2>User Conversations</h2>
-                <div class="new-conversations">
-                    {% for conv in conversations %}
-                    <div class="conversation-card">
-                        <div class="conversation-header">
-                            <div class="id-info">
-                                <p><strong>User:</strong> 
-                                    <a href="https://ichatbio.org/admin#/user/{{ conv.user_id }}" target="_blank">
-                                    <u>{{ conv.username }}</u>
-                                    </a>
-                                </p>
-                                <p><strong>Conversation ID:</strong> {{ conv.conv_id }}</p>
-                                <p><strong>Date:</strong> {{ conv.last_message_created }}</p>
-                            </div>
-                        </div>
-                        <div class="message-count">{{ conv.counts["user_text_message"] }} user messages</div>
-                    </div>
-                    {% endfor %}
-                </div>
+    def generate_html_email(self) -> str:
+        # Single pass over the inputs: the sections are rendered while the
+        # totals are accumulated and the full lists are spooled, then the page
+        # is rendered around them
+        self.reset_totals()
+        users_csv, conversations_csv = UserCsv(), ConversationCsv()
+        try:
+            users_html = USER_ROWS.render(
+                users=self.top(self.count_users(self.users), self.max_rows, users_csv)
+            )
+            conversations_html = CONVERSATION_CARDS.render(
+                conversations=self.top(self.aggregate(self.conversations), self.max_rows, conversations_csv)
+            )
 
-                <div class="metrics-section overview-section">
-                    <h2>Messaging Metrics</h2>
-                    <table class="table">
-                        <thead>
-                            <tr>
-                                <th width="70%">Message Type</th>
-                                <th width="30%">Count</th>
-                            </tr>
-                        </thead>
-                        <tbody>
-                            {% for type, metric in message_metrics.items() %}
-                            <tr>
-                                <td>{{ type }}</td>
-                                <td>{{ metric.count }}</td>
-                            </tr>
-                            {% endfor %}
-                        </tbody>
-                    </table>
-                </div>
-                <div class="footer">
-                    <p>This is an automated summary generated on {{ generation_date }}</p>
-                    <p>&copy; 2025 <a href="https://www.acis.ufl.edu" target="_blank">www.acis.ufl.edu</a></p>         
-                </div>
-            </div>
-        </body>
-        </html>
-        """
+            more_users = max(0, self.total_users - self.max_rows)
+            more_conversations = max(0, self.total_conversations - self.max_rows)
+            self.attachments = {}
+            if more_users:
+                self.attachments[USERS_CSV] = users_csv.gzipped()
+            if more_conversations:
+                self.attachments[CONVERSATIONS_CSV] = conversations_csv.gzipped()
+        finally:
+            users_csv.close()
+            conversations_csv.close()
+        if self.history is not None:
+            self.trends = self.history.trends(self.kind, self.aggregates())
 
-        template = Template(template_str)
-        return template.render(
+        return EMAIL.render(
             period=self.get_reporting_period(),
-            total_users=len(self.users),
-            total_messages=self.get_total_messages(),
-            message_metrics=self.analyze_message_metrics(),
-            users=self.users,
-            total_conversations=len(self.conversations),
-            conversations=self.conversations,
+            total_users=self.total_users,
+            total_messages=self.total_messages,
+            message_metrics=self.message_metrics,
+            trends=self.trends,
+            users_html=users_html,
+            more_users=more_users,
+            users_csv=USERS_CSV,
+            total_conversations=self.total_conversations,
+            conversations_html=conversations_html,
+            more_conversations=more_conversations,
+            conversations_csv=CONVERSATIONS_CSV,
             kind=self.kind,
             generation_date=datetime.now().strftime("%B %d, %Y")
         )
\ No newline at end of file
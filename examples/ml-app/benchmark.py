@@ -0,0 +1,62 @@
+'''
+Images/s of the batched detection path (letterbox + forward + NMS) per batch size.
+
+Runs without Ray or a GPU so batching gains can be measured on any machine:
+
+    python benchmark.py --device cpu --batch-sizes 1,2,4,8,16 --images 64
+'''
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from detection import detect_images
+
+
+def synthetic_images(count: int, seed: int = 0):
+    # Mixed sizes and aspect ratios so letterboxing does real work
+    rng = np.random.default_rng(seed)
+    sizes = [(480, 640), (720, 1280), (1080, 1920), (640, 640), (1200, 800)]
+    return [rng.integers(0, 255, size=(*sizes[i % len(sizes)], 3), dtype=np.uint8) for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser("Batched YOLOv5 detection benchmark")
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--model", default="yolov5s")
+    parser.add_argument("--batch-sizes", default="1,2,4,8,16")
+    parser.add_argument("--images", type=int, default=64, help="Images per batch size")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed batches per batch size")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = torch.hub.load("ultralytics/yolov5", args.model)
+    model.to(device).eval()
+    if device.type == "cuda":
+        model.half()
+    images = synthetic_images(args.images)
+
+    print(f"{'batch':>6} {'images/s':>10} {'ms/batch':>10} {'speedup':>8}")
+    baseline = None
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+        for batch in batches[:args.warmup]:
+            detect_images(model, batch, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+        start = time.perf_counter()
+        for batch in batches:
+            detect_images(model, batch, device)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+        throughput = len(images) / elapsed
+        baseline = baseline or throughput
+        print(f"{batch_size:>6} {throughput:>10.1f} {1000 * elapsed / len(batches):>10.1f} {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+'''
+Batched YOLOv5 pre/post-processing shared by the Serve deployment and benchmark.py.
+
+Images are letterboxed into one (N, 3, size, size) array so a whole batch goes
+through a single forward pass, and the detections are scaled back to each
+image's original coordinates.
+'''
+from io import BytesIO
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import torch
+import torchvision
+from PIL import Image, ImageDraw
+
+INPUT_SIZE = 640
+PAD_VALUE = 114
+
+
+def decode_image(data: bytes) -> np.ndarray:
+    return np.asarray(Image.open(BytesIO(data)).convert("RGB"))
+
+
+def check_image(data: bytes) -> None:
+    """Raises ValueError unless PIL can identify `data` as an intact image
+    (headers and structure only, nothing is decoded)."""
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.verify()
+    except Exception as e:
+        raise ValueError(f"Not a decodable image: {e}") from e
+
+
+def letterbox_batch(images: Sequence[np.ndarray], size: int = INPUT_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Resizes each HWC uint8 image to fit `size` keeping its aspect ratio and
+    pads it into a shared NCHW float32 batch.
+
+    Returns the batch plus per-image scales (N,) and (pad_x, pad_y) offsets (N, 2).
+    """
+    shapes = np.array([image.shape[:2] for image in images], dtype=np.float32)  # (N, 2) as (h, w)
+    scales = np.min(size / shapes, axis=1)
+    resized = np.round(shapes * scales[:, None]).astype(np.int32)
+    pads = (size - resized[:, ::-1]) // 2  # (pad_x, pad_y)
+
+    batch = np.full((len(images), size, size, 3), PAD_VALUE, dtype=np.uint8)
+    for i, image in enumerate(images):
+        h, w = resized[i]
+        x, y = pads[i]
+        batch[i, y:y + h, x:x + w] = np.asarray(Image.fromarray(image).resize((w, h), Image.BILINEAR))
+
+    # One vectorized normalize + layout change for the whole batch
+    batch = np.ascontiguousarray(batch.transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+    return batch, scales, pads.astype(np.float32)
+
+
+def postprocess(
+    pred: torch.Tensor,
+    scales: np.ndarray,
+    pads: np.ndarray,
+    shapes: Sequence[Tuple[int, int]],
+    conf_thres: float = 0.25,
+    iou_thres: float = 0.45,
+    max_det: int = 300,
+) -> List[Dict[str, np.ndarray]]:
+    """Turns raw (N, anchors, 5 + classes) predictions into per-image
+    `boxes` (xyxy, original pixels), `classes` and `scores` arrays."""
+    results = []
+    for i, p in enumerate(pred):
+        p = p[p[:, 4] > conf_thres]
+        cls_conf, cls = (p[:, 5:] * p[:, 4:5]).max(1)
+        keep = cls_conf > conf_thres
+        p, cls_conf, cls = p[keep], cls_conf[keep], cls[keep]
+
+        xy, wh = p[:, :2], p[:, 2:4] / 2
+        boxes = torch.cat([xy - wh, xy + wh], dim=1)
+        keep = torchvision.ops.batched_nms(boxes, cls_conf, cls, iou_thres)[:max_det]
+        boxes, cls_conf, cls = boxes[keep].cpu().numpy(), cls_conf[keep].cpu().numpy(), cls[keep].cpu().numpy()
+
+        # Undo the letterbox and clip to the original image
+        h, w = shapes[i]
+        boxes = (boxes - np.tile(pads[i], 2)) / scales[i]
+        boxes = np.clip(boxes, 0, [w, h, w, h])
+        results.append({
+            "boxes": boxes.astype(np.float32),
+            "classes": cls.astype(np.int32),
+            "scores": cls_conf.astype(np.float32),
+        })
+    return results
+
+
+@torch.inference_mode()
+def detect_images(model, images: Sequence[np.ndarray], device: torch.device) -> List[Dict[str, np.ndarray]]:
+    batch, scales, pads = letterbox_batch(images)
+    tensor = torch.from_numpy(batch).to(device)
+    if next(model.parameters()).dtype == torch.float16:
+        tensor = tensor.half()
+    # AutoShape passes tensors straight to the network, skipping its per-image preprocessing
+    out = model(tensor)
+    pred = out[0] if isinstance(out, (list, tuple)) else out
+    return postprocess(pred.float(), scales, pads, [image.shape[:2] for image in images])
+
+
+def render(image: np.ndarray, detections: Dict[str, np.ndarray], names: Dict[int, str]) -> Image.Image:
+    annotated = Image.fromarray(image)
+    draw = ImageDraw.Draw(annotated)
+    for box, cls, score in zip(detections["boxes"], detections["classes"], detections["scores"]):
+        draw.rectangle(box.tolist(), outline=(255, 56, 56), width=3)
+        draw.text((box[0] + 3, box[1] + 2), f"{names[int(cls)]} {score:.2f}", fill=(255, 255, 255))
+    return annotated
+
+
+def render_jpeg(image: np.ndarray, detections: Dict[str, np.ndarray], names: Dict[int, str], quality: int = 90) -> bytes:
+    file_stream = BytesIO()
+    render(image, detections, names).save(file_stream, "jpeg", quality=quality)
+    return file_stream.getvalue()
+
+
+def detections_to_json(detections: Dict[str, np.ndarray], names: Dict[int, str]) -> Dict[str, List]:
+    return {
+        "boxes": detections["boxes"].round(1).tolist(),
+        "classes": detections["classes"].tolist(),
+        "labels": [names[int(cls)] for cls in detections["classes"]],
+        "scores": detections["scores"].round(4).tolist(),
+    }
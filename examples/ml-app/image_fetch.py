@@ -0,0 +1,128 @@
+'''
+Async image download and a content-addressed detection cache for APIIngress.
+
+Images are fetched on the ingress over a pooled HTTP client, so slow origins
+never hold a GPU replica's batch slot, and identical image bytes (whatever the
+URL) are only run through the model once while they stay in the cache.
+'''
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+
+class FetchError(Exception):
+    """Fetching the image failed; `status_code` is what the ingress answers with."""
+    status_code = 502
+
+
+class ImageTooLarge(FetchError, ValueError):
+    status_code = 413
+
+
+class ImageFetcher:
+    """Downloads images with a shared connection pool, a concurrency limit and a size cap."""
+
+    def __init__(self, max_connections: int = 64, max_bytes: int = 20 * 1024 * 1024, timeout_s: float = 10.0):
+        self.max_bytes = max_bytes
+        self.semaphore = asyncio.Semaphore(max_connections)
+        self.client = httpx.AsyncClient(
+            timeout=timeout_s,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    async def fetch(self, url: str) -> bytes:
+        try:
+            return await self._fetch(url)
+        except httpx.HTTPStatusError as e:
+            raise FetchError(f"Fetching image failed with {e.response.status_code}") from e
+        except httpx.HTTPError as e:
+            raise FetchError(f"Fetching image failed: {e!r}") from e
+
+    async def _fetch(self, url: str) -> bytes:
+        async with self.semaphore:
+            async with self.client.stream("GET", url) as response:
+                response.raise_for_status()
+                # Reject early when the origin announces the size, otherwise count while reading
+                length = response.headers.get("content-length")
+                if length is not None and int(length) > self.max_bytes:
+                    raise ImageTooLarge(f"Image is {length} bytes, limit is {self.max_bytes}")
+                chunks, size = [], 0
+                async for chunk in response.aiter_bytes():
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise ImageTooLarge(f"Image exceeds {self.max_bytes} bytes")
+                    chunks.append(chunk)
+        return b"".join(chunks)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def content_key(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class DetectionCache:
+    """LRU of detections keyed by image content hash.
+
+    Concurrent misses on the same key share one computation instead of each
+    sending the image to the model.
+    """
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Any]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody else may be waiting; mark the exception as retrieved
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            self.put(key, value)
+            return value
+        finally:
+            self._pending.pop(key, None)
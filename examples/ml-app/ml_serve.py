@@ -7,17 +7,22 @@ Ray cluster dependency management docs: https://docs.ray.io/en/latest/ray-core/h
 
 '''
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
 import torch
-from PIL import Image
 import numpy as np
-from io import BytesIO
-from fastapi.responses import Response
-from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response
+from fastapi import FastAPI, HTTPException
 
 import ray
 from ray import serve
 from ray.serve.handle import DeploymentHandle
 
+from detection import check_image, decode_image, detect_images, detections_to_json, render_jpeg
+from image_fetch import DetectionCache, FetchError, ImageFetcher, content_key
+
 runtime_env = {"pip": ["ultralytics"]}
 
 ray.init(runtime_env=runtime_env)
@@ -33,34 +38,88 @@ app = FastAPI()
 )
 @serve.ingress(app)
 class APIIngress:
-    def __init__(self, object_detection_handle: DeploymentHandle):
+    def __init__(
+        self,
+        object_detection_handle: DeploymentHandle,
+        render_workers: int = 4,
+        fetch_max_connections: int = 64,
+        max_image_bytes: int = 20 * 1024 * 1024,
+        cache_max_entries: int = 4096,
+    ):
         self.handle = object_detection_handle
+        # JPEG rendering/encoding runs here instead of on the event loop
+        self.render_pool = ThreadPoolExecutor(max_workers=render_workers)
+        self.names = None
+        # Images are downloaded here so network stalls never hold a GPU batch slot
+        self.fetcher = ImageFetcher(max_connections=fetch_max_connections, max_bytes=max_image_bytes)
+        self.cache = DetectionCache(max_entries=cache_max_entries)
+
+    async def fetch(self, image_url: str) -> bytes:
+        try:
+            return await self.fetcher.fetch(image_url)
+        except FetchError as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
 
     @app.get(
         "/detect",
-        responses={200: {"content": {"image/jpeg": {}}}},
+        responses={200: {"content": {"image/jpeg": {}, "application/json": {}}}},
         response_class=Response,
     )
-    async def detect(self, image_url: str):
-        image = await self.handle.detect.remote(image_url)
-        file_stream = BytesIO()
-        image.save(file_stream, "jpeg")
-        return Response(content=file_stream.getvalue(), media_type="image/jpeg")
+    async def detect(self, image_url: str, format: str = "jpeg"):
+        if self.names is None:
+            self.names = await self.handle.class_names.remote()
+
+        data = await self.fetch(image_url)
+        # Rejected here, before it can share a GPU batch with other requests
+        try:
+            await asyncio.to_thread(check_image, data)
+        except ValueError as e:
+            raise HTTPException(status_code=415, detail=str(e))
+        # Keyed by content, so the same image under different URLs is inferred once
+        detections = await self.cache.get_or_compute(
+            content_key(data), lambda: self.handle.detect.remote(data)
+        )
+
+        if format == "json":
+            # Detections only, nothing is rendered
+            return JSONResponse(detections_to_json(detections, self.names))
+
+        content = await asyncio.get_running_loop().run_in_executor(
+            self.render_pool, lambda: render_jpeg(decode_image(data), detections, self.names)
+        )
+        return Response(content=content, media_type="image/jpeg")
 
 
 @serve.deployment(
     ray_actor_options={"num_gpus": 1},
     autoscaling_config={"min_replicas": 1},
+    # Must be at least the batch size or requests never fill a batch
+    max_ongoing_requests=64,
 )
 class ObjectDetection:
-    def __init__(self):
+    def __init__(self, max_batch_size: int = 16, batch_wait_timeout_s: float = 0.01):
         self.model = torch.hub.load("ultralytics/yolov5", "yolov5s")
-        self.model.cuda()
-        self.model.to(torch.device(0))
-
-    def detect(self, image_url: str):
-        result_im = self.model(image_url)
-        return Image.fromarray(result_im.render()[0].astype(np.uint8))
+        self.device = torch.device(0)
+        self.model.to(self.device).half().eval()
+        self.names = self.model.names
+        self.detect_batch.set_max_batch_size(max_batch_size)
+        self.detect_batch.set_batch_wait_timeout_s(batch_wait_timeout_s)
+
+    def class_names(self) -> Dict[int, str]:
+        return dict(enumerate(self.names)) if isinstance(self.names, list) else dict(self.names)
+
+    async def detect(self, image: bytes) -> Dict[str, np.ndarray]:
+        # Decoded per request before batching, so an image that fails to
+        # decode fails only its own caller, not the whole batch
+        decoded = await asyncio.to_thread(decode_image, image)
+        return await self.detect_batch(decoded)
+
+    # Concurrent /detect calls are stacked into one forward pass; Serve scatters
+    # the returned list back to the individual callers in order. Results are
+    # plain NumPy arrays, which the caller reads zero-copy from the object store.
+    @serve.batch(max_batch_size=16, batch_wait_timeout_s=0.01)
+    async def detect_batch(self, images: List[np.ndarray]) -> List[Dict[str, np.ndarray]]:
+        return detect_images(self.model, images, self.device)
 
 entrypoint = APIIngress.bind(
     ObjectDetection.options(
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app's modules are imported by name, as in the Serve working_dir
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
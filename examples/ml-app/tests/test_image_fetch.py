@@ -0,0 +1,152 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from image_fetch import DetectionCache, FetchError, ImageFetcher, ImageTooLarge, content_key
+
+IMAGE = b"\x89PNG" + bytes(1000)
+MAX_BYTES = 4096
+
+
+class Origin(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/image.png":
+            self.reply(200, IMAGE)
+        elif self.path == "/large.png":
+            self.reply(200, bytes(MAX_BYTES + 1))
+        elif self.path == "/large-unannounced.png":
+            # No Content-Length: the size is only known while reading
+            self.send_response(200)
+            self.end_headers()
+            for _ in range(8):
+                self.wfile.write(bytes(1024))
+            self.close_connection = True
+        elif self.path == "/moved.png":
+            self.send_response(302)
+            self.send_header("Location", "/image.png")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.reply(404, b"not found")
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def origin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def fetch(url):
+    async def run():
+        fetcher = ImageFetcher(max_connections=2, max_bytes=MAX_BYTES, timeout_s=5)
+        try:
+            return await fetcher.fetch(url)
+        finally:
+            await fetcher.close()
+
+    return asyncio.run(run())
+
+
+def test_fetch(origin):
+    assert fetch(f"{origin}/image.png") == IMAGE
+
+
+def test_fetch_follows_redirects(origin):
+    assert fetch(f"{origin}/moved.png") == IMAGE
+
+
+@pytest.mark.parametrize("path", ["/large.png", "/large-unannounced.png"])
+def test_fetch_size_cap(origin, path):
+    with pytest.raises(ImageTooLarge) as e:
+        fetch(f"{origin}{path}")
+    assert e.value.status_code == 413
+
+
+def test_fetch_upstream_error(origin):
+    with pytest.raises(FetchError, match="failed with 404") as e:
+        fetch(f"{origin}/missing.png")
+    assert e.value.status_code == 502
+
+
+def test_fetch_connection_error(origin):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Origin)
+    port = server.server_port
+    server.server_close()
+    with pytest.raises(FetchError) as e:
+        fetch(f"http://127.0.0.1:{port}/image.png")
+    assert e.value.status_code == 502
+
+
+def test_cache_hit_by_content():
+    cache = DetectionCache(max_entries=2)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return ["detection"]
+
+    async def run():
+        # Same bytes, whatever URL they came from
+        for _ in range(3):
+            assert await cache.get_or_compute(content_key(IMAGE), compute) == ["detection"]
+
+    asyncio.run(run())
+    assert len(calls) == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_cache_concurrent_misses_share_compute():
+    cache = DetectionCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ["detection"]
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute("key", compute) for _ in range(5)))
+
+    assert asyncio.run(run()) == [["detection"]] * 5
+    assert len(calls) == 1
+
+
+def test_cache_does_not_keep_failures():
+    cache = DetectionCache()
+
+    async def fail():
+        raise RuntimeError("replica died")
+
+    async def succeed():
+        return ["detection"]
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute("key", fail)
+        return await cache.get_or_compute("key", succeed)
+
+    assert asyncio.run(run()) == ["detection"]
+
+
+def test_cache_evicts_least_recently_used():
+    cache = DetectionCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
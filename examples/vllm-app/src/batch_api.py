@@ -0,0 +1,346 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger("ray.serve")
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+TERMINAL_STATUSES = ("completed", "failed", "cancelled", "expired")
+MAX_VALIDATION_ERRORS = 100
+# Bytes of input read per trip to the I/O thread
+READ_CHUNK_BYTES = 1 << 16
+# Seconds between progress checkpoints of a running batch
+SAVE_INTERVAL = 1.0
+
+
+class BatchStore:
+    """Files and batch objects of the OpenAI Batch API, kept on local disk.
+
+    `batch_dir` should be on persistent storage (e.g. the mounted /tmp/ray) so
+    that a restarted replica can pick up unfinished batches.
+    """
+
+    def __init__(self, batch_dir: str):
+        self.files_dir = os.path.join(batch_dir, "files")
+        self.batches_dir = os.path.join(batch_dir, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+
+    # Files
+    def file_path(self, file_id: str) -> str:
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def create_file(self, filename: str, purpose: str, chunks: Iterator[bytes]) -> Dict[str, Any]:
+        file_id = f"file-{uuid.uuid4().hex}"
+        size = 0
+        with open(self.file_path(file_id), "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        file = {
+            "id": file_id,
+            "object": "file",
+            "bytes": size,
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+        }
+        with open(os.path.join(self.files_dir, f"{file_id}.json"), "w") as f:
+            json.dump(file, f)
+        return file
+
+    def get_file(self, file_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.files_dir, f"{file_id}.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    # Batches
+    def save_batch(self, batch: Dict[str, Any]) -> None:
+        path = os.path.join(self.batches_dir, f"{batch['id']}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(batch, f)
+        os.replace(f"{path}.tmp", path)
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(os.path.join(self.batches_dir, f"{batch_id}.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def list_batches(self) -> Iterator[Dict[str, Any]]:
+        for name in sorted(os.listdir(self.batches_dir)):
+            if name.endswith(".json"):
+                batch = self.get_batch(name[:-len(".json")])
+                if batch is not None:
+                    yield batch
+
+    def page_batches(self, after: Optional[str] = None, limit: int = 20) -> Dict[str, Any]:
+        """Newest first, paginated like the Batch API's list endpoint."""
+        batches = sorted(self.list_batches(), key=lambda b: (b["created_at"], b["id"]), reverse=True)
+        if after is not None:
+            ids = [b["id"] for b in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        page = batches[:limit]
+        return {
+            "object": "list",
+            "data": page,
+            "first_id": page[0]["id"] if page else None,
+            "last_id": page[-1]["id"] if page else None,
+            "has_more": len(batches) > limit,
+        }
+
+
+def read_done_ids(path: str) -> Set[str]:
+    """custom_ids already written to a results file; drops a torn last line."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["custom_id"])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    with open(path, "ab") as f:
+        f.truncate(valid_bytes)
+    return done
+
+
+def append_line(f, line: str) -> None:
+    f.write(line + "\n")
+    f.flush()
+
+
+def validate_input(path: str) -> Tuple[int, List[Dict[str, Any]]]:
+    """Request count of a batch input file and its invalid lines, in the
+    Batch API's error format (at most MAX_VALIDATION_ERRORS of them)."""
+    total = 0
+    errors = []
+    custom_ids = set()
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            total += 1
+            try:
+                item = json.loads(line)
+            except ValueError as e:
+                message = f"Invalid JSON: {e}"
+            else:
+                if not isinstance(item, dict):
+                    message = "Expected a JSON object"
+                elif not isinstance(item.get("custom_id"), str):
+                    message = "Missing or non-string custom_id"
+                elif item["custom_id"] in custom_ids:
+                    message = f"Duplicate custom_id {item['custom_id']}"
+                elif not isinstance(item.get("body"), dict):
+                    message = "Missing or non-object body"
+                else:
+                    custom_ids.add(item["custom_id"])
+                    continue
+            if len(errors) < MAX_VALIDATION_ERRORS:
+                errors.append({"code": "invalid_request", "message": message, "line": number})
+    if total == 0:
+        errors.append({"code": "empty_file", "message": "The input file has no requests", "line": None})
+    return total, errors
+
+
+class BatchRunner:
+    """Runs batches through the chat serving path at lower priority than
+    interactive traffic.
+
+    Input lines are read lazily into a bounded queue (backpressure) and at
+    most `max_concurrency` batch requests are in the engine at once. Every
+    result is appended to the output or error file as it completes, which is
+    also the checkpoint: on resume, custom_ids already written are skipped.
+    File I/O of running batches goes through one dedicated thread, which
+    keeps it off the replica's event loop and keeps the appends in order.
+    """
+
+    def __init__(
+        self,
+        store: BatchStore,
+        create_chat_completion: Callable,
+        interactive_inflight: Callable[[], int],
+        max_concurrency: int = 8,
+        priority: Optional[int] = None,
+        pause_threshold: int = 32,
+    ):
+        self.store = store
+        self.create_chat_completion = create_chat_completion
+        self.interactive_inflight = interactive_inflight
+        self.max_concurrency = max_concurrency
+        self.priority = priority
+        self.pause_threshold = pause_threshold
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-io")
+
+    async def _io(self, fn: Callable, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io, fn, *args)
+
+    async def _save(self, batch: Dict[str, Any]) -> None:
+        # A snapshot, the workers keep updating the counts meanwhile
+        await self._io(self.store.save_batch, {**batch, "request_counts": dict(batch["request_counts"])})
+
+    def create(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[Dict] = None) -> Dict[str, Any]:
+        """Validates the input file and persists the batch; blocking file I/O,
+        run it off the event loop and `start` the returned batch if it is
+        still "validating"."""
+        if endpoint not in SUPPORTED_ENDPOINTS:
+            raise ValueError(f"Unsupported endpoint {endpoint}, expected one of {SUPPORTED_ENDPOINTS}")
+        if self.store.get_file(input_file_id) is None:
+            raise ValueError(f"No such file: {input_file_id}")
+
+        total, errors = validate_input(self.store.file_path(input_file_id))
+        batch = {
+            "id": f"batch_{uuid.uuid4().hex}",
+            "object": "batch",
+            "endpoint": endpoint,
+            "input_file_id": input_file_id,
+            "completion_window": completion_window,
+            "status": "validating",
+            "output_file_id": f"file-{uuid.uuid4().hex}",
+            "error_file_id": f"file-{uuid.uuid4().hex}",
+            "created_at": int(time.time()),
+            "in_progress_at": None,
+            "completed_at": None,
+            "failed_at": None,
+            "cancelled_at": None,
+            "request_counts": {"total": total, "completed": 0, "failed": 0},
+            "metadata": metadata,
+            "errors": None,
+        }
+        if errors:
+            batch.update(status="failed", failed_at=int(time.time()), errors={"object": "list", "data": errors})
+        self.store.save_batch(batch)
+        return batch
+
+    def start(self, batch: Dict[str, Any]) -> None:
+        """Schedules the batch on the running event loop."""
+        self.tasks[batch["id"]] = asyncio.get_running_loop().create_task(self._run(batch))
+
+    def resume(self) -> None:
+        for batch in self.store.list_batches():
+            if batch["status"] not in TERMINAL_STATUSES and batch["status"] != "cancelling":
+                logger.info(f"Resuming batch {batch['id']} ({batch['request_counts']})")
+                self.start(batch)
+
+    async def cancel(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        batch = await self._io(self.store.get_batch, batch_id)
+        if batch is None or batch["status"] in TERMINAL_STATUSES:
+            return batch
+        task = self.tasks.pop(batch_id, None)
+        if task is not None:
+            task.cancel()
+        batch.update(status="cancelled", cancelled_at=int(time.time()))
+        await self._save(batch)
+        return batch
+
+    async def _run(self, batch: Dict[str, Any]) -> None:
+        output_path = self.store.file_path(batch["output_file_id"])
+        error_path = self.store.file_path(batch["error_file_id"])
+        completed = await self._io(read_done_ids, output_path)
+        failed = await self._io(read_done_ids, error_path)
+        done = completed | failed
+        batch["request_counts"]["completed"] = len(completed)
+        batch["request_counts"]["failed"] = len(failed)
+        batch.update(status="in_progress", in_progress_at=batch["in_progress_at"] or int(time.time()))
+        await self._save(batch)
+
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * self.max_concurrency)
+        files = []
+        try:
+            output = await self._io(open, output_path, "a")
+            files.append(output)
+            errors = await self._io(open, error_path, "a")
+            files.append(errors)
+            f = await self._io(open, self.store.file_path(batch["input_file_id"]))
+            files.append(f)
+            progress = {"saved_at": time.monotonic()}
+            workers = [
+                asyncio.create_task(self._worker(batch, queue, output, errors, progress))
+                for _ in range(self.max_concurrency)
+            ]
+            try:
+                while lines := await self._io(f.readlines, READ_CHUNK_BYTES):
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        # Validated in create
+                        item = json.loads(line)
+                        if item["custom_id"] in done:
+                            continue
+                        # Blocks while the workers are busy
+                        await queue.put(item)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+        except Exception as e:
+            logger.exception(f"Batch {batch['id']} failed")
+            batch.update(
+                status="failed",
+                failed_at=int(time.time()),
+                errors={"object": "list", "data": [{"code": "batch_failed", "message": str(e)}]},
+            )
+            await self._save(batch)
+            self.tasks.pop(batch["id"], None)
+            return
+        finally:
+            for file in files:
+                self.io.submit(file.close)
+
+        batch.update(status="completed", completed_at=int(time.time()))
+        await self._save(batch)
+        self.tasks.pop(batch["id"], None)
+        logger.info(f"Batch {batch['id']} completed: {batch['request_counts']}")
+
+    async def _worker(self, batch: Dict[str, Any], queue: asyncio.Queue, output, errors, progress: Dict[str, float]) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            # Interactive requests go first: hold back while they saturate the engine
+            while self.interactive_inflight() >= self.pause_threshold:
+                await asyncio.sleep(0.1)
+
+            body = {**item["body"], "stream": False}
+            if self.priority is not None:
+                body["priority"] = self.priority
+            request_id = f"batch_req_{uuid.uuid4().hex}"
+            try:
+                status_code, response = await self.create_chat_completion(body)
+            except Exception as e:
+                # One bad request fails its line, not the batch
+                logger.exception(f"Batch {batch['id']} request {item['custom_id']} failed")
+                status_code, response = 500, {"message": str(e)}
+            result = {
+                "id": request_id,
+                "custom_id": item["custom_id"],
+                "response": {"status_code": status_code, "request_id": request_id, "body": response},
+                "error": None,
+            }
+            if status_code == 200:
+                await self._io(append_line, output, json.dumps(result))
+                batch["request_counts"]["completed"] += 1
+            else:
+                result["error"] = {"code": str(status_code), "message": response.get("message")}
+                await self._io(append_line, errors, json.dumps(result))
+                batch["request_counts"]["failed"] += 1
+
+            now = time.monotonic()
+            if now - progress["saved_at"] >= SAVE_INTERVAL:
+                progress["saved_at"] = now
+                await self._save(batch)
@@ -1,10 +1,13 @@
-from typing import Dict, Optional, List
+from typing import Any, Dict, Optional, List, Tuple
+import asyncio
 import logging
 import os
+import time
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Form, UploadFile
+from pydantic import ValidationError
 from starlette.requests import Request
-from starlette.responses import StreamingResponse, JSONResponse
+from starlette.responses import FileResponse, StreamingResponse, JSONResponse
 
 from ray import serve
 
@@ -21,6 +24,9 @@ from vllm.entrypoints.openai.serving_models import BaseModelPath, OpenAIServingM
 from vllm.utils import FlexibleArgumentParser
 from vllm.entrypoints.logger import RequestLogger
 
+from batch_api import BatchRunner, BatchStore
+from stage_metrics import StageMetrics, request_tags
+
 logger = logging.getLogger("ray.serve")
 
 app = FastAPI()
@@ -28,28 +34,127 @@ app = FastAPI()
 @serve.deployment(
     autoscaling_config={"max_replicas": 1},
     ray_actor_options={
-        "runtime_env": {"pip": ["vllm==0.8.3"]}
+        "runtime_env": {
+            "pip": ["vllm==0.8.3"],
+            # vllm 0.8 defaults to the V1 engine, which leaves RequestOutput.metrics
+            # (read by StageMetrics) empty and has no priority scheduling for batches
+            "env_vars": {"VLLM_USE_V1": "0"},
+        }
     }
 )
 @serve.ingress(app)
 class VLLMDeployment:
-    def __init__(
+    # Serve awaits the constructor before the replica is marked running, so no
+    # traffic is routed here until the engine is built and warmed up.
+    async def __init__(
         self,
         engine_args: AsyncEngineArgs,
         response_role: str,
         request_logger: Optional[RequestLogger] = None,
         chat_template: Optional[str] = None,
+        warmup_prompt_lengths: Optional[List[int]] = None,
+        warmup_max_tokens: int = 16,
+        batch_dir: str = "/tmp/ray/vllm_batches",
+        batch_max_concurrency: int = 8,
+        batch_priority: int = 10,
     ):
         logger.info(f"Starting with engine args: {engine_args}")
         self.engine_args = engine_args
         self.response_role = response_role
         self.request_logger = request_logger
         self.chat_template = chat_template
-        self.openai_serving_chat = None
+        self.ready = False
         if 'CUDA_VISIBLE_DEVICES' in os.environ:
             logger.info(f"Unsetting CUDA_VISIBLE_DEVICES (was {os.environ['CUDA_VISIBLE_DEVICES']})")
             del os.environ['CUDA_VISIBLE_DEVICES']
         self.engine = AsyncLLMEngine.from_engine_args(engine_args)
+        self.metrics = StageMetrics()
+        self.metrics.instrument_engine(self.engine)
+
+        await self._init_serving()
+        await self._warmup(warmup_prompt_lengths or [], warmup_max_tokens)
+
+        # Offline batches run behind interactive traffic: with
+        # scheduling_policy=priority the engine schedules them after interactive
+        # requests (lower value = earlier), otherwise they only yield via pausing.
+        self.interactive_inflight = 0
+        self.batch_store = BatchStore(batch_dir)
+        self.batch_runner = BatchRunner(
+            self.batch_store,
+            self._batch_chat_completion,
+            lambda: self.interactive_inflight,
+            max_concurrency=batch_max_concurrency,
+            priority=batch_priority if engine_args.scheduling_policy == "priority" else None,
+            pause_threshold=self.engine_args.max_num_seqs,
+        )
+        self.batch_runner.resume()
+
+        self.ready = True
+        logger.info("Replica ready")
+
+    async def _init_serving(self):
+        self.model_config = await self.engine.get_model_config()
+        # Determine the name of the served model for the OpenAI client.
+        if self.engine_args.served_model_name is not None:
+            self.served_model_names = self.engine_args.served_model_name
+        else:
+            self.served_model_names = [self.engine_args.model]
+        base_model_paths = [
+            BaseModelPath(name=name, model_path=self.engine_args.model)
+            for name in self.served_model_names
+        ]
+        self.openai_serving_models = OpenAIServingModels(
+            engine_client=self.engine,
+            model_config=self.model_config,
+            base_model_paths=base_model_paths,
+        )
+        await self.openai_serving_models.init_static_loras()
+        self.openai_serving_chat = OpenAIServingChat(
+            self.engine,
+            self.model_config,
+            self.openai_serving_models,
+            self.response_role,
+            request_logger=self.request_logger,
+            chat_template=self.chat_template,
+            chat_template_content_format=None,
+        )
+
+    async def _warmup(self, prompt_lengths: List[int], max_tokens: int):
+        """Runs synthetic streaming and non-streaming requests through the full
+        chat path so kernels, CUDA graphs and the tokenizer are warm before the
+        first user request."""
+        # Leave room for the chat template and the generated tokens
+        longest = self.model_config.max_model_len - max_tokens - 64
+        # Kept apart from user traffic in the stage histograms, and reset so
+        # tasks started later from __init__ do not inherit the tag
+        token = request_tags.set({"model": self.served_model_names[0], "stream": "warmup"})
+        try:
+            for length in prompt_lengths:
+                length = max(1, min(length, longest))
+                for stream in (False, True):
+                    start = time.perf_counter()
+                    request = ChatCompletionRequest(
+                        model=self.served_model_names[0],
+                        messages=[{"role": "user", "content": " ".join(["hello"] * length)}],
+                        max_tokens=max_tokens,
+                        temperature=0,
+                        stream=stream,
+                    )
+                    generator = await self.openai_serving_chat.create_chat_completion(request)
+                    if isinstance(generator, ErrorResponse):
+                        raise RuntimeError(f"Warm-up request failed: {generator.message}")
+                    if stream:
+                        async for _ in generator:
+                            pass
+                    logger.info(f"Warm-up prompt_len={length} stream={stream}: {time.perf_counter() - start:.2f}s")
+        finally:
+            request_tags.reset(token)
+
+    async def check_health(self):
+        # Serve restarts the replica if this raises
+        if not self.ready:
+            raise RuntimeError("Replica is not warmed up")
+        await self.engine.check_health()
 
     @app.post("/v1/chat/completions")
     async def create_chat_completion(
@@ -60,47 +165,107 @@ class VLLMDeployment:
         API reference:
             - https://docs.vllm.ai/en/latest/serving/openai_compatible_server.html
         """
-        print('Incoming completion request...')
-        if not self.openai_serving_chat:
-            model_config = await self.engine.get_model_config()
-            print('Model config, completion request...')
-            # Determine the name of the served model for the OpenAI client.
-            if self.engine_args.served_model_name is not None:
-                served_model_names = self.engine_args.served_model_name
-            else:
-                served_model_names = [self.engine_args.model]
-            base_model_paths = [
-                BaseModelPath(name=name, model_path=self.engine_args.model)
-                for name in served_model_names
-            ]
-            self.openai_serving_models = OpenAIServingModels(
-                engine_client=self.engine,
-                model_config=model_config,
-                base_model_paths=base_model_paths,
-            )
-            self.openai_serving_chat = OpenAIServingChat(
-                self.engine,
-                model_config,
-                self.openai_serving_models,
-                self.response_role,
-                request_logger=self.request_logger,
-                chat_template=self.chat_template,
-                chat_template_content_format=None,
+        logger.debug("Request: %s", request)
+        tags = {"model": request.model, "stream": "true" if request.stream else "false"}
+        request_tags.set(tags)
+        self.interactive_inflight += 1
+        try:
+            generator = await self.openai_serving_chat.create_chat_completion(
+                request, raw_request
             )
-        logger.info(f"Request: {request}")
-        generator = await self.openai_serving_chat.create_chat_completion(
-            request, raw_request
-        )
+        except BaseException:
+            self.interactive_inflight -= 1
+            raise
         if isinstance(generator, ErrorResponse):
+            self.interactive_inflight -= 1
             return JSONResponse(
                 content=generator.model_dump(), status_code=generator.code
             )
         if request.stream:
-            return StreamingResponse(content=generator, media_type="text/event-stream")
+            return StreamingResponse(
+                content=self._track_stream(self.metrics.timed_stream(generator, tags)),
+                media_type="text/event-stream",
+            )
         else:
+            self.interactive_inflight -= 1
             assert isinstance(generator, ChatCompletionResponse)
             return JSONResponse(content=generator.model_dump())
 
+    async def _track_stream(self, chunks):
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.interactive_inflight -= 1
+
+    # ================================================================== #
+    # OpenAI Batch API
+    # https://platform.openai.com/docs/api-reference/batch
+    # ================================================================== #
+    async def _batch_chat_completion(self, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any]]:
+        try:
+            request = ChatCompletionRequest(**body)
+        except ValidationError as e:
+            return 400, {"message": str(e)}
+        request_tags.set({"model": request.model, "stream": "batch"})
+        response = await self.openai_serving_chat.create_chat_completion(request)
+        if isinstance(response, ErrorResponse):
+            return response.code, response.model_dump()
+        return 200, response.model_dump()
+
+    @app.post("/v1/files")
+    async def create_file(self, file: UploadFile, purpose: str = Form("batch")):
+        def chunks():
+            while chunk := file.file.read(1 << 20):
+                yield chunk
+
+        return JSONResponse(
+            await asyncio.to_thread(self.batch_store.create_file, file.filename, purpose, chunks())
+        )
+
+    @app.get("/v1/files/{file_id}/content")
+    async def file_content(self, file_id: str):
+        path = self.batch_store.file_path(file_id)
+        if not os.path.exists(path):
+            return JSONResponse({"message": f"No such file: {file_id}"}, status_code=404)
+        return FileResponse(path, media_type="application/jsonl")
+
+    @app.post("/v1/batches")
+    async def create_batch(self, raw_request: Request):
+        body = await raw_request.json()
+        try:
+            batch = await asyncio.to_thread(
+                self.batch_runner.create,
+                body["input_file_id"],
+                body.get("endpoint", "/v1/chat/completions"),
+                body.get("completion_window", "24h"),
+                body.get("metadata"),
+            )
+        except (KeyError, ValueError) as e:
+            return JSONResponse({"message": str(e)}, status_code=400)
+        # The batch task belongs on this event loop, not the file I/O thread
+        if batch["status"] == "validating":
+            self.batch_runner.start(batch)
+        return JSONResponse(batch)
+
+    @app.get("/v1/batches")
+    async def list_batches(self, after: Optional[str] = None, limit: int = 20):
+        return JSONResponse(await asyncio.to_thread(self.batch_store.page_batches, after, limit))
+
+    @app.get("/v1/batches/{batch_id}")
+    async def retrieve_batch(self, batch_id: str):
+        batch = await asyncio.to_thread(self.batch_store.get_batch, batch_id)
+        if batch is None:
+            return JSONResponse({"message": f"No such batch: {batch_id}"}, status_code=404)
+        return JSONResponse(batch)
+
+    @app.post("/v1/batches/{batch_id}/cancel")
+    async def cancel_batch(self, batch_id: str):
+        batch = await self.batch_runner.cancel(batch_id)
+        if batch is None:
+            return JSONResponse({"message": f"No such batch: {batch_id}"}, status_code=404)
+        return JSONResponse(batch)
+
 
 def parse_vllm_args(cli_args: Dict[str, str]):
     """Parses vLLM args based on CLI inputs.
@@ -134,6 +299,16 @@ def build_app(cli_args: Dict[str, str]) -> serve.Application:
         cli_args["max_num_seqs"] = "64"
     if "max_num_batched_tokens" not in cli_args:
         cli_args["max_num_batched_tokens"] = "8192"
+
+    # Deployment-only options, not understood by the vLLM arg parser.
+    # warmup_prompt_lengths="" disables the warm-up pass.
+    warmup_prompt_lengths = [
+        int(n) for n in cli_args.pop("warmup_prompt_lengths", "16,256,1024").split(",") if n
+    ]
+    warmup_max_tokens = int(cli_args.pop("warmup_max_tokens", "16"))
+    batch_dir = cli_args.pop("batch_dir", "/tmp/ray/vllm_batches")
+    batch_max_concurrency = int(cli_args.pop("batch_max_concurrency", "8"))
+    batch_priority = int(cli_args.pop("batch_priority", "10"))
     
     parsed_args = parse_vllm_args(cli_args)
     engine_args = AsyncEngineArgs.from_cli_args(parsed_args)
@@ -148,5 +323,10 @@ def build_app(cli_args: Dict[str, str]) -> serve.Application:
         parsed_args.response_role,
         cli_args.get("request_logger"),
         parsed_args.chat_template,
+        warmup_prompt_lengths,
+        warmup_max_tokens,
+        batch_dir,
+        batch_max_concurrency,
+        batch_priority,
     )
 
@@ -0,0 +1,96 @@
+import contextvars
+import time
+from typing import Any, AsyncIterator, Dict
+
+from ray.serve import metrics
+
+# Tags of the request being handled. The engine's generate() is called from the
+# request handler's context, so the wrapped generate can pick them up here.
+request_tags: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar(
+    "request_tags", default={"model": "", "stream": "false"}
+)
+
+LATENCY_BOUNDARIES_S = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+PER_TOKEN_BOUNDARIES_S = [0.001, 0.0025, 0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.25, 0.5]
+FLUSH_BOUNDARIES_S = [0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5, 1]
+
+
+class StageMetrics:
+    """Per-stage latency histograms for the vLLM deployment, exported through
+    Ray's metrics API (scraped by the `ray` job in prometheus.yml).
+
+    Queue wait, prefill, time-to-first-token and decode time per token come
+    from the engine's per-request metrics, which only the V0 engine fills (the
+    deployment pins VLLM_USE_V1=0). Stream flush is the time spent handing
+    each SSE chunk to the client.
+    """
+
+    def __init__(self):
+        tag_keys = ("model", "stream")
+        self.queue_wait = metrics.Histogram(
+            "vllm_deployment_queue_wait_seconds",
+            description="Time from engine arrival until the request is first scheduled.",
+            boundaries=LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.prefill = metrics.Histogram(
+            "vllm_deployment_prefill_seconds",
+            description="Time from first scheduling until the first token is generated.",
+            boundaries=LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.ttft = metrics.Histogram(
+            "vllm_deployment_time_to_first_token_seconds",
+            description="Time from engine arrival until the first token is generated.",
+            boundaries=LATENCY_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.decode_per_token = metrics.Histogram(
+            "vllm_deployment_decode_per_token_seconds",
+            description="Mean decode time per output token after the first.",
+            boundaries=PER_TOKEN_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+        self.stream_flush = metrics.Histogram(
+            "vllm_deployment_stream_flush_seconds",
+            description="Time spent handing one SSE chunk to the client.",
+            boundaries=FLUSH_BOUNDARIES_S,
+            tag_keys=tag_keys,
+        )
+
+    def instrument_engine(self, engine) -> None:
+        """Wraps `engine.generate` so finished requests record their stage latencies."""
+        generate = engine.generate
+
+        def timed_generate(*args, **kwargs):
+            return self._observe_outputs(generate(*args, **kwargs), request_tags.get())
+
+        engine.generate = timed_generate
+
+    async def _observe_outputs(self, outputs: AsyncIterator[Any], tags: Dict[str, str]) -> AsyncIterator[Any]:
+        output = None
+        try:
+            async for output in outputs:
+                yield output
+        finally:
+            await outputs.aclose()
+        if output is not None and output.finished:
+            self.observe_request(output, tags)
+
+    def observe_request(self, output: Any, tags: Dict[str, str]) -> None:
+        m = output.metrics
+        if m is None or m.first_token_time is None:
+            return
+        if m.first_scheduled_time is not None:
+            self.queue_wait.observe(m.first_scheduled_time - m.arrival_time, tags=tags)
+            self.prefill.observe(m.first_token_time - m.first_scheduled_time, tags=tags)
+        self.ttft.observe(m.first_token_time - m.arrival_time, tags=tags)
+        num_tokens = max(len(completion.token_ids) for completion in output.outputs)
+        if num_tokens > 1 and m.last_token_time:
+            self.decode_per_token.observe((m.last_token_time - m.first_token_time) / (num_tokens - 1), tags=tags)
+
+    async def timed_stream(self, chunks: AsyncIterator[str], tags: Dict[str, str]) -> AsyncIterator[str]:
+        async for chunk in chunks:
+            start = time.perf_counter()
+            yield chunk
+            self.stream_flush.observe(time.perf_counter() - start, tags=tags)
@@ -9,4 +9,8 @@ serve run llm_serve:build_app \
   max_model_len=2048 \
   max_num_seqs=64 \
   max_num_batched_tokens=8192 \
+  warmup_prompt_lengths="16,256,1024" \
+  warmup_max_tokens=16 \
+  scheduling_policy=priority \
+  batch_max_concurrency=8 \
   guided_decoding_backend="xgrammar"